@@ -227,7 +227,7 @@ def main():
         otherenvs = config_document.createElement("otherenvs")
         if compiler[5]:
             length = config_document.createElement("length")
-            length.appendChild(config_document.createTextNode(len(compiler[5])))
+            length.appendChild(config_document.createTextNode(str(len(compiler[5]))))
             otherenvs.appendChild(length)
             i = 0
             for otherenv in compiler[5]:
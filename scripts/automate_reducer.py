@@ -1,16 +1,32 @@
 import argparse
+import hashlib
 import os
 import shlex
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
 from datetime import timedelta
 
 import create_shell_test
 import common
+import pre_reduction
+import profiler
+import reducer_portfolio
+import reduction_queue
 import splitter_merger
 
+# Smallest interesting shader found by the interestingness test during a checkpointed reduction
+CHECKPOINT_FILE = "checkpoint.comp"
+# Best partial result of an interrupted reduction (SEED_partial.shadertrap in the keptshaders directory)
+PARTIAL_SUFFIX = "_partial.shadertrap"
+# Hash of the shader whose reduction produced a partial result (next to the partial result)
+PARTIAL_SOURCE_SUFFIX = ".source"
+# Running reducer, started in its own process group which is killed with the reduction (see handle_sigterm)
+reducer_process = None
+
 
 def main():
     parser = argparse.ArgumentParser(description="Automates the reduction of a shadertrap file")
@@ -30,7 +46,53 @@ def main():
                         help="forces the reducer to attempt to reduce shaders which time out")
     parser.add_argument("--instrumentation", dest="instru", action="store_true",
                         help="adds an extra line in the shell script to generate a reduction log file")
+    parser.add_argument("--pre-reduction", dest="pre_reduction", default=0, type=int, nargs="?", const=os.cpu_count(),
+                        help="remove chunks of lines of the shader with a built-in delta debugging pass before "
+                             "calling the reducer, evaluating this number of candidates in parallel (by default: "
+                             "the number of cpus)")
+    parser.add_argument("--shader-time-budget", dest="shader_budget", default=0, type=int,
+                        help="stop the reduction of a shader after this number of seconds, keeping its best partial "
+                             "result (by default: no limit)")
+    parser.add_argument("--batch-time-budget", dest="batch_budget", default=0, type=int,
+                        help="stop the batch reduction after this number of seconds (by default: no limit)")
+    parser.add_argument("--checkpoint-interval", dest="checkpoint_interval", default=60, type=int,
+                        help="save the best partial result of the reduction every this number of seconds (by default: "
+                             "60), the reduction is resumed from it when restarted")
+    parser.add_argument("--queue-file", dest="queue_file", default="",
+                        help="specify the persistent queue of the batch reduction (by default: "
+                             + reduction_queue.QUEUE_FILE + " in the keptshaders directory)")
+    parser.add_argument("--priority", dest="priority", default="rarity,size",
+                        help="comma separated order of the batch reduction among size (smallest shader first), "
+                             "rarity (rarest divergence class first) and newest (most recently kept shader first) "
+                             "(by default: rarity,size)")
+    parser.add_argument("--workers", dest="workers", default=1, type=int,
+                        help="number of batch reduction workers sharing the queue, each worker runs in its own "
+                             "workspace of the execution directory (by default: 1)")
+    parser.add_argument("--portfolio", dest="portfolio", nargs="*", default=None,
+                        help="race the given reducers (by default: all the configured reducers) on isolated copies "
+                             "of the shader and keep the smallest interesting result")
+    parser.add_argument("--portfolio-size", dest="portfolio_size", default=0, type=int,
+                        help="only race this number of reducers, chosen by their win rate in previous races")
+    parser.add_argument("--time-budget", dest="time_budget", default=3600, type=int,
+                        help="maximum duration of a portfolio reduction in seconds (by default: 3600)")
+    parser.add_argument("--grace-period", dest="grace", default=0, type=int,
+                        help="time left to the other reducers once the first one finishes in seconds (by default: 0)")
+    parser.add_argument("--portfolio-stats", dest="portfolio_stats", default="reducer_stats.json",
+                        help="specify the file recording the wins of each reducer (by default: reducer_stats.json)")
+    profiler.add_arguments(parser)
     ns = parser.parse_args(sys.argv[1:])
+    profiler.start(ns.profile, ns.profileinterval)
+    previous_sigterm_handler = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        # The reducer runs in its own process group: it is killed with the reduction (e.g. by the portfolio)
+        kill_reducer()
+        if callable(previous_sigterm_handler):
+            previous_sigterm_handler(signum, frame)
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    # The workspaces of the portfolio and of the workers are configured after the change of directory
+    ns.config = os.path.abspath(ns.config)
 
     reducers = common.load_reducers_settings(ns.config)
     compilers = common.load_compilers_settings(ns.config)
@@ -50,44 +112,184 @@ def main():
     compilers_dict = {}
     for compiler in compilers:
         compilers_dict[compiler.name] = compiler
+    portfolio = None
+    if ns.portfolio is not None:
+        portfolio_reducers = [existing_reducer for existing_reducer in reducers
+                              if not ns.portfolio or existing_reducer.name in ns.portfolio]
+        if len(portfolio_reducers) == 0:
+            exit("No configured reducer in the portfolio")
+        portfolio = reducer_portfolio.Portfolio(portfolio_reducers, ns.config, ns.time_budget, ns.grace,
+                                                ns.portfolio_stats)
+        if ns.portfolio_size > 0:
+            portfolio.select(ns.portfolio_size)
     if ns.batch:
-        files_to_reduce = os.listdir(exec_dirs.keptshaderdir)
-        # Exclude files that have been already reduced
-        for file in list(files_to_reduce):
-            if os.path.isfile(exec_dirs.keptshaderdir + file) and len(file.split("_")) > 1:
-                files_to_reduce.remove(file)
-                if os.path.isfile(exec_dirs.keptshaderdir + file.split("_")[0] + ".shadertrap"):
-                    files_to_reduce.remove(file.split("_")[0] + ".shadertrap")
-
-        batch_reduction(reducer, compilers_dict, exec_dirs, files_to_reduce, ns.ref, ns.timeout,
-                        instrumentation=ns.instru)
+        kept_files = [file for file in os.listdir(exec_dirs.keptshaderdir) if file.endswith(".shadertrap")]
+        # Exclude files that have been already reduced (partially reduced files are resumed)
+        reduced_radixes = set([file.split("_")[0] for file in kept_files
+                               if len(file.split("_")) > 1 and not file.endswith(PARTIAL_SUFFIX)])
+        files_to_reduce = [file for file in kept_files
+                           if len(file.split("_")) == 1 and file.split(".")[0] not in reduced_radixes]
+        queue_file = ns.queue_file
+        if queue_file == "":
+            queue_file = exec_dirs.keptshaderdir + reduction_queue.QUEUE_FILE
+        queue = reduction_queue.ReductionQueue(queue_file)
+        order = reduction_queue.parse_priority(ns.priority)
+        queue.refresh(exec_dirs.keptshaderdir, kept_files, files_to_reduce)
+        if ns.workers > 1:
+            run_workers(ns, exec_dirs, queue.filename)
+        else:
+            queue_reduction(reducer, compilers_dict, exec_dirs, queue, order, ns.ref, ns.timeout,
+                            instrumentation=ns.instru, portfolio=portfolio, pre_reduction_jobs=ns.pre_reduction,
+                            time_budget=ns.shader_budget, batch_time_budget=ns.batch_budget,
+                            checkpoint_interval=ns.checkpoint_interval)
+        for state, count in queue.get_counts().items():
+            print(state + ": " + str(count))
+    elif portfolio is not None:
+        portfolio.run(exec_dirs, ns.test_file, ns.output_file, ns.ref, ns.timeout)
     else:
         run_reduction(reducer, compilers_dict, exec_dirs, ns.test_file, ns.output_file, ns.ref, ns.timeout,
-                      instrumentation=ns.instru)
+                      instrumentation=ns.instru, pre_reduction_jobs=ns.pre_reduction,
+                      partial_output=os.path.splitext(ns.test_file)[0] + PARTIAL_SUFFIX, time_budget=ns.shader_budget,
+                      checkpoint_interval=ns.checkpoint_interval)
+
+
+def run_workers(ns, exec_dirs, queue_file):
+    # Each worker is a batch reduction of its own workspace (see reducer_portfolio.py) taking shaders from the queue
+    processes = []
+    for i in range(ns.workers):
+        workspace = reducer_portfolio.create_workspace(exec_dirs.execdir, ns.config, "worker_" + str(i))
+        cmd = [sys.executable, os.path.join(workspace, "scripts", "automate_reducer.py"), "--config-file",
+               os.path.join(workspace, "scripts", "config.xml"), "--batch-reduction", "--queue-file", queue_file,
+               "--priority", ns.priority, "--reducer", ns.reducer, "--ref", str(ns.ref), "--pre-reduction",
+               str(ns.pre_reduction), "--shader-time-budget", str(ns.shader_budget), "--batch-time-budget",
+               str(ns.batch_budget), "--checkpoint-interval", str(ns.checkpoint_interval)]
+        if ns.timeout:
+            cmd.append("--reduce-timeout")
+        if ns.instru:
+            cmd.append("--instrumentation")
+        log_file = open("reduction_worker_" + str(i) + ".log", "w")
+        processes.append((workspace, subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT, cwd=workspace)))
+        log_file.close()
+        print("Worker " + str(i) + " started, logging in reduction_worker_" + str(i) + ".log")
+    for workspace, process in processes:
+        process.wait()
+        # Keep the instrumentation logs of the worker
+        for file in os.listdir(workspace):
+            if file.endswith(".log") and os.path.isfile(os.path.join(workspace, file)):
+                shutil.copy(os.path.join(workspace, file), file)
+        shutil.rmtree(workspace, ignore_errors=True)
 
 
 def batch_reduction(reducer, compilers, exec_dirs, files_to_reduce, ref, reduce_timeout, override_prefix="_reduced",
-                    instrumentation=False):
+                    instrumentation=False, journal=None, batch_nb=0, portfolio=None, pre_reduction_jobs=0,
+                    time_budget=0, batch_time_budget=0, checkpoint_interval=60):
+    batch_start = time.time()
     for file in files_to_reduce:
-        # copy file to exec_dir
-        file_radix = file.split(".")[0]
-        print("Reduction of " + exec_dirs.keptshaderdir + file)
-        shutil.copy(exec_dirs.keptshaderdir + file, "original_test.shadertrap")
-        # run reduction
-        run_reduction(reducer, compilers, exec_dirs, "original_test.shadertrap", "test_reduced.shadertrap", ref,
-                      reduce_timeout, log_file=reducer.name + "_" + file_radix + ".log",
-                      instrumentation=instrumentation)
-
-        # copy back
-        if os.path.isfile(exec_dirs.execdir + "test_reduced.shadertrap"):
-            shutil.copy("test_reduced.shadertrap",
-                        exec_dirs.keptshaderdir + file_radix + override_prefix + ".shadertrap")
-            # clean exec_dir
-            common.clean_files(os.getcwd(), ["test_reduced.shadertrap"])
+        shader_budget = get_shader_budget(time_budget, batch_start, batch_time_budget)
+        if shader_budget < 0:
+            print("Batch time budget reached, " + str(len(files_to_reduce) - files_to_reduce.index(file))
+                  + " shaders left to reduce")
+            break
+        status = reduce_kept_file(reducer, compilers, exec_dirs, file, ref, reduce_timeout, override_prefix,
+                                  instrumentation, portfolio, pre_reduction_jobs, shader_budget, checkpoint_interval)
+        if journal is not None:
+            journal.record("reduced", batch=batch_nb, file=file, status=status)
+
+
+def queue_reduction(reducer, compilers, exec_dirs, queue, order, ref, reduce_timeout, override_prefix="_reduced",
+                    instrumentation=False, portfolio=None, pre_reduction_jobs=0, time_budget=0, batch_time_budget=0,
+                    checkpoint_interval=60):
+    # Reduces the shaders of the queue in priority order until it is empty (see reduction_queue.py)
+    batch_start = time.time()
+    # Timeout shaders are only attempted again when the reducer is forced to reduce them
+    states = ["pending"]
+    if reduce_timeout:
+        states.append("skipped-timeout")
+    # Partially reduced shaders go back to the queue but are not resumed by the same worker
+    interrupted = []
+    while True:
+        shader_budget = get_shader_budget(time_budget, batch_start, batch_time_budget)
+        if shader_budget < 0:
+            print("Batch time budget reached, " + str(queue.get_counts()["pending"]) + " shaders left to reduce")
+            break
+        file = queue.claim(order, states, interrupted)
+        if file is None:
+            print("Reduction queue empty")
+            break
+        # The heartbeat tells the workers of other hosts that the shader is still being reduced
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=queue.keep_alive, args=(file, stop_event), daemon=True)
+        heartbeat.start()
+        try:
+            status = reduce_kept_file(reducer, compilers, exec_dirs, file, ref, reduce_timeout, override_prefix,
+                                      instrumentation, portfolio, pre_reduction_jobs, shader_budget,
+                                      checkpoint_interval)
+        finally:
+            stop_event.set()
+            heartbeat.join()
+        if status == "partial":
+            interrupted.append(file)
+            status = "pending"
+        queue.complete(file, status)
+
+
+def get_shader_budget(time_budget, batch_start, batch_time_budget):
+    # The budget of a shader is bounded by the remaining budget of the batch (-1 once the batch budget is exhausted)
+    if batch_time_budget > 0:
+        remaining = int(batch_start + batch_time_budget - time.time())
+        if remaining <= 0:
+            return -1
+        if time_budget == 0 or remaining < time_budget:
+            return remaining
+    return time_budget
+
+
+def reduce_kept_file(reducer, compilers, exec_dirs, file, ref, reduce_timeout, override_prefix, instrumentation,
+                     portfolio, pre_reduction_jobs, time_budget, checkpoint_interval):
+    # Returns the status of the reduction (see run_reduction)
+    # copy file to exec_dir
+    file_radix = file.split(".")[0]
+    print("Reduction of " + exec_dirs.keptshaderdir + file)
+    shutil.copy(exec_dirs.keptshaderdir + file, "original_test.shadertrap")
+    # run reduction
+    if portfolio is not None:
+        status = "failed"
+        if portfolio.run(exec_dirs, "original_test.shadertrap", "test_reduced.shadertrap", ref,
+                         reduce_timeout) is not None:
+            status = "reduced"
+        common.clean_files(os.getcwd(), ["original_test.shadertrap"])
+    else:
+        status = run_reduction(reducer, compilers, exec_dirs, "original_test.shadertrap", "test_reduced.shadertrap",
+                               ref, reduce_timeout, log_file=reducer.name + "_" + file_radix + ".log",
+                               instrumentation=instrumentation, pre_reduction_jobs=pre_reduction_jobs,
+                               partial_output=exec_dirs.keptshaderdir + file_radix + PARTIAL_SUFFIX,
+                               time_budget=time_budget, checkpoint_interval=checkpoint_interval)
+
+    # copy back
+    if os.path.isfile(exec_dirs.execdir + "test_reduced.shadertrap"):
+        shutil.copy("test_reduced.shadertrap",
+                    exec_dirs.keptshaderdir + file_radix + override_prefix + ".shadertrap")
+        # clean exec_dir
+        common.clean_files(os.getcwd(), ["test_reduced.shadertrap"])
+    return status
 
 
 def run_reduction(reducer, compilers, exec_dirs, test_input, test_output, ref, reduce_timeout, log_file="",
-                  instrumentation=True):
+                  instrumentation=True, pre_reduction_jobs=0, partial_output="", time_budget=0,
+                  checkpoint_interval=60):
+    # The best interesting shader is periodically saved in partial_output (if given) and the reduction restarts from
+    # it when it exists, the reducer is stopped after time_budget seconds (if not 0)
+    # Returns reduced, partial (time budget reached), failed (reducer failure or no error) or skipped-timeout
+    global reducer_process
+    start_timestamp = time.time()
+    source_hash = get_file_hash(test_input)
+    if partial_output != "" and os.path.isfile(partial_output):
+        if get_partial_source(partial_output) == source_hash:
+            print("Resuming the reduction from " + partial_output)
+            test_input = partial_output
+        else:
+            print("Ignoring " + partial_output + " produced by the reduction of another shader")
+            remove_partial(partial_output)
     # Builds the interestingness test
     print("Building the interesting shell script")
     # Builds a temp harness
@@ -97,8 +299,13 @@ def run_reduction(reducer, compilers, exec_dirs, test_input, test_output, ref, r
     instrumentation_filename = log_file
     if instrumentation and instrumentation_filename == "":
         instrumentation_filename = reducer.name + "_" + test_input + ".log"
+    checkpoint_file = ""
+    if partial_output != "":
+        checkpoint_file = CHECKPOINT_FILE
+        common.clean_files(os.getcwd(), [checkpoint_file])
     error_code_str = create_shell_test.build_shell_test(compilers, exec_dirs, "temp.shadertrap", reducer.input_file, ref
-                                                        , reducer.interesting_test, instrumentation_filename)
+                                                        , reducer.interesting_test, instrumentation_filename,
+                                                        checkpoint_file)
     error_code = int(error_code_str[:4])
     common.clean_files(exec_dirs.execdir, common.find_buffer_file(exec_dirs.execdir))
     # Copy the input file to the output (prevents to destroy the harness through execution)
@@ -110,15 +317,43 @@ def run_reduction(reducer, compilers, exec_dirs, test_input, test_output, ref, r
             json_file.close()
         # extract the shader code using the splitter and name it as input_file
         splitter_merger.split(test_input, reducer.input_file)
+        # remove the obviously irrelevant code before the reducer
+        if pre_reduction_jobs > 0:
+            pre_reduction.pre_reduce(exec_dirs, "temp.shadertrap", reducer.input_file, reducer.interesting_test,
+                                     pre_reduction_jobs)
+            if partial_output != "":
+                shutil.copy(reducer.input_file, checkpoint_file)
+                save_checkpoint(test_input, checkpoint_file, partial_output, source_hash)
 
         # perform the reduction using the reduction launch command
         ref_timestamp = time.time()
         print("Setup finished, beginning reduction")
         cmd = shlex.split(reducer.command)
-        process = subprocess.run(cmd, stdout=sys.stdout, stderr=sys.stdout, universal_newlines=True,
-                                 cwd=exec_dirs.execdir)
+        process = subprocess.Popen(cmd, stdout=sys.stdout, stderr=sys.stdout, universal_newlines=True,
+                                   cwd=exec_dirs.execdir, start_new_session=True)
+        reducer_process = process
+        budget_reached = False
+        while process.poll() is None:
+            wait_time = checkpoint_interval
+            if time_budget > 0:
+                wait_time = max(0, min(wait_time, start_timestamp + time_budget - time.time()))
+            try:
+                process.wait(timeout=wait_time)
+            except subprocess.TimeoutExpired:
+                if partial_output != "":
+                    save_checkpoint(test_input, checkpoint_file, partial_output, source_hash)
+                if time_budget > 0 and time.time() - start_timestamp >= time_budget:
+                    budget_reached = True
+                    kill_reducer()
+        reducer_process = None
         # after execution concatenate back the result
-        if os.path.isfile(reducer.output_files):
+        if budget_reached:
+            print("Time budget reached, stopping the reduction")
+            if partial_output != "" and os.path.isfile(partial_output):
+                print("Best partial result kept in " + partial_output)
+            common.clean_files(os.getcwd(), [test_output])
+            status = "partial"
+        elif os.path.isfile(reducer.output_files):
             splitter_merger.merge(test_output, reducer.output_files)
             end_timestamp = time.time()
             delta = timedelta(seconds=end_timestamp - ref_timestamp)
@@ -127,23 +362,77 @@ def run_reduction(reducer, compilers, exec_dirs, test_input, test_output, ref, r
                 f = open(instrumentation_filename, "a")
                 f.write("\n" + str(delta))
                 f.close()
+            # The reduction is complete, the partial result is not needed anymore
+            if partial_output != "":
+                remove_partial(partial_output)
+            status = "reduced"
         else:
             print("Reduction failed for shader")
             common.clean_files(os.getcwd(), ["test_reduced.shadertrap"])
+            status = "failed"
     elif error_code >= 2000:
         print("Skipping test-case reduction for timeout shader")
         common.clean_files(os.getcwd(), ["test_reduced.shadertrap"])
+        status = "skipped-timeout"
     else:
         print("No error on the current shader")
         common.clean_files(os.getcwd(), ["test_reduced.shadertrap"])
+        status = "failed"
 
     # Cleans the current repository
     common.clean_files(os.getcwd(),
-                       ["temp.shadertrap", reducer.input_file, reducer.output_files, reducer.interesting_test])
+                       ["temp.shadertrap", reducer.input_file, reducer.output_files, reducer.interesting_test,
+                        CHECKPOINT_FILE])
     residues = common.find_test_file(os.getcwd())
-    if test_output in residues:
-        residues.remove(test_output)
+    for kept_file in [test_output, partial_output, partial_output + PARTIAL_SOURCE_SUFFIX]:
+        if kept_file in residues:
+            residues.remove(kept_file)
     common.clean_files(os.getcwd(), residues)
+    return status
+
+
+def get_file_hash(file):
+    f = open(file, "rb")
+    file_hash = hashlib.sha256(f.read()).hexdigest()
+    f.close()
+    return file_hash
+
+
+def get_partial_source(partial_output):
+    # Hash of the shader reduced into the partial result, None if unknown
+    if not os.path.isfile(partial_output + PARTIAL_SOURCE_SUFFIX):
+        return None
+    f = open(partial_output + PARTIAL_SOURCE_SUFFIX, "r")
+    source_hash = f.read().strip()
+    f.close()
+    return source_hash
+
+
+def remove_partial(partial_output):
+    common.clean_files(os.getcwd(), [partial_output, partial_output + PARTIAL_SOURCE_SUFFIX])
+
+
+def kill_reducer():
+    if reducer_process is not None and reducer_process.poll() is None:
+        try:
+            os.killpg(reducer_process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        reducer_process.wait()
+
+
+def save_checkpoint(test_input, checkpoint_file, partial_output, source_hash):
+    # Merge the best interesting shader found by the interestingness test in a copy of the harness
+    if not os.path.isfile(checkpoint_file):
+        return
+    shutil.copy(test_input, partial_output + ".tmp")
+    splitter_merger.merge(partial_output + ".tmp", checkpoint_file)
+    # The source is written first: a partial result without source is never resumed
+    g = open(partial_output + PARTIAL_SOURCE_SUFFIX, "w")
+    g.write(source_hash + "\n")
+    g.close()
+    os.replace(partial_output + ".tmp", partial_output)
+    print("Checkpoint saved in " + partial_output)
 
 
 if __name__ == '__main__':
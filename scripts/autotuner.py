@@ -0,0 +1,154 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import time
+
+# Autotuning of the continuous mode: after each batch, the throughput (executed shaders per hour over the whole batch)
+# is compared to the best one seen so far. A move (more or fewer jobs, larger or smaller batches) which improves it is
+# repeated, otherwise the best settings are restored and the next move is tried. The best throughput slowly decays so
+# that the settings keep following the load of the host. Jobs are reduced first when the available memory falls below
+# the reserve and never increased when the load average already exceeds the number of cpus. Each decision is appended
+# to a json-lines log with the measures it is based on.
+
+MOVES = [("jobs", 1), ("jobs", -1), ("shadercount", 1), ("shadercount", -1)]
+# Growth factor of the batch size for a shadercount move
+BATCH_FACTOR = 1.5
+# Decay of the best throughput per batch
+DECAY = 0.95
+
+
+def get_memory_info():
+    # Returns (available, total) memory in MB, None if /proc/meminfo is not readable
+    values = {}
+    try:
+        f = open("/proc/meminfo", "r")
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                values[fields[0].rstrip(":")] = int(fields[1]) // 1024
+        f.close()
+    except OSError:
+        return None
+    if "MemTotal" not in values:
+        return None
+    return values.get("MemAvailable", values.get("MemFree", 0)), values["MemTotal"]
+
+
+def get_load():
+    try:
+        return os.getloadavg()[0]
+    except OSError:
+        return 0.0
+
+
+class Autotuner:
+    def __init__(self, shadercount, jobs, min_shadercount=10, max_shadercount=1000, max_jobs=None,
+                 min_free_memory=1024, log_file="autotune_log.jsonl"):
+        self.shadercount = shadercount
+        self.jobs = jobs
+        self.min_shadercount = min_shadercount
+        self.max_shadercount = max_shadercount
+        self.max_jobs = max_jobs if max_jobs is not None else os.cpu_count()
+        self.min_free_memory = min_free_memory
+        self.log_file = log_file
+        self.best = None
+        self.move = 0
+        self.phase_start = None
+        self.phase_durations = {}
+
+    def start_phase(self, phase):
+        self.end_phase()
+        self.phase_start = (phase, time.time())
+
+    def end_phase(self):
+        if self.phase_start is not None:
+            phase, start = self.phase_start
+            self.phase_durations[phase] = self.phase_durations.get(phase, 0.0) + time.time() - start
+            self.phase_start = None
+
+    def apply_move(self, move):
+        # Returns False when the move is not possible from the current settings
+        name, direction = move
+        if name == "jobs":
+            jobs = min(self.max_jobs, max(1, self.jobs + direction))
+            if jobs == self.jobs:
+                return False
+            self.jobs = jobs
+        else:
+            factor = BATCH_FACTOR if direction > 0 else 1 / BATCH_FACTOR
+            shadercount = min(self.max_shadercount, max(self.min_shadercount, int(round(self.shadercount * factor))))
+            if shadercount == self.shadercount:
+                return False
+            self.shadercount = shadercount
+        return True
+
+    def next_move(self, load):
+        # Tries the moves in turn from the current one, more jobs are skipped on a saturated host
+        for offset in range(len(MOVES)):
+            move = MOVES[(self.move + offset) % len(MOVES)]
+            if move == ("jobs", 1) and load >= os.cpu_count():
+                continue
+            if self.apply_move(move):
+                self.move = (self.move + offset) % len(MOVES)
+                return move[0] + (" +" if move[1] > 0 else " -")
+        return "keep"
+
+    def end_batch(self, batch_nb, executed):
+        # Measures the batch and adjusts shadercount and jobs for the next one
+        self.end_phase()
+        duration = sum(self.phase_durations.values())
+        throughput = 0.0
+        if duration > 0:
+            throughput = executed * 3600 / duration
+        load = get_load()
+        memory = get_memory_info()
+        entry = {"time": time.time(), "batch": batch_nb, "shadercount": self.shadercount, "jobs": self.jobs,
+                 "executed": executed, "phases": {phase: round(value, 3) for phase, value
+                                                  in self.phase_durations.items()},
+                 "throughput": round(throughput, 1), "load": load}
+        if memory is not None:
+            entry["memory_available"] = memory[0]
+            entry["memory_total"] = memory[1]
+        if self.best is not None:
+            self.best["throughput"] *= DECAY
+        if memory is not None and memory[0] < self.min_free_memory and self.jobs > 1:
+            reason = "available memory " + str(memory[0]) + "MB below the reserve of " + str(self.min_free_memory) \
+                     + "MB"
+            self.jobs -= 1
+            self.best = None
+            decision = "jobs -"
+        elif self.best is None or throughput > self.best["throughput"]:
+            reason = "throughput " + str(round(throughput, 1)) + " shaders/h is the best so far"
+            self.best = {"throughput": throughput, "shadercount": self.shadercount, "jobs": self.jobs}
+            # Keep moving in the same direction
+            decision = self.next_move(load)
+        else:
+            reason = "throughput " + str(round(throughput, 1)) + " shaders/h below the best " \
+                     + str(round(self.best["throughput"], 1)) + " shaders/h"
+            self.shadercount = self.best["shadercount"]
+            self.jobs = self.best["jobs"]
+            self.move = (self.move + 1) % len(MOVES)
+            decision = "restore, " + self.next_move(load)
+        entry["decision"] = decision
+        entry["reason"] = reason
+        entry["next_shadercount"] = self.shadercount
+        entry["next_jobs"] = self.jobs
+        g = open(self.log_file, "a")
+        g.write(json.dumps(entry) + "\n")
+        g.close()
+        print("Autotuning: " + reason + ", " + decision + " (next batch: " + str(self.shadercount)
+              + " shaders, " + str(self.jobs) + " jobs)")
+        self.phase_durations = {}
@@ -0,0 +1,107 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+
+
+# Write-ahead journal of the continuous batches, one json record per line:
+# batch_start: a new batch of count shaders is started
+# generated: the shaders of the batch have been generated from seed
+# prevalidated: the shaders rejected by the GLSL front end have been removed from the batch
+# executed: a shader has been executed on the given compilers (with their status)
+# kept: a divergent shader has been moved to the kept directories
+# compared: the buffers of the batch have been compared and the divergent shaders kept
+# reduced: the reduction of a kept shader ended with status (see automate_reducer.run_reduction), partial reductions
+#          are resumed
+# batch_end: the batch is processed, the journal is compacted to this single record
+
+
+def get_compiler_status(result):
+    if result == "no_crash" or result == "timeout":
+        return result
+    if result is False:
+        return "missing"
+    return "crash"
+
+
+class BatchJournal:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def record(self, event, **values):
+        values["event"] = event
+        with self.lock:
+            journal_file = open(self.filename, "a")
+            journal_file.write(json.dumps(values) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+            journal_file.close()
+
+    def record_execution(self, batch_nb, shader_id, compilers, results):
+        self.record("executed", batch=batch_nb, shader=shader_id,
+                    compilers={compiler.name: get_compiler_status(result)
+                               for compiler, result in zip(compilers, results)})
+
+    def end_batch(self, batch_nb, seed, count):
+        # Compact the journal: only the last finished batch is needed to continue the seed sequence
+        tmp_filename = self.filename + ".tmp"
+        journal_file = open(tmp_filename, "w")
+        journal_file.write(json.dumps({"event": "batch_end", "batch": batch_nb, "seed": seed, "count": count}) + "\n")
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+        journal_file.close()
+        os.replace(tmp_filename, self.filename)
+
+    def load_state(self):
+        # Replays the journal and returns the state of the last batch (None without journal)
+        if not os.path.isfile(self.filename):
+            return None
+        state = None
+        journal_file = open(self.filename, "r")
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partially written record from an interrupted run
+                continue
+            if record["event"] == "batch_start":
+                state = {"batch": record["batch"], "requested_seed": record["seed"], "seed": -1,
+                         "count": record["count"], "generated": False, "prevalidated": False, "executed": {},
+                         "partially_kept": [], "kept": None, "reduced": [], "ended": False}
+            elif record["event"] == "batch_end":
+                state = {"batch": record["batch"], "requested_seed": record["seed"], "seed": record["seed"],
+                         "count": record["count"], "generated": True, "prevalidated": True, "executed": {},
+                         "partially_kept": [], "kept": [], "reduced": [], "ended": True}
+            elif state is None:
+                continue
+            elif record["event"] == "generated":
+                state["generated"] = True
+                state["seed"] = record["seed"]
+            elif record["event"] == "prevalidated":
+                state["prevalidated"] = True
+            elif record["event"] == "executed":
+                # A shader can be executed in several steps (resumed batch or tiered execution)
+                state["executed"].setdefault(record["shader"], {}).update(record["compilers"])
+            elif record["event"] == "kept":
+                state["partially_kept"].append(record["file"])
+            elif record["event"] == "compared":
+                state["kept"] = record["kept"]
+            elif record["event"] == "reduced" and record.get("status") != "partial":
+                # Partially reduced shaders are reduced again (from their partial result) when resuming
+                state["reduced"].append(record["file"])
+        journal_file.close()
+        return state
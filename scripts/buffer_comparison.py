@@ -0,0 +1,287 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import hashlib
+import re
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Numeric comparison of the concatenated buffers: the buffers are decoded as typed arrays following the
+# CREATE_BUFFER / DUMP_BUFFER_* commands of the harness and compared element-wise, float values being equal up to a
+# ULP and / or relative tolerance. Buffers which cannot be decoded (e.g. timeouts) are only compared byte-wise.
+
+BUFFER_TYPES = {"byte": "u1", "int": "<i4", "uint": "<u4", "float": "<f4"}
+TOKEN_REGEX = re.compile(r'"[^"]*"|\S+')
+# Patterns matching a given number of whitespace separated values of a text dump, per number of values
+VALUES_REGEXES = {}
+# Number of differing indices reported per buffer in the summary
+REPORTED_INDICES = 5
+
+
+class BufferSegment:
+    def __init__(self, name, dump_file, fields, binary, text_format):
+        self.name = name
+        self.dump_file = dump_file
+        # List of (type, count)
+        self.fields = fields
+        self.binary = binary
+        # List of (type, count) or ("literal", string) or ("skip", bytes) for text dumps
+        self.text_format = text_format
+
+
+def require_numpy():
+    if numpy is None:
+        exit("The numeric buffer comparison requires numpy, please install it (pip install numpy)")
+
+
+def parse_init_fields(tokens):
+    fields = []
+    for token in tokens:
+        if token in BUFFER_TYPES:
+            fields.append([token, 0])
+        elif fields:
+            fields[-1][1] += 1
+    return [(field_type, count) for field_type, count in fields]
+
+
+def parse_text_format(tokens):
+    text_format = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i].startswith('"'):
+            text_format.append(("literal", tokens[i][1:-1]))
+            i += 1
+        elif tokens[i] == "SKIP_BYTES" and i + 1 < len(tokens):
+            text_format.append(("skip", int(tokens[i + 1])))
+            i += 2
+        elif tokens[i] in BUFFER_TYPES and i + 1 < len(tokens):
+            text_format.append((tokens[i], int(tokens[i + 1])))
+            i += 2
+        else:
+            i += 1
+    return text_format
+
+
+def parse_buffer_layout(harness_file):
+    # Returns the dumped buffers in the order of their concatenation (sorted dump file names)
+    f = open(harness_file, "r")
+    lines = f.readlines()
+    f.close()
+    buffer_fields = {}
+    segments = []
+    in_shader = False
+    for line in lines:
+        if in_shader:
+            in_shader = line.strip() != "END"
+            continue
+        tokens = TOKEN_REGEX.findall(line)
+        if len(tokens) == 0:
+            continue
+        if tokens[0] == "DECLARE_SHADER":
+            in_shader = True
+        elif tokens[0] == "CREATE_BUFFER" and len(tokens) > 1:
+            if "INIT_VALUES" in tokens:
+                buffer_fields[tokens[1]] = parse_init_fields(tokens[tokens.index("INIT_VALUES") + 1:])
+            elif "SIZE_BYTES" in tokens:
+                buffer_fields[tokens[1]] = [("byte", int(tokens[tokens.index("SIZE_BYTES") + 1]))]
+        elif tokens[0] in ["DUMP_BUFFER_BINARY", "DUMP_BUFFER_TEXT"] and "BUFFER" in tokens and "FILE" in tokens:
+            name = tokens[tokens.index("BUFFER") + 1]
+            dump_file = tokens[tokens.index("FILE") + 1].strip('"')
+            text_format = []
+            if "FORMAT" in tokens:
+                text_format = parse_text_format(tokens[tokens.index("FORMAT") + 1:])
+            segments.append(BufferSegment(name, dump_file, buffer_fields.get(name, []),
+                                          tokens[0] == "DUMP_BUFFER_BINARY", text_format))
+    return sorted(segments, key=lambda segment: segment.dump_file)
+
+
+def get_values_regex(count):
+    if count not in VALUES_REGEXES:
+        VALUES_REGEXES[count] = re.compile(rb"\s*\S+(?:\s+\S+){" + str(count - 1).encode() + rb"}")
+    return VALUES_REGEXES[count]
+
+
+def parse_text_values(data, position, field_type, count):
+    # The values are converted at once from the span of the dump holding them
+    dtype = BUFFER_TYPES[field_type].replace("<", "")
+    if count == 0:
+        return numpy.array([], dtype=dtype), position
+    match = get_values_regex(count).match(data, position)
+    if match is None:
+        return None, position
+    try:
+        return numpy.array(data[position:match.end()].split(), dtype=dtype), match.end()
+    except (ValueError, OverflowError):
+        return None, position
+
+
+def decode_buffers(data, layout):
+    # Returns the list of arrays per buffer segment (None if the data does not follow the layout)
+    decoded = []
+    offset = 0
+    for segment in layout:
+        arrays = []
+        if segment.binary:
+            for field_type, count in segment.fields:
+                dtype = numpy.dtype(BUFFER_TYPES[field_type])
+                if offset + count * dtype.itemsize > len(data):
+                    return None
+                arrays.append((field_type, numpy.frombuffer(data, dtype, count, offset)))
+                offset += count * dtype.itemsize
+        else:
+            # Text dumps are parsed in place in the concatenated bytes
+            for element, value in segment.text_format:
+                if element == "literal":
+                    literal = value.encode("utf-8")
+                    if not data.startswith(literal, offset):
+                        return None
+                    offset += len(literal)
+                elif element in BUFFER_TYPES:
+                    values, offset = parse_text_values(data, offset, element, value)
+                    if values is None:
+                        return None
+                    arrays.append((element, values))
+            # Trailing new line written after each text dump
+            while offset < len(data) and data[offset] in b"\r\n":
+                offset += 1
+        decoded.append(arrays)
+    if offset != len(data):
+        return None
+    return decoded
+
+
+def float_differences(a, b, max_ulp, rel_tolerance):
+    # Returns the indices of the different values, the tolerance is only evaluated on the values which are not equal
+    indices = numpy.flatnonzero(~((a == b) | (numpy.isnan(a) & numpy.isnan(b))))
+    if len(indices) == 0:
+        return indices
+    a = a[indices]
+    b = b[indices]
+    different = numpy.ones(len(indices), dtype=bool)
+    if max_ulp > 0:
+        # Map the float bit patterns to ordered integers to get the distance in ULP
+        ia = a.view(numpy.int32).astype(numpy.int64)
+        ib = b.view(numpy.int32).astype(numpy.int64)
+        ia = numpy.where(ia < 0, -(ia & 0x7fffffff), ia)
+        ib = numpy.where(ib < 0, -(ib & 0x7fffffff), ib)
+        different &= numpy.abs(ia - ib) > max_ulp
+    if rel_tolerance > 0:
+        with numpy.errstate(invalid="ignore", over="ignore"):
+            different &= ~(numpy.abs(a - b) <= rel_tolerance * numpy.maximum(numpy.abs(a), numpy.abs(b)))
+    return indices[different]
+
+
+def find_differences(decoded_a, decoded_b, max_ulp, rel_tolerance):
+    # Returns a list of (segment index, differing indices) for the segments which differ
+    differences = []
+    for segment_id, (arrays_a, arrays_b) in enumerate(zip(decoded_a, decoded_b)):
+        indices = []
+        base_index = 0
+        for (field_type, a), (_, b) in zip(arrays_a, arrays_b):
+            if len(a) != len(b):
+                indices.append(numpy.arange(base_index, base_index + max(len(a), len(b))))
+            elif field_type == "float":
+                indices.append(float_differences(a, b, max_ulp, rel_tolerance) + base_index)
+            else:
+                indices.append(numpy.flatnonzero(a != b) + base_index)
+            base_index += max(len(a), len(b))
+        if indices:
+            indices = numpy.concatenate(indices)
+            if len(indices) != 0:
+                differences.append((segment_id, indices))
+    return differences
+
+
+def get_element(decoded, segment_id, index):
+    for _, array in decoded[segment_id]:
+        if index < len(array):
+            return array[index]
+        index -= len(array)
+    return None
+
+
+def numeric_comparison_helper(files, layout, max_ulp=0, rel_tolerance=0.0, names=None):
+    # Same groups as common.comparison_helper with a tolerance on the float values, and a diff summary per buffer
+    require_numpy()
+    if names is None:
+        names = files
+    # Identical files are grouped from their digest without any decoding
+    digests = {}
+    contents = {}
+    for file in files:
+        f = open(file, "rb")
+        contents[file] = f.read()
+        f.close()
+        digests.setdefault(hashlib.sha1(contents[file]).digest(), []).append(file)
+    groups = list(digests.values())
+    decoded = {}
+    for group in groups:
+        decoded[group[0]] = decode_buffers(contents[group[0]], layout)
+    # Merge groups whose values only differ within the tolerance
+    merged_groups = []
+    for group in groups:
+        for merged_group in merged_groups:
+            reference = decoded[merged_group[0]]
+            current = decoded[group[0]]
+            if reference is not None and current is not None \
+                    and not find_differences(reference, current, max_ulp, rel_tolerance):
+                merged_group += group
+                break
+        else:
+            merged_groups.append(list(group))
+
+    summary = []
+    reference_file = merged_groups[0][0]
+    for group in merged_groups[1:]:
+        header = names[files.index(group[0])] + " vs " + names[files.index(reference_file)] + ": "
+        if decoded[reference_file] is None or decoded[group[0]] is None:
+            summary.append(header + "buffers cannot be decoded with the harness layout, byte comparison only")
+            continue
+        for segment_id, indices in find_differences(decoded[reference_file], decoded[group[0]], max_ulp,
+                                                    rel_tolerance):
+            details = []
+            for index in indices[:REPORTED_INDICES]:
+                details.append("[" + str(index) + "] " + str(get_element(decoded[group[0]], segment_id, index))
+                               + " != " + str(get_element(decoded[reference_file], segment_id, index)))
+            summary.append(header + layout[segment_id].name + " " + str(len(indices)) + " different values: "
+                           + ", ".join(details) + (", ..." if len(indices) > REPORTED_INDICES else ""))
+    return merged_groups, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare buffer outputs numerically following the buffer layout "
+                                                 "of a shadertrap harness")
+    parser.add_argument("--harness", dest="harness", required=True,
+                        help="shadertrap harness declaring the dumped buffers")
+    parser.add_argument("--buffers", dest="buffers", nargs="+", required=True,
+                        help="concatenated buffer outputs to compare")
+    parser.add_argument("--float-ulp", dest="ulp", default=0, type=int,
+                        help="maximum distance in ULP between two equal float values")
+    parser.add_argument("--float-rel-tolerance", dest="rel", default=0.0, type=float,
+                        help="maximum relative difference between two equal float values")
+    ns = parser.parse_args(sys.argv[1:])
+    groups, summary = numeric_comparison_helper(ns.buffers, parse_buffer_layout(ns.harness), ns.ulp, ns.rel)
+    for group in groups:
+        print(", ".join(group) + " agree")
+    for line in summary:
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,10 +14,14 @@
 
 import filecmp
 import shutil
-import subprocess
 from subprocess import run
 from xml.dom import minidom
 import os
+import time
+
+import executors
+import result_cache
+import shader_cache
 
 
 class DirSettings:
@@ -45,13 +49,28 @@ def load_dir_settings(filename):
 class Compiler:
     available_syscode = 1
 
-    def __init__(self,name, renderer, type, ldpath, vkfilename, othervens):
+    def __init__(self,name, renderer, type, ldpath, vkfilename, othervens, executor="local", executor_command="",
+                 executor_record_dir="", max_slots=1, cost=1.0, family="", variant="", shader_cache="",
+                 shader_cache_dir="", shader_cache_size=""):
         self.name = name
         self.renderer = renderer
         self.type = type
         self.ldpath = ldpath
         self.vkfilename = vkfilename
         self.otherenvs = othervens
+        self.executor = executor
+        self.executor_command = executor_command
+        self.executor_record_dir = executor_record_dir
+        # Scheduling: maximum number of concurrent executions and relative cost of an execution
+        self.max_slots = max_slots
+        self.cost = cost
+        # Variants of a driver (see load_compilers_settings) share the execution slots of their family
+        self.family = family if family != "" else name
+        self.variant = variant
+        # Policy of the on-disk shader caches of the driver (see shader_cache.py)
+        self.shader_cache = shader_cache
+        self.shader_cache_dir = shader_cache_dir
+        self.shader_cache_size = shader_cache_size
         self.compilercode = Compiler.available_syscode
         Compiler.available_syscode += 1
 
@@ -59,6 +78,28 @@ class Compiler:
         return self.name
 
 
+def get_optional_setting(node, tag, default=""):
+    elements = node.getElementsByTagName(tag)
+    if elements.length == 0 or len(elements[0].childNodes) == 0 or elements[0].childNodes[0].data.strip() == "":
+        return default
+    return elements[0].childNodes[0].data.strip()
+
+
+def get_list_setting(node, tag, prefix):
+    # Values of the PREFIX0, PREFIX1, ... elements of the first tag element, in index order (the length element
+    # written by the installer is not needed)
+    elements = node.getElementsByTagName(tag)
+    if elements.length == 0:
+        return []
+    values = {}
+    for child in elements[0].childNodes:
+        if child.nodeType == child.ELEMENT_NODE and child.tagName.startswith(prefix) \
+                and child.tagName[len(prefix):].isdigit() and len(child.childNodes) > 0 \
+                and child.childNodes[0].data.strip() != "":
+            values[int(child.tagName[len(prefix):])] = child.childNodes[0].data.strip()
+    return [values[i] for i in sorted(values)]
+
+
 def load_compilers_settings(filename):
     xmldoc = minidom.parse(filename)
     compilers = []
@@ -69,13 +110,32 @@ def load_compilers_settings(filename):
         type = compiler.getElementsByTagName("type")[0].childNodes[0].data
         ldpath = compiler.getElementsByTagName("LD_LIBRARY_PATH")[0].childNodes[0].data
         vkfilename = compiler.getElementsByTagName("VK_ICD_FILENAMES")[0].childNodes[0].data
-        otherenvs = []
-        otherenvsxml = compiler.getElementsByTagName("otherenvs")
-        if otherenvsxml.length != 1:
-            nb_envs  = int(otherenvsxml.getElementByTagName("length")[0].childNodes[0].data)
-            for i in range(nb_envs):
-                otherenvs.append(otherenvsxml.getElementByTagName("env_"+str(i))[0].childNodes[0].data)
-        compilers.append(Compiler(name, renderer, type, ldpath, vkfilename, otherenvs))
+        otherenvs = get_list_setting(compiler, "otherenvs", "env_")
+        executor = get_optional_setting(compiler, "executor", "local")
+        executor_command = get_optional_setting(compiler, "executor_command")
+        executor_record_dir = get_optional_setting(compiler, "executor_record_dir")
+        max_slots = int(get_optional_setting(compiler, "max_slots", "1"))
+        cost = float(get_optional_setting(compiler, "cost", "1"))
+        cache_policy = get_optional_setting(compiler, "shader_cache")
+        if cache_policy != "" and cache_policy not in shader_cache.POLICIES:
+            exit("Unknown shader cache policy " + cache_policy + " for " + name + ", use one of "
+                 + ", ".join(shader_cache.POLICIES))
+        cache_dir = get_optional_setting(compiler, "shader_cache_dir")
+        cache_size = get_optional_setting(compiler, "shader_cache_size")
+        # A compiler with variants is expanded into one compiler per variant named FAMILY-VARIANT, the environment
+        # variables of the variant being added to the ones of the compiler
+        variants = compiler.getElementsByTagName("variant")
+        if variants.length == 0:
+            compilers.append(Compiler(name, renderer, type, ldpath, vkfilename, otherenvs, executor,
+                                      executor_command, executor_record_dir, max_slots, cost, "", "", cache_policy,
+                                      cache_dir, cache_size))
+        for variant in variants:
+            variant_name = variant.getElementsByTagName("name")[0].childNodes[0].data.strip()
+            variant_envs = [env.childNodes[0].data.strip() for env in variant.getElementsByTagName("env")
+                            if len(env.childNodes) > 0 and env.childNodes[0].data.strip() != ""]
+            compilers.append(Compiler(name + "-" + variant_name, renderer, type, ldpath, vkfilename,
+                                      otherenvs + variant_envs, executor, executor_command, executor_record_dir,
+                                      max_slots, cost, name, variant_name, cache_policy, cache_dir, cache_size))
     return compilers
 
 class Reducer:
@@ -97,12 +157,7 @@ def load_reducers_settings(filename):
         interesting_test = reducer.getElementsByTagName("interesting")[0].childNodes[0].data
         input_name = reducer.getElementsByTagName("input_file")[0].childNodes[0].data
         output_name = reducer.getElementsByTagName("output_file")[0].childNodes[0].data
-        extra_files = []
-        extra_file_xml = reducer.getElementsByTagName("extra_files")
-        if extra_file_xml.length != 1:
-            nb_files = int(extra_file_xml.getElementByTagName("length")[0].childNodes[0].data)
-            for i in range(nb_files):
-                extra_files.append(extra_file_xml.getElementByTagName("file_"+str(i)[0]).childNodes[0].data)
+        extra_files = get_list_setting(reducer, "extra_files", "file_")
         reducers.append(Reducer(name, reducer_command, interesting_test, input_name, output_name, extra_files))
     return reducers
 
@@ -119,17 +174,15 @@ def concatenate_files(outputname, files):
 
 
 def clean_files(dir, files_list):
-    ref = os.getcwd()
-    os.chdir(dir)
     for file in files_list:
-        if os.path.isfile(file):
-            os.remove(file)
-    os.chdir(ref)
+        if os.path.isfile(os.path.join(dir, file)):
+            os.remove(os.path.join(dir, file))
 
 
 def build_env_from_compiler(compiler):
     cmd_env = []
-    if compiler.ldpath != " " or compiler.otherenvs != [] or compiler.type == "angle":
+    cache_envs = shader_cache.get_cache_envs(compiler)
+    if compiler.ldpath != " " or compiler.otherenvs != [] or compiler.type == "angle" or cache_envs != []:
         cmd_env.append("env")
         if compiler.ldpath != " ":
             cmd_env.append("LD_LIBRARY_PATH="+compiler.ldpath)
@@ -137,6 +190,8 @@ def build_env_from_compiler(compiler):
             cmd_env.append("ANGLE_DEFAULT_PLATFORM=vulkan")
         if compiler.vkfilename != " ":
             cmd_env.append("VK_ICD_FILENAMES="+compiler.vkfilename)
+        # The variables of the cache policy can be overridden by otherenvs
+        cmd_env += cache_envs
         for otherenv in compiler.otherenvs:
             cmd_env.append(otherenv)
     return cmd_env
@@ -177,6 +232,145 @@ def comparison_helper(files):
     return comparison_values
 
 
+def classify_divergence(groups, compilers_dict):
+    # Sort a divergence (groups of agreeing compiler names) as one compiler name, angle or more_than_two
+    if len(groups) == 2:
+        if len(groups[0]) == 1:
+            return groups[0][0]
+        if len(groups[1]) == 1:
+            return groups[1][0]
+        # Try if we are in the angle case
+        if (all(compilers_dict[name].type == "angle" for name in groups[0])
+            and all(compilers_dict[name].type == "independent" for name in groups[1])) \
+                or (all(compilers_dict[name].type == "angle" for name in groups[1])
+                    and all(compilers_dict[name].type == "independent" for name in groups[0])):
+            return "angle"
+    # Everything else where a cause is difficult to identify
+    return "more_than_two"
+
+
+def get_divergent_compilers(groups):
+    # Compilers outside the largest group of agreeing compilers
+    return [name for group in sorted(groups, key=len)[:-1] for name in group]
+
+
+def postprocess_shader(graphicsfuzz, shadername, output_name="tmp.shadertrap"):
+    # Call postprocessing using java
+    cmd = ["mvn", "-f", graphicsfuzz+"pom.xml","-pl","glslsmith", "-q","-e", "exec:java","-Dexec.mainClass=com.graphicsfuzz.PostProcessingHandler" ]
+    args = r'-Dexec.args=--src '+ str(shadername) + r' --dest ' + output_name
+    cmd += [args]
+    process_return = run(cmd, capture_output=True, text=True)
+    if "SUCCESS!" not in process_return.stdout:
+        print(process_return.stderr)
+        print(process_return.stdout)
+        print(shadername + " cannot be parsed for post-processing")
+        return False
+    return True
+
+
+def run_shadertrap(compiler, shadertrap, shader_to_compile, shadername, verbose=False, timeout=10, cwd=None):
+    # Execute the shader with the executor backend of the compiler
+    start = time.time()
+    process_return = executors.get_executor(compiler, shadertrap).execute(shader_to_compile, timeout, cwd=cwd)
+    shader_cache.record_execution(compiler, time.time() - start)
+    # Catch timeouts (post-processed shaders should not contain any)
+    if process_return.timed_out:
+        print("Timeout reached on shader "+ shadername + " with " + compiler.name)
+        return "timeout"
+    # Detect error at compilation time
+    if not process_return.success:
+        if verbose:
+            print("Execution error on shader " + shadername + " with " + compiler.name)
+        message = ""
+        # Output compilation error messages
+        if process_return.stdout != "":
+            print(process_return.stdout)
+            message += process_return.stdout
+        if process_return.stderr != "":
+            print(process_return.stderr)
+            message += process_return.stderr
+        return message
+    return "no_crash"
+
+
+def collect_buffers(file_result, buffer_files, move_dir="./", cwd=None):
+    if cwd is None:
+        cwd = os.getcwd()
+    # Concatenate files to a single output per test (sorted to get the same order whatever the directory listing)
+    concatenate_files(os.path.join(cwd, file_result), [os.path.join(cwd, file) for file in sorted(buffer_files)])
+    # Move the results to the dumpbuffer
+    if move_dir != './':
+        shutil.move(os.path.join(cwd, file_result), move_dir)
+    clean_files(cwd, buffer_files)
+
+
+def write_timeout_buffer(file_result, move_dir="./", cwd=None):
+    if cwd is None:
+        cwd = os.getcwd()
+    # Write timeout as buffer value to permit direct buffer comparison in reduction for example etc...
+    with open(os.path.join(cwd, file_result), 'w') as file:
+        file.write("timeout")
+    # Perform the copy of the file if the final buffer is saved somewhere else
+    if move_dir != './':
+        shutil.move(os.path.join(cwd, file_result), move_dir)
+
+
+def get_result_file(file_result, move_dir="./", cwd=None):
+    if move_dir != './':
+        return os.path.join(move_dir, file_result)
+    if cwd is None:
+        cwd = os.getcwd()
+    return os.path.join(cwd, file_result)
+
+
+def restore_cached_result(compiler, shadertrap, shader_to_compile, shadername, file_result, move_dir="./",
+                          verbose=False, cwd=None):
+    # Write the cached buffer of an already executed shader (see result_cache.py), returns None if not cached
+    cached = result_cache.lookup(compiler, shadertrap, shader_to_compile)
+    if cached is None:
+        return None
+    if cwd is None:
+        cwd = os.getcwd()
+    result, buffer = cached
+    if verbose and result != "no_crash":
+        print("Execution error on shader " + shadername + " with " + compiler.name + " (cached)")
+    with open(os.path.join(cwd, file_result), 'wb') as file:
+        file.write(buffer)
+    if move_dir != './':
+        shutil.move(os.path.join(cwd, file_result), move_dir)
+    return result
+
+
+def execute_compiler(compiler, shadertrap, shader_to_compile, shadername, file_result, move_dir="./", verbose=False,
+                     timeout=10, excluded_buffers=None, cwd=None):
+    # The buffers are dumped in cwd (by default the current directory)
+    if cwd is None:
+        cwd = os.getcwd()
+    result = restore_cached_result(compiler, shadertrap, shader_to_compile, shadername, file_result, move_dir,
+                                   verbose, cwd)
+    if result is not None:
+        return result
+    result = run_shadertrap(compiler, shadertrap, shader_to_compile, shadername, verbose, timeout, cwd)
+    if result == "timeout":
+        write_timeout_buffer(file_result, move_dir, cwd)
+        return result
+    buffer_files = find_buffer_file(cwd)
+    # Exclude combined files from concatenation and removal
+    if excluded_buffers is None:
+        excluded_buffers = []
+    buffer_files = [file for file in buffer_files if file not in excluded_buffers and file != file_result]
+    collect_buffers(file_result, buffer_files, move_dir, cwd)
+    result_cache.store(compiler, shadertrap, shader_to_compile, result, get_result_file(file_result, move_dir, cwd))
+    return result
+
+
+def get_buffer_name(compiler, output_seed=""):
+    # Specify the buffers output name (if a seed is given it is added in the name)
+    if output_seed != "":
+        return "buffer_" + compiler.name + "_" + str(output_seed) + ".txt"
+    return "buffer_" + compiler.name + ".txt"
+
+
 def execute_compilation(compilers, graphicsfuzz, shadertrap, shadername, output_seed = "", move_dir = "./", verbose = False, timeout=10, postprocessing=True):
     no_compile_errors = []
     # Verify that the file exists
@@ -184,71 +378,17 @@ def execute_compilation(compilers, graphicsfuzz, shadertrap, shadername, output_
         print(shadername + " not found")
         return [False for _ in compilers]
     resulting_buffers = []
-    # Call postprocessing using java
     shader_to_compile = shadername
     if postprocessing:
-        cmd = ["mvn", "-f", graphicsfuzz+"pom.xml","-pl","glslsmith", "-q","-e", "exec:java","-Dexec.mainClass=com.graphicsfuzz.PostProcessingHandler" ]
-        args = r'-Dexec.args=--src '+ str(shadername) + r' --dest tmp.shadertrap'
-        cmd += [args]
-        process_return = run(cmd, capture_output=True, text=True)
-        #print(process_return.stderr)
-        #print(process_return.stdout)
-        if "SUCCESS!" not in process_return.stdout:
-            print(process_return.stderr)
-            print(process_return.stdout)
-            print(shadername + " cannot be parsed for post-processing")
+        if not postprocess_shader(graphicsfuzz, shadername):
             return [False for _ in compilers]
         shader_to_compile = "tmp.shadertrap"
 
     # Call the compilation for each available compiler
     for compiler in compilers:
-        # Specify the buffers output name (if a seed is given it is added in the name)
-        if output_seed != "":
-            file_result = "buffer_"+compiler.name + "_" + str(output_seed) + ".txt"
-        else:
-            file_result = "buffer_"+compiler.name + ".txt"
+        file_result = get_buffer_name(compiler, output_seed)
         # Register the resulting buffer as a result instead of a temporary buffer (ie: buffer_1 etc...)
         resulting_buffers.append(file_result)
-        # Execute the correct cmd command
-        cmd_ending = [shadertrap,"--require-vendor-renderer-substring",compiler.renderer, shader_to_compile]
-        cmd = build_env_from_compiler(compiler) + cmd_ending
-        try:
-            process_return = run(cmd, capture_output=True, text=True, timeout=timeout)
-        # Catch timeouts (post-processed shaders should not contain any)
-        except subprocess.TimeoutExpired:
-            print("Timeout reached on shader "+ shadername + " with " + compiler.name)
-            no_compile_errors.append(("timeout"))
-            # Write timeout as buffer value to permit direct buffer comparison in reduction for example etc...
-            file = open(file_result,'w')
-            file.write("timeout")
-            # Perform the copy of the file if the final buffer is saved somewhere else
-            if move_dir != './':
-                shutil.move(file_result, move_dir)
-                clean_files(os.getcwd(),file_result)
-            continue
-        # Detect error at compilation time
-        if 'SUCCESS!' not in process_return.stderr:
-            if verbose:
-                print("Execution error on shader " + shadername + " with " + compiler.name)
-            message = ""
-            # Output compilation error messages
-            if process_return.stdout != "":
-                print(process_return.stdout)
-                message += process_return.stdout
-            if process_return.stderr != "":
-                print(process_return.stderr)
-                message += process_return.stderr
-            no_compile_errors.append(message)
-        else:
-            no_compile_errors.append("no_crash")
-        # Concatenate files to a single output per test
-        buffer_files = find_buffer_file(os.getcwd())
-        # Exclude combined files from concatenation and removal
-        buffer_files = [file for file in buffer_files if file not in resulting_buffers]
-        concatenate_files(file_result, buffer_files)
-        # Move the results to the dumpbuffer
-        if move_dir != './':
-            shutil.move(file_result, move_dir)
-            buffer_files.append(file_result)
-        clean_files(os.getcwd(), buffer_files)
+        no_compile_errors.append(execute_compiler(compiler, shadertrap, shader_to_compile, shadername, file_result,
+                                                  move_dir, verbose, timeout, resulting_buffers))
     return no_compile_errors
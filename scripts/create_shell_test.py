@@ -45,7 +45,8 @@ def main():
     build_shell_test(compilers_dict, exec_dirs, ns.harness, ns.shader, ns.ref, ns.shellname)
 
 
-def build_shell_test(compilers_dict, exec_dirs, harness_name, shader_name, ref, shell_file, instrumentation=""):
+def build_shell_test(compilers_dict, exec_dirs, harness_name, shader_name, ref, shell_file, instrumentation="",
+                     checkpoint_file=""):
     # Collect error code from the reduction process
     try:
         reduction_helper.execute_reduction(compilers_dict, exec_dirs, harness_name, ref, True, True)
@@ -80,7 +81,14 @@ def build_shell_test(compilers_dict, exec_dirs, harness_name, shader_name, ref,
         shell.write("ERROR_CODE_IN_FILE=$( (python3 ${ROOT}/scripts/reduction_helper.py --config-file ${"
                     "ROOT}/scripts/config.xml --shader-name ${ROOT}/" + harness_name + " 2>&1 > /dev/null) || true)\n")
         shell.write("echo $ERROR_CODE_IN_FILE\n")
-        shell.write("if [ \"$ERROR_CODE_IN_FILE\" == \"$ERROR_CODE\" ]\nthen\n    exit 0\nelse\n    exit 1\nfi\n")
+        shell.write("if [ \"$ERROR_CODE_IN_FILE\" == \"$ERROR_CODE\" ]\nthen\n")
+        if checkpoint_file != "":
+            # Keep the smallest interesting shader seen so far to checkpoint the reduction
+            checkpoint = "\"${ROOT}/" + checkpoint_file + "\""
+            shell.write("    if [ ! -f " + checkpoint + " ] || [ $(wc -c < \"$SHADER\") -lt $(wc -c < " + checkpoint
+                        + ") ]\n    then\n        cp \"$SHADER\" " + checkpoint[:-1] + ".tmp\"\n        mv "
+                        + checkpoint[:-1] + ".tmp\" " + checkpoint + "\n    fi\n")
+        shell.write("    exit 0\nelse\n    exit 1\nfi\n")
         shell.close()
         return str(error_code)
     else:
@@ -0,0 +1,452 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import base64
+import json
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+import common
+import exec_glslsmith
+import regression
+
+
+# The protocol sends a single json line per connection and reads back a single json line as answer:
+# claim: get a seed range lease (or done when the seed space is exhausted)
+# renew: extend a lease while the worker is still processing its range
+# result: send back a divergent shader with its buffers and its classification
+# complete: release a lease once the whole range has been processed
+# The workers retry their messages with an exponential backoff, the results are idempotent.
+
+# Longest delay in seconds between two attempts to reach the coordinator
+MAX_RETRY_DELAY = 60
+# State of the coordinator (next seed, leases, pending and completed ranges) in the execution directory, reloaded when
+# the coordinator restarts so that no range is handed out twice
+STATE_FILE = "distributed_state.json"
+
+
+class Coordinator:
+    def __init__(self, exec_dirs, compiler_names, seed_start, range_size, lease_timeout, seed_end=-1, state_file=""):
+        self.exec_dirs = exec_dirs
+        # Only the buffers of the configured compilers are accepted
+        self.compiler_names = set(compiler_names)
+        self.seed_start = seed_start
+        self.next_seed = seed_start
+        self.range_size = range_size
+        self.lease_timeout = lease_timeout
+        self.seed_end = seed_end
+        self.next_lease = 1
+        self.leases = {}
+        self.pending_ranges = []
+        self.completed_ranges = []
+        self.kept_shaders = 0
+        self.lock = threading.Lock()
+        self.state_file = state_file
+        if state_file != "" and os.path.isfile(state_file):
+            self.load_state()
+
+    def load_state(self):
+        f = open(self.state_file, "r")
+        state = json.load(f)
+        f.close()
+        if state["seed_start"] != self.seed_start:
+            exit("The state file " + self.state_file + " starts at seed " + str(state["seed_start"])
+                 + ", please remove it or use another --state-file to start at seed " + str(self.seed_start))
+        self.next_seed = state["next_seed"]
+        self.next_lease = state["next_lease"]
+        # The workers of the leases get a new lease timeout to renew them
+        self.leases = {int(lease_id): (seed, count, worker, time.time() + self.lease_timeout)
+                       for lease_id, (seed, count, worker) in state["leases"].items()}
+        self.pending_ranges = [tuple(seed_range) for seed_range in state["pending_ranges"]]
+        self.completed_ranges = [tuple(seed_range) for seed_range in state["completed_ranges"]]
+        self.kept_shaders = state["kept_shaders"]
+        print("State loaded from " + self.state_file + ": next seed " + str(self.next_seed) + ", "
+              + str(len(self.leases)) + " leases, " + str(len(self.completed_ranges)) + " ranges completed")
+
+    def save_state(self):
+        # To call with the lock held
+        if self.state_file == "":
+            return
+        state = {"seed_start": self.seed_start, "next_seed": self.next_seed, "next_lease": self.next_lease,
+                 "leases": {str(lease_id): [seed, count, worker]
+                            for lease_id, (seed, count, worker, _) in self.leases.items()},
+                 "pending_ranges": self.pending_ranges, "completed_ranges": self.completed_ranges,
+                 "kept_shaders": self.kept_shaders}
+        g = open(self.state_file + ".tmp", "w")
+        json.dump(state, g)
+        g.close()
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def reclaim_expired_leases(self):
+        now = time.time()
+        for lease_id in list(self.leases.keys()):
+            seed, count, worker, deadline = self.leases[lease_id]
+            if deadline < now:
+                print("Lease " + str(lease_id) + " of " + worker + " expired, seeds " + str(seed) + " to "
+                      + str(seed + count - 1) + " will be reassigned")
+                del self.leases[lease_id]
+                self.pending_ranges.append((seed, count))
+
+    def claim(self, worker):
+        with self.lock:
+            self.reclaim_expired_leases()
+            # Reassigned ranges are served first
+            if self.pending_ranges:
+                seed, count = self.pending_ranges.pop(0)
+            elif self.seed_end == -1 or self.next_seed < self.seed_end:
+                seed = self.next_seed
+                count = self.range_size
+                if self.seed_end != -1:
+                    count = min(count, self.seed_end - seed)
+                self.next_seed += count
+            else:
+                return {"done": len(self.leases) == 0}
+            lease_id = self.next_lease
+            self.next_lease += 1
+            self.leases[lease_id] = (seed, count, worker, time.time() + self.lease_timeout)
+            self.save_state()
+            print("Lease " + str(lease_id) + " given to " + worker + ": seeds " + str(seed) + " to "
+                  + str(seed + count - 1))
+            return {"lease": lease_id, "seed": seed, "count": count, "lease_timeout": self.lease_timeout}
+
+    def renew(self, lease_id):
+        with self.lock:
+            if lease_id not in self.leases:
+                return {"ok": False}
+            seed, count, worker, _ = self.leases[lease_id]
+            self.leases[lease_id] = (seed, count, worker, time.time() + self.lease_timeout)
+            return {"ok": True}
+
+    def store_result(self, message):
+        # The file names are built from the message: the seed must be a number and the buffers of known compilers
+        try:
+            seed = str(int(message["seed"]))
+        except (TypeError, ValueError):
+            return {"error": "invalid seed " + repr(message["seed"])}
+        if int(seed) < 0 or not isinstance(message["shader"], str) or not isinstance(message["buffers"], dict):
+            return {"error": "invalid result for seed " + seed}
+        unknown_compilers = [name for name in message["buffers"] if name not in self.compiler_names]
+        if unknown_compilers:
+            return {"error": "unknown compilers " + ", ".join(repr(name) for name in unknown_compilers)}
+        with self.lock:
+            # Results sent again by a retry or by the new owner of a reassigned range are not counted twice
+            if not os.path.isfile(self.exec_dirs.keptshaderdir + seed + ".shadertrap"):
+                self.kept_shaders += 1
+            shader_file = open(self.exec_dirs.keptshaderdir + seed + ".shadertrap", "w")
+            shader_file.write(message["shader"])
+            shader_file.close()
+            for compiler_name, buffer in message["buffers"].items():
+                buffer_file = open(self.exec_dirs.keptbufferdir + compiler_name + "_" + seed + ".txt", "wb")
+                buffer_file.write(base64.b64decode(buffer))
+                buffer_file.close()
+            regression.record_kept_shader(self.exec_dirs.keptshaderdir, seed + ".shadertrap", message["classification"])
+            self.save_state()
+        print("Different results across implementations for shader " + seed + " (" + message["classification"]
+              + ", from " + message["worker"] + ")")
+        return {"ok": True}
+
+    def complete(self, lease_id):
+        with self.lock:
+            if lease_id not in self.leases:
+                # The range has already been given to another worker
+                return {"ok": False}
+            seed, count, _, _ = self.leases[lease_id]
+            del self.leases[lease_id]
+            self.completed_ranges.append((seed, count))
+            self.save_state()
+            return {"ok": True}
+
+    def handle(self, message):
+        if message["type"] == "claim":
+            return self.claim(message["worker"])
+        if message["type"] == "renew":
+            return self.renew(message["lease"])
+        if message["type"] == "result":
+            return self.store_result(message)
+        if message["type"] == "complete":
+            return self.complete(message["lease"])
+        return {"error": "unknown message type " + str(message["type"])}
+
+    def handle_safely(self, message):
+        try:
+            return self.handle(message)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            return {"error": "malformed message: " + repr(e)}
+
+
+class CoordinatorRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = None
+        answer = self.server.coordinator.handle_safely(message)
+        self.wfile.write((json.dumps(answer) + "\n").encode())
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, coordinator):
+        socketserver.ThreadingTCPServer.__init__(self, address, CoordinatorRequestHandler)
+        self.coordinator = coordinator
+
+
+def send_message(address, message, timeout=60):
+    host, port = address.rsplit(":", 1)
+    with socket.create_connection((host, int(port)), timeout=timeout) as connection:
+        connection.sendall((json.dumps(message) + "\n").encode())
+        answer = b""
+        while not answer.endswith(b"\n"):
+            data = connection.recv(65536)
+            if not data:
+                break
+            answer += data
+    return json.loads(answer)
+
+
+def send_message_retry(address, message):
+    # Retries until the coordinator answers, waiting twice longer after each failure
+    delay = 1
+    while True:
+        try:
+            return send_message(address, message)
+        except (OSError, ValueError) as e:
+            print("Coordinator unreachable (" + message["type"] + "): " + str(e) + ", retrying in " + str(delay)
+                  + "s")
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_RETRY_DELAY)
+
+
+def renew_lease(address, lease_id, period, stop_event, lost_event):
+    # Sets lost_event when the coordinator has reassigned the range
+    while not stop_event.wait(period):
+        try:
+            answer = send_message(address, {"type": "renew", "lease": lease_id})
+        except (OSError, ValueError) as e:
+            print("Lease renewal failed: " + str(e))
+            continue
+        if not answer.get("ok"):
+            print("Lease " + str(lease_id) + " has been reassigned")
+            lost_event.set()
+            return
+
+
+def run_worker(address, compilers, exec_dirs, shadercount, packsize=1, validate_compilers=True):
+    worker_name = socket.gethostname() + ":" + str(os.getpid())
+    compilers_dict = {}
+    for compiler in compilers:
+        compilers_dict[compiler.name] = compiler
+    if validate_compilers and not exec_glslsmith.validate_compilers_setup(compilers, exec_dirs):
+        return
+    while True:
+        lease = send_message_retry(address, {"type": "claim", "worker": worker_name})
+        if "lease" not in lease:
+            if lease.get("done"):
+                print("No more seeds to process")
+                return
+            # Remaining ranges are leased to other workers and might be reassigned
+            time.sleep(10)
+            continue
+        # Keep the lease alive while the range is processed
+        stop_event = threading.Event()
+        lost_event = threading.Event()
+        renewer = threading.Thread(target=renew_lease,
+                                   args=(address, lease["lease"], max(1, lease["lease_timeout"] // 3), stop_event,
+                                         lost_event),
+                                   daemon=True)
+        renewer.start()
+        try:
+            processed = process_range(address, worker_name, compilers, compilers_dict, exec_dirs, lease["seed"],
+                                      lease["count"], shadercount, packsize, lost_event)
+        finally:
+            stop_event.set()
+            renewer.join()
+        seeds = "Seeds " + str(lease["seed"]) + " to " + str(lease["seed"] + lease["count"] - 1)
+        if not processed:
+            print(seeds + " left to their new worker")
+        elif send_message_retry(address, {"type": "complete", "lease": lease["lease"]}).get("ok"):
+            print(seeds + " processed")
+        else:
+            print(seeds + " processed after their reassignment")
+
+
+def process_range(address, worker_name, compilers, compilers_dict, exec_dirs, seed_start, count, shadercount,
+                  packsize, lost_event=None):
+    # The range is processed by batches of at most shadercount shaders, returns False if it was stopped because its
+    # lease has been lost
+    for batch_seed in range(seed_start, seed_start + count, shadercount):
+        if lost_event is not None and lost_event.is_set():
+            return False
+        batch_count = min(shadercount, seed_start + count - batch_seed)
+        seed = exec_glslsmith.generate_shaders(exec_dirs, batch_count, batch_seed)
+        if seed is None:
+            raise RuntimeError("Generation failed for seed " + str(batch_seed))
+        exec_glslsmith.execute_batch(compilers, exec_dirs, batch_count, packsize)
+        for i, groups in exec_glslsmith.compare_batch(compilers, exec_dirs, batch_count):
+            shader_file = open(exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap", "r")
+            buffers = {}
+            for compiler in compilers:
+                buffer_file = open(exec_glslsmith.get_batch_buffer(exec_dirs, compiler, i), "rb")
+                buffers[compiler.name] = base64.b64encode(buffer_file.read()).decode()
+                buffer_file.close()
+            classification = common.classify_divergence(groups, compilers_dict)
+            answer = send_message_retry(address, {"type": "result", "worker": worker_name, "seed": seed + i,
+                                                  "shader": shader_file.read(), "buffers": buffers,
+                                                  "classification": classification})
+            if "error" in answer:
+                print("Shader " + str(seed + i) + " rejected by the coordinator: " + answer["error"])
+            shader_file.close()
+        common.clean_files(exec_dirs.dumpbufferdir, common.find_buffer_file(exec_dirs.dumpbufferdir))
+    return True
+
+
+def start_server(address, coordinator):
+    server = CoordinatorServer(address, coordinator)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def self_test():
+    # Runs a coordinator on localhost and plays the workers through the protocol, returns True if every check passed
+    base_dir = tempfile.mkdtemp() + "/"
+    exec_dirs = common.DirSettings("", base_dir, "", "", "", base_dir + "keptbuffers/", base_dir + "keptshaders/")
+    os.makedirs(exec_dirs.keptbufferdir)
+    os.makedirs(exec_dirs.keptshaderdir)
+    coordinator = Coordinator(exec_dirs, ["compiler"], 0, 2, 2, 4, base_dir + STATE_FILE)
+    server = start_server(("localhost", 0), coordinator)
+    port = server.server_address[1]
+    address = "localhost:" + str(port)
+    failures = []
+
+    def check(name, condition):
+        print(("ok: " if condition else "FAILED: ") + name)
+        if not condition:
+            failures.append(name)
+
+    first = send_message_retry(address, {"type": "claim", "worker": "first"})
+    second = send_message_retry(address, {"type": "claim", "worker": "second"})
+    check("seed ranges handed out", [first.get("seed"), second.get("seed")] == [0, 2])
+    # The first lease is renewed, the second one expires and is reassigned
+    stop_event = threading.Event()
+    lost_event = threading.Event()
+    renewer = threading.Thread(target=renew_lease, args=(address, first["lease"], 0.5, stop_event, lost_event),
+                               daemon=True)
+    renewer.start()
+    time.sleep(3)
+    third = send_message_retry(address, {"type": "claim", "worker": "third"})
+    check("expired range reassigned", third.get("seed") == 2)
+    check("renewed lease kept", not lost_event.is_set())
+    second_lost = threading.Event()
+    second_renewer = threading.Thread(target=renew_lease,
+                                      args=(address, second["lease"], 0.1, threading.Event(), second_lost),
+                                      daemon=True)
+    second_renewer.start()
+    second_renewer.join(5)
+    check("renewal of a reassigned lease rejected", second_lost.is_set())
+    stop_event.set()
+    renewer.join()
+    check("range completed", send_message_retry(address, {"type": "complete", "lease": first["lease"]}).get("ok"))
+    check("reassigned range not completed by its previous worker",
+          not send_message_retry(address, {"type": "complete", "lease": second["lease"]}).get("ok"))
+    # A result sent while the coordinator restarts is delivered once it listens again
+    result = {"type": "result", "worker": "third", "seed": 2, "shader": "shader", "classification": "test",
+              "buffers": {"compiler": base64.b64encode(b"buffer").decode()}}
+    server.shutdown()
+    server.server_close()
+    answers = []
+    sender = threading.Thread(target=lambda: answers.append(send_message_retry(address, result)), daemon=True)
+    sender.start()
+    time.sleep(1.5)
+    server = start_server(("localhost", port), coordinator)
+    sender.join(10)
+    check("result retried across a coordinator restart",
+          answers == [{"ok": True}] and os.path.isfile(exec_dirs.keptbufferdir + "compiler_2.txt"))
+    send_message_retry(address, result)
+    check("result sent twice kept once", coordinator.kept_shaders == 1)
+    forged_seed = dict(result, seed="../../forged")
+    forged_buffer = dict(result, buffers={"../forged": result["buffers"]["compiler"]})
+    check("results with a forged seed or compiler rejected",
+          "error" in send_message_retry(address, forged_seed) and "error" in send_message_retry(address, forged_buffer)
+          and sorted(os.listdir(exec_dirs.keptbufferdir)) == ["compiler_2.txt"]
+          and not os.path.exists(base_dir + "forged"))
+    check("reassigned range completed", send_message_retry(address, {"type": "complete",
+                                                                     "lease": third["lease"]}).get("ok"))
+    check("seed space exhausted", send_message_retry(address, {"type": "claim", "worker": "first"}) == {"done": True})
+    # A restarted coordinator continues the seed sequence of its state file
+    restarted = Coordinator(exec_dirs, ["compiler"], 0, 2, 2, 6, base_dir + STATE_FILE)
+    check("state reloaded after a restart", restarted.completed_ranges == [(0, 2), (2, 2)]
+          and restarted.kept_shaders == 1 and restarted.claim("first").get("seed") == 4)
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(base_dir)
+    return len(failures) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Coordinate exec_glslsmith workers (see exec_glslsmith --worker) "
+                                                 "by handing out seed ranges over TCP")
+    parser.add_argument("--host", dest="host", default="127.0.0.1",
+                        help="Address to listen on, e.g. 0.0.0.0 for the workers of other hosts (by default: "
+                             "127.0.0.1)")
+    parser.add_argument("--port", dest="port", default=8765, type=int, help="Port to listen on (by default: 8765)")
+    parser.add_argument("--seed-start", dest="seed_start", default=0, type=int,
+                        help="First seed handed out to the workers")
+    parser.add_argument("--seed-end", dest="seed_end", default=-1, type=int,
+                        help="Stop handing out ranges at this seed (by default: never)")
+    parser.add_argument("--range-size", dest="range_size", default=500, type=int,
+                        help="Number of seeds per lease")
+    parser.add_argument("--lease-timeout", dest="lease_timeout", default=600, type=int,
+                        help="Seconds without renewal after which a range is reassigned to another worker")
+    parser.add_argument('--config-file', dest='config', default="config.xml",
+                        help="specify a different configuration file from the default")
+    parser.add_argument("--state-file", dest="state_file", default=STATE_FILE,
+                        help="File keeping the state of the coordinator across restarts (by default: " + STATE_FILE
+                             + " in the execution directory)")
+    parser.add_argument("--self-test", dest="self_test", action="store_true",
+                        help="Check the lease, retry and result handling with a coordinator and workers on localhost")
+    ns = parser.parse_args(sys.argv[1:])
+    if ns.self_test:
+        if not self_test():
+            exit("Self-test failed")
+        return
+    exec_dirs = common.load_dir_settings(ns.config)
+    os.chdir(exec_dirs.execdir)
+    compiler_names = [compiler.name for compiler in common.load_compilers_settings(ns.config)]
+    coordinator = Coordinator(exec_dirs, compiler_names, ns.seed_start, ns.range_size, ns.lease_timeout,
+                              ns.seed_end, ns.state_file)
+    server = CoordinatorServer((ns.host, ns.port), coordinator)
+    print("Coordinator listening on " + ns.host + ":" + str(ns.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(str(len(coordinator.completed_ranges)) + " ranges completed, " + str(coordinator.kept_shaders)
+              + " shaders kept")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import copy
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+import reduction_helper
+import regression
+import result_cache
+
+
+# Finds the first driver build of an ordered list (oldest first) which reproduces the error code of a shader.
+# The tested compiler of the config file is pointed to each build (LD_LIBRARY_PATH set to the build directory and
+# VK_ICD_FILENAMES to the manifest of the same name in the build directory if it exists) while the other compilers
+# serve as references. Several builds are probed at once: each round splits the remaining range in jobs + 1 parts.
+
+def get_build_compiler(compiler, build_dir, build_index):
+    # Each build gets its own compiler name so that its results are cached separately
+    build_compiler = copy.copy(compiler)
+    build_compiler.name = compiler.name + "-build" + str(build_index)
+    build_compiler.ldpath = os.path.abspath(build_dir)
+    if compiler.vkfilename.strip() != "":
+        icd_file = os.path.join(build_dir, os.path.basename(compiler.vkfilename.strip()))
+        if os.path.isfile(icd_file):
+            build_compiler.vkfilename = os.path.abspath(icd_file)
+    return build_compiler
+
+
+def probe_build(compilers, tested_compiler, exec_dirs, harness_file, builds, build_index, timeout=10):
+    # Returns the error code of the shader with the given build (see reduction_helper.py)
+    probe_compilers = [get_build_compiler(compiler, builds[build_index], build_index)
+                       if compiler.name == tested_compiler else compiler for compiler in compilers]
+    probe_dir = tempfile.mkdtemp(prefix="bisect_", dir=os.getcwd())
+    results = []
+    buffer_files = []
+    for compiler in probe_compilers:
+        file_result = common.get_buffer_name(compiler)
+        results.append(common.execute_compiler(compiler, exec_dirs.shadertrap, harness_file, harness_file,
+                                               file_result, "./", True, timeout, buffer_files, probe_dir))
+        buffer_files.append(file_result)
+    error_code = reduction_helper.classify_execution(probe_compilers, results,
+                                                     [os.path.join(probe_dir, file) for file in buffer_files])
+    shutil.rmtree(probe_dir, ignore_errors=True)
+    print("Build " + builds[build_index] + ": " + error_code[:4])
+    return error_code
+
+
+def get_probes(good, bad, jobs):
+    # Evenly spread builds strictly between the last good and the first bad builds
+    count = min(jobs, bad - good - 1)
+    return sorted(set([good + (bad - good) * (i + 1) // (count + 1) for i in range(count)]))
+
+
+def bisect_builds(compilers, tested_compiler, exec_dirs, harness_file, builds, jobs=2, timeout=10,
+                  expected_code=""):
+    # Returns (last good build index, first bad build index), the expected error code being the one of the last
+    # build by default, None if the bounds do not behave as expected
+    with ThreadPoolExecutor(max_workers=max(jobs, 2)) as pool:
+        first_code, last_code = pool.map(lambda build_index: probe_build(compilers, tested_compiler, exec_dirs,
+                                                                         harness_file, builds, build_index,
+                                                                         timeout),
+                                         [0, len(builds) - 1])
+        if expected_code == "":
+            expected_code = last_code[:4]
+        if last_code[:4] != expected_code:
+            print("The last build does not reproduce the error code " + expected_code)
+            return None
+        if first_code[:4] == expected_code:
+            print("The first build already reproduces the error code " + expected_code)
+            return None
+        good = 0
+        bad = len(builds) - 1
+        while bad - good > 1:
+            probes = get_probes(good, bad, jobs)
+            codes = list(pool.map(lambda build_index: probe_build(compilers, tested_compiler, exec_dirs,
+                                                                  harness_file, builds, build_index, timeout),
+                                  probes))
+            # Builds are assumed to be ordered: the first reproducing probe bounds the range
+            for build_index, code in zip(probes, codes):
+                if code[:4] == expected_code:
+                    bad = build_index
+                    break
+                good = build_index
+    return good, bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the first driver build reproducing the error of a shader")
+    parser.add_argument('--config-file', dest='config', default="config.xml",
+                        help="specify a different configuration file from the default")
+    parser.add_argument('--shader', dest='shader', required=True,
+                        help="Shader to execute (e.g. a kept shader), the path is relative to the execution "
+                             "directory")
+    parser.add_argument('--compiler', dest='compiler', required=True,
+                        help="Name of the compiler of the config file whose driver is replaced by the builds")
+    parser.add_argument('--builds', dest='builds', nargs="+", required=True,
+                        help="Driver build directories ordered from the oldest to the most recent")
+    parser.add_argument('--override-compilers', dest='restrict_compilers', default=[], nargs="+",
+                        help="Restrict the reference compilers to this list")
+    parser.add_argument('--error-code', dest='error_code', default="",
+                        help="Error code to look for (see reduction_helper.py, by default: the error code of the "
+                             "last build)")
+    parser.add_argument('--jobs', dest='jobs', default=3, type=int,
+                        help="Number of builds probed at once (by default: 3)")
+    parser.add_argument('--timeout', dest='timeout', default=10, type=int,
+                        help="Timeout of an execution in seconds (by default: 10)")
+    parser.add_argument('--no-postprocessing', dest='postprocessing', action='store_false',
+                        help="Deactivate post-processing")
+    parser.add_argument('--result-cache', dest='resultcache', default="result_cache.sqlite",
+                        help="Reuse the results of already executed builds from this cache file (by default: "
+                             "result_cache.sqlite in the execution directory, pass an empty string to disable)")
+    ns = parser.parse_args(sys.argv[1:])
+    exec_dirs = common.load_dir_settings(ns.config)
+    compilers = [compiler for compiler in common.load_compilers_settings(ns.config)
+                 if compiler.name == ns.compiler or not ns.restrict_compilers
+                 or compiler.name in ns.restrict_compilers]
+    if ns.compiler not in [compiler.name for compiler in compilers]:
+        exit("No compiler named " + ns.compiler + " configured")
+    if len(ns.builds) < 2:
+        exit("Please provide at least two builds")
+    # The build directories are given relative to the directory of the call, unlike the shader
+    ns.builds = [os.path.abspath(build) for build in ns.builds]
+    os.chdir(exec_dirs.execdir)
+    result_cache.open_cache(ns.resultcache)
+    harness_file = ns.shader
+    if ns.postprocessing:
+        harness_file = regression.get_postprocessed_harness(exec_dirs.graphicsfuzz, ns.shader, "postprocessed/")
+        if harness_file is None:
+            exit("Post-processing of " + ns.shader + " failed")
+    bounds = bisect_builds(compilers, ns.compiler, exec_dirs, os.path.abspath(harness_file), ns.builds, ns.jobs,
+                           ns.timeout, ns.error_code)
+    if bounds is None:
+        sys.exit(1)
+    print("Last good build: " + ns.builds[bounds[0]])
+    print("First bad build: " + ns.builds[bounds[1]])
+
+
+if __name__ == "__main__":
+    main()
@@ -13,23 +13,340 @@
 # limitations under the License.
 
 import sys
+import subprocess
 from subprocess import run
+import json
 import os
+import random
 import shutil
 import argparse
+import threading
+import time
 import common
 import automate_reducer
+import autotuner
+import batch_journal
+import buffer_comparison
+import distributed
+import executors
+import metrics
+import output_capture
+import prevalidation
+import profiler
+import regression
+import result_cache
+import scheduler
+import shader_cache
+import shader_packer
+import smoke_corpus
+import tiered_execution
+import timeout_lane
+
+
+SEED_MAP_FILE = "seed_map.json"
 
 
 def main():
-    # Parse arguments
+    ns = parse_arguments()
+    profiler.start(ns.profile, ns.profileinterval)
+    config_file = os.path.abspath(ns.config)
+    # temp value for compiler validation (not revalidating on loops)
+    validate_compilers = ns.validatecompilers
+    # Get the config files (execution directories and tested compilers)
+    exec_dirs = common.load_dir_settings(ns.config)
+    compilers = common.load_compilers_settings(ns.config)
+    reducer = get_reducer(ns.config, ns.reducer)
+    compilers_dict = {}
+    for compiler in compilers:
+        compilers_dict[compiler.name] = compiler
+    tier_compilers = get_tier_compilers(compilers, compilers_dict, ns.cheaptier)
+    if ns.prevalidate and shutil.which(ns.validator) is None:
+        exit("GLSL front end " + ns.validator + " not found, please install it or change it with --validator")
+    tolerance = get_tolerance(ns.numeric, ns.ulp, ns.rel_tolerance)
+    if ns.worker != "":
+        os.chdir(exec_dirs.execdir)
+        distributed.run_worker(ns.worker, compilers, exec_dirs, ns.shadercount, ns.packsize, validate_compilers)
+        return
+    # go to generation location
+    seed = 0
+    os.chdir(exec_dirs.execdir)
+    output_capture.log_dir = ns.logdir
+    result_cache.open_cache(ns.resultcache, ns.resultcachesize)
+    journal = batch_journal.BatchJournal(ns.journal)
+    jobs = ns.jobs
+    autotune = get_autotuner(ns)
+    metrics.start(exec_dirs, ns.metricsport, ns.metricsaddress, ns.metricsfile, ns.metricsinterval)
+    lane_process = None
+    lane_dir = os.path.join(ns.timeoutlanedir, "")
+    batch_nb, next_seed, resume_state = get_resume_point(journal, ns.resume, ns.seed)
+    # Number of batches processed by this run, the batch number continues the journal on resumes
+    processed_batches = 0
+    while processed_batches == 0 or ns.continuous or resume_state is not None:
+        shadercount = ns.shadercount
+        if autotune is not None:
+            shadercount = autotune.shadercount
+            jobs = autotune.jobs
+        executed = None
+        batch_start = time.time()
+        # Detect driver builds changed between two batches
+        result_cache.reset_fingerprints()
+        if resume_state is not None:
+            shadercount = resume_state["count"]
+        else:
+            journal.record("batch_start", batch=batch_nb, seed=next_seed, count=shadercount)
+        if resume_state is not None and resume_state["kept"] is not None:
+            # The batch has already been compared, only the reduction remains
+            seed = resume_state["seed"]
+            identified_shaders = [file for file in resume_state["kept"] if file not in resume_state["reduced"]]
+        else:
+            escalations = None
+            outcomes = {}
+            if not ns.diffonly:
+                seed = generate_batch(ns, exec_dirs, journal, autotune, batch_nb, shadercount, seed, next_seed,
+                                      resume_state)
+                if seed is None:
+                    return
+                # execute actions on generated shaders
+                if ns.syntaxonly:
+                    check_syntax(compilers[0], exec_dirs, shadercount)
+                    return
+                # Validate compilers on an empty program instance
+                if validate_compilers:
+                    if not validate_compilers_setup(compilers, exec_dirs):
+                        return
+                    validate_compilers = False
+                start_phase(autotune, "execution")
+                # A resumed batch keeps the buffers of the already executed compilers
+                if tier_compilers:
+                    escalations, outcomes = execute_tiered_batch(compilers, tier_compilers, exec_dirs, shadercount,
+                                                                 seed, ns.auditrate, ns.packsize, journal, batch_nb,
+                                                                 resume_state, jobs)
+                else:
+                    outcomes = execute_batch(compilers, exec_dirs, shadercount, ns.packsize, journal, batch_nb,
+                                             resume_state is None, jobs)
+            # Compare outputs and save buffers
+            # Check that we can compare outputs across multiple compilers
+            if len(compilers) == 1:
+                print("Impossible to compare outputs for only one compiler")
+                return
+            identified_shaders = []
+            if resume_state is not None:
+                identified_shaders += resume_state["partially_kept"]
+            start_phase(autotune, "comparison")
+            executed = count_batch_shaders(exec_dirs, shadercount)
+            metrics.inc("shaders_executed_total", executed)
+            # Only the escalated shaders have been executed on every compiler
+            divergent_shaders = compare_batch(compilers, exec_dirs, shadercount, tolerance,
+                                              None if escalations is None else sorted(escalations))
+            if escalations is not None:
+                batch_stats = tiered_execution.get_batch_stats(executed, escalations,
+                                                               [i for i, _ in divergent_shaders])
+                tiered_execution.report(batch_stats, "Batch " + str(batch_nb))
+                tiered_execution.report(tiered_execution.record_stats(ns.tierstats, batch_stats), "All batches")
+            report_variants(compilers, outcomes, divergent_shaders)
+            identified_shaders += keep_divergent_shaders(compilers, compilers_dict, exec_dirs, divergent_shaders,
+                                                         seed, ns.timeoutlane, lane_dir, journal, batch_nb)
+            journal.record("compared", batch=batch_nb, kept=identified_shaders)
+
+        # reduce with the default reducer if specified
+        if ns.reduce:
+            start_phase(autotune, "reduction")
+            automate_reducer.batch_reduction(reducer, compilers_dict, exec_dirs, identified_shaders, -1,
+                                             ns.timeout, journal=journal, batch_nb=batch_nb,
+                                             pre_reduction_jobs=ns.pre_reduction, time_budget=ns.reduction_budget,
+                                             batch_time_budget=ns.batch_reduction_budget)
+        journal.end_batch(batch_nb, seed, shadercount)
+        lane_process = update_after_batch(ns, config_file, compilers, exec_dirs, identified_shaders, lane_process,
+                                          lane_dir)
+        record_batch_metrics(ns, compilers, autotune, batch_nb, executed, batch_start, resume_state is not None)
+        output_capture.rotate_logs("batch_" + str(batch_nb) + "_" + str(seed), ns.keptlogs)
+        # Set flag for while loop and print the number of batch
+        print("Batch " + str(batch_nb) + " processed")
+        batch_nb += 1
+        processed_batches += 1
+        next_seed = seed + shadercount
+        resume_state = None
+
+
+def get_reducer(config, name):
+    reducers = common.load_reducers_settings(config)
+    if len(reducers) == 0:
+        exit("No reducer has been declared at installation, please rerun installation or edit the configuration file")
+    reducer = reducers[0]
+    if name != "":
+        reducer_found = False
+        for existing_reducer in reducers:
+            if existing_reducer.name == name:
+                reducer = existing_reducer
+                reducer_found = True
+        if not reducer_found:
+            exit("No reducer named " + str(name) + " configured")
+    return reducer
+
+
+def get_tier_compilers(compilers, compilers_dict, names):
+    # Compilers of the cheap tier (see tiered_execution.py), empty without tiered execution
+    tier_compilers = []
+    for name in names:
+        if name not in compilers_dict:
+            exit("No compiler named " + name + " configured")
+        tier_compilers.append(compilers_dict[name])
+    if tier_compilers and len(tier_compilers) == len(compilers):
+        exit("The cheap tier must leave at least one compiler to escalate to")
+    return tier_compilers
+
+
+def get_tolerance(numeric, ulp, rel_tolerance):
+    # Float tolerance of the numeric comparison, None for the byte comparison
+    if not numeric:
+        return None
+    buffer_comparison.require_numpy()
+    return ulp, rel_tolerance
+
+
+def get_autotuner(ns):
+    if not ns.autotune:
+        return None
+    return autotuner.Autotuner(ns.shadercount, ns.jobs, ns.minshadercount, ns.maxshadercount, ns.maxjobs,
+                               ns.memoryreserve, ns.autotunelog)
+
+
+def get_resume_point(journal, resume, seed):
+    # Returns the number of the first batch, its seed and the state of the batch to resume (None for a new batch)
+    batch_nb = 1
+    next_seed = seed
+    resume_state = None
+    if resume:
+        resume_state = journal.load_state()
+        if resume_state is None:
+            print("No journal to resume from, starting a new run")
+        elif resume_state["ended"]:
+            # Continue the seed sequence after the last finished batch
+            batch_nb = resume_state["batch"] + 1
+            next_seed = resume_state["seed"] + resume_state["count"]
+            resume_state = None
+            print("Batch " + str(batch_nb - 1) + " already ended, starting batch " + str(batch_nb))
+        else:
+            batch_nb = resume_state["batch"]
+            next_seed = resume_state["requested_seed"]
+            print("Resuming batch " + str(batch_nb))
+    return batch_nb, next_seed, resume_state
+
+
+def start_phase(autotune, phase):
+    if autotune is not None:
+        autotune.start_phase(phase)
+    metrics.start_phase(phase)
+
+
+def generate_batch(ns, exec_dirs, journal, autotune, batch_nb, shadercount, seed, next_seed, resume_state):
+    # Returns the seed of the batch, None if the run stops after the generation
+    if resume_state is not None and resume_state["generated"]:
+        seed = resume_state["seed"]
+    elif not ns.nogeneration:
+        # generate programs and seed reporting
+        start_phase(autotune, "generation")
+        seed = generate_shaders(exec_dirs, shadercount, next_seed, ns.generationshards)
+        if seed is None:
+            return None
+        journal.record("generated", batch=batch_nb, seed=seed)
+        metrics.inc("shaders_generated_total", shadercount)
+        if ns.generateonly:
+            return None
+
+    # Discard the shaders rejected by the front end before any driver execution
+    if ns.prevalidate and (resume_state is None or not resume_state["prevalidated"]):
+        start_phase(autotune, "prevalidation")
+        rejected, _ = prevalidation.prevalidate_batch(ns.validator, exec_dirs, range(shadercount), seed,
+                                                      os.cpu_count(), ns.quarantinedir, ns.prevalidationstats)
+        journal.record("prevalidated", batch=batch_nb, rejected=rejected)
+    return seed
+
+
+def check_syntax(compiler, exec_dirs, shadercount):
+    # Execute the program with the default implementation
+    for i in range(shadercount):
+        result = common.execute_compilation([compiler], exec_dirs.graphicsfuzz, exec_dirs.shadertrap,
+                                            exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap", verbose=True)
+        if result[0] != "no_crash":
+            print("Error on shader " + str(i))
+        else:
+            print("Shader " + str(i) + " validated")
+    # Clean the directory after usage and exit
+    buffers = common.find_buffer_file(os.getcwd())
+    common.clean_files(os.getcwd(), buffers)
+    print("Compilation of all programs done")
+
+
+def keep_divergent_shaders(compilers, compilers_dict, exec_dirs, divergent_shaders, seed, use_timeout_lane, lane_dir,
+                           journal, batch_nb):
+    # Returns the kept shaders, the shaders only differing by timeouts go to the timeout lane if it is used
+    kept_shaders = []
+    for i, groups in divergent_shaders:
+        if use_timeout_lane:
+            buffer_files = [get_batch_buffer(exec_dirs, compiler, i) for compiler in compilers]
+            timed_out = timeout_lane.get_timed_out_compilers(compilers, buffer_files)
+            if timed_out:
+                timeout_lane.divert_shader(compilers, lane_dir,
+                                           exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap", buffer_files,
+                                           seed + i, timed_out)
+                metrics.inc("timeouts_diverted_total")
+                continue
+        print("Different results across implementations for shader " + str(seed + i))
+        for name in common.get_divergent_compilers(groups):
+            metrics.inc("divergences_total", compiler=name, family=compilers_dict[name].family)
+        kept_shaders.append(keep_shader(compilers, exec_dirs, i, seed + i))
+        regression.record_kept_shader(exec_dirs.keptshaderdir, kept_shaders[-1],
+                                      regression.get_classification(groups, compilers_dict))
+        journal.record("kept", batch=batch_nb, file=kept_shaders[-1])
+    return kept_shaders
+
+
+def update_after_batch(ns, config_file, compilers, exec_dirs, identified_shaders, lane_process, lane_dir):
+    # Smoke corpus and timeout lane, returns the process of the lane
+    if ns.smokecorpus and identified_shaders:
+        corpus, _ = smoke_corpus.update_corpus(exec_dirs, compilers)
+        print("Smoke corpus updated: " + str(len(corpus)) + " shaders")
+    # The lane runs in the background until its shaders are sorted, it is restarted for the next diverted shaders
+    if ns.timeoutlane and (lane_process is None or lane_process.poll() is not None) \
+            and timeout_lane.has_pending(lane_dir):
+        lane_process = start_timeout_lane(config_file, lane_dir, ns.timeoutbudgets, ns.timeoutlanenice)
+    return lane_process
+
+
+def record_batch_metrics(ns, compilers, autotune, batch_nb, executed, batch_start, resumed):
+    metrics.end_phase()
+    metrics.inc("batches_total")
+    if executed is not None:
+        shader_cache.end_batch(compilers, batch_nb, ns.shadercachestats)
+        metrics.set_gauge("batch_shaders_per_second", round(executed / max(time.time() - batch_start, 0.001), 3))
+    # Resumed batches are only partially measured
+    if autotune is not None and not resumed and executed is not None:
+        autotune.end_batch(batch_nb, executed)
+
+
+def parse_arguments():
     parser = argparse.ArgumentParser(description="Execute GLSLsmith framework and sort results")
-    parser.add_argument('--seed', dest='seed', default=-1, help="Seed the random generator of GLSLsmith")
+    parser.add_argument('--seed', dest='seed', default=-1, type=int, help="Seed the random generator of GLSLsmith")
     parser.add_argument('--shader-count', dest='shadercount', default=50, type=int,
                         help="Specify the number of test per batch")
     parser.add_argument('--syntax-only', dest='syntaxonly', action='store_true',
                         help="Compile only the first compiler of the provided list to verify the syntax through "
                              "ShaderTrap")
+    parser.add_argument('--prevalidate', dest='prevalidate', action='store_true',
+                        help="Validate the generated compute shaders with a local GLSL front end in parallel and "
+                             "discard the invalid ones before any driver execution")
+    parser.add_argument('--validator', dest='validator', default="glslangValidator",
+                        help="Specify the front end used by --prevalidate (by default: glslangValidator)")
+    parser.add_argument('--quarantine-dir', dest='quarantinedir', default="",
+                        help="Keep the shaders rejected by --prevalidate with their rejection reason in this "
+                             "directory instead of deleting them")
+    parser.add_argument('--prevalidation-stats', dest='prevalidationstats', default="prevalidation_stats.jsonl",
+                        help="Specify the file receiving the rejection statistics of each batch (by default: "
+                             "prevalidation_stats.jsonl in the execution directory)")
+    parser.add_argument('--generation-shards', dest='generationshards', default=1, type=int,
+                        help="Split the generation of a batch into this number of concurrent generator processes with "
+                             "disjoint seed ranges (by default: 1)")
     parser.add_argument('--generate-only', dest='generateonly', action='store_true',
                         help="Only generate shaders without doing differential testing")
     parser.add_argument('--no-generation', dest='nogeneration', action='store_true',
@@ -46,132 +363,428 @@ def main():
                         help="Reduce interesting shaders at the end of a batch")
     parser.add_argument("--reducer", dest="reducer", default="glsl-reduce",
                         help="Enforce the reducer if reduction is applied, see --reduce")
+    parser.add_argument('--pre-reduction', dest="pre_reduction", default=0, type=int, nargs="?", const=os.cpu_count(),
+                        help="Remove chunks of lines of the kept shaders with a built-in delta debugging pass before "
+                             "calling the reducer, evaluating this number of candidates in parallel (by default: the "
+                             "number of cpus)")
+    parser.add_argument('--reduction-time-budget', dest="reduction_budget", default=0, type=int,
+                        help="Stop the reduction of a shader after this number of seconds, its best partial result "
+                             "being kept as SEED_partial.shadertrap (by default: no limit)")
+    parser.add_argument('--batch-reduction-budget', dest="batch_reduction_budget", default=0, type=int,
+                        help="Stop the reductions of a batch after this number of seconds (by default: no limit)")
     parser.add_argument('--reduce-timeout', dest="timeout", action="store_true",
                         help="Force the reducer to consider reduction of shaders that time out (DISCOURAGED)")
-    ns = parser.parse_args(sys.argv[1:])
-    # temp value for compiler validation (not revalidating on loops)
-    validate_compilers = ns.validatecompilers
-    # Get the config files (execution directories and tested compilers)
-    exec_dirs = common.load_dir_settings(ns.config)
-    compilers = common.load_compilers_settings(ns.config)
-    reducers = common.load_reducers_settings(ns.config)
-    if len(reducers) == 0:
-        exit("No reducer has been declared at installation, please rerun installation or edit the configuration file")
-    reducer = reducers[0]
-    if ns.reducer != "":
-        reducer_found = False
-        for existing_reducer in reducers:
-            if existing_reducer.name == ns.reducer:
-                reducer = existing_reducer
-                reducer_found = True
-        if not reducer_found:
-            exit("No reducer named " + str(ns.reducer) + " configured")
-    compilers_dict = {}
+    parser.add_argument('--pack-size', dest="packsize", default=1, type=int,
+                        help="Merge this number of shaders in a single ShaderTrap run per compiler (bisects the pack "
+                             "on crashes and timeouts)")
+    parser.add_argument('--numeric-comparison', dest="numeric", action="store_true",
+                        help="Compare the buffers as typed arrays decoded with the harness layout (requires numpy) "
+                             "and report the differing values per buffer")
+    parser.add_argument('--float-ulp', dest="ulp", default=0, type=int,
+                        help="Maximum distance in ULP between equal float values (numeric comparison only)")
+    parser.add_argument('--float-rel-tolerance', dest="rel_tolerance", default=0.0, type=float,
+                        help="Maximum relative difference between equal float values (numeric comparison only)")
+    parser.add_argument('--log-dir', dest="logdir", default="logs/",
+                        help="Directory receiving the driver outputs of each run, compressed at the end of each batch "
+                             "(by default: logs/ in the execution directory, pass an empty string to disable)")
+    parser.add_argument('--kept-logs', dest="keptlogs", default=10, type=int,
+                        help="Number of compressed batch logs to keep (by default: 10)")
+    parser.add_argument('--jobs', dest="jobs", default=1, type=int,
+                        help="Number of concurrent executions, each compiler being limited to its max_slots setting "
+                             "(by default: 1)")
+    parser.add_argument('--cheap-tier', dest="cheaptier", nargs="+", default=[],
+                        help="Execute the shaders on these compilers first and only escalate them to the other "
+                             "compilers when they crash, time out, diverge or are part of the audit sample")
+    parser.add_argument('--audit-rate', dest="auditrate", default=0.05, type=float,
+                        help="Proportion of the shaders agreeing on the cheap tier escalated anyway to estimate the "
+                             "missed bug risk (by default: 0.05)")
+    parser.add_argument('--tier-stats', dest="tierstats", default="tier_stats.json",
+                        help="Specify the file accumulating the escalation statistics of the tiered execution (by "
+                             "default: tier_stats.json)")
+    parser.add_argument('--autotune', dest="autotune", action="store_true",
+                        help="Adjust the shader count and the number of jobs after each batch to maximize the number "
+                             "of executed shaders per hour within the memory reserve, the decisions are logged in the "
+                             "autotuning log")
+    parser.add_argument('--min-shader-count', dest="minshadercount", default=10, type=int,
+                        help="Smallest batch chosen by the autotuning (by default: 10)")
+    parser.add_argument('--max-shader-count', dest="maxshadercount", default=1000, type=int,
+                        help="Largest batch chosen by the autotuning (by default: 1000)")
+    parser.add_argument('--max-jobs', dest="maxjobs", default=os.cpu_count(), type=int,
+                        help="Largest number of jobs chosen by the autotuning (by default: the number of cpus)")
+    parser.add_argument('--memory-reserve', dest="memoryreserve", default=1024, type=int,
+                        help="Available memory in MB below which the autotuning reduces the number of jobs (by "
+                             "default: 1024)")
+    parser.add_argument('--autotune-log', dest="autotunelog", default="autotune_log.jsonl",
+                        help="Specify the json-lines log of the autotuning decisions (by default: autotune_log.jsonl)")
+    parser.add_argument('--metrics-port', dest="metricsport", default=0, type=int,
+                        help="Serve the metrics of the run in the Prometheus text format on this port (/metrics)")
+    parser.add_argument('--metrics-address', dest="metricsaddress", default="127.0.0.1",
+                        help="Address the metrics server listens on (by default: 127.0.0.1)")
+    parser.add_argument('--metrics-file', dest="metricsfile", default="",
+                        help="Periodically rewrite the metrics of the run in the Prometheus text format in this file")
+    parser.add_argument('--metrics-interval', dest="metricsinterval", default=15, type=int,
+                        help="Interval in seconds between two rewrites of the metrics file (by default: 15)")
+    parser.add_argument('--timeout-lane', dest="timeoutlane", action="store_true",
+                        help="Move the shaders which only differ by timeouts to a background lane re-executing them "
+                             "with escalating budgets instead of keeping them")
+    parser.add_argument('--timeout-lane-dir', dest="timeoutlanedir", default="timeoutlane/",
+                        help="Directory of the timeout lane (by default: timeoutlane/ in the execution directory)")
+    parser.add_argument('--timeout-budgets', dest="timeoutbudgets", nargs="+", default=[30, 120, 600], type=int,
+                        help="Escalating time budgets of the timeout lane in seconds (by default: 30 120 600)")
+    parser.add_argument('--timeout-lane-nice', dest="timeoutlanenice", default=10, type=int,
+                        help="Niceness increment of the timeout lane (by default: 10)")
+    parser.add_argument('--shader-cache-stats', dest="shadercachestats", default="shader_cache_stats.jsonl",
+                        help="Specify the file receiving the execution times per compiler and shader cache policy "
+                             "after each batch (by default: shader_cache_stats.jsonl)")
+    parser.add_argument('--smoke-corpus', dest="smokecorpus", action="store_true",
+                        help="Extend the smoke corpus (smoke_corpus.txt, see smoke_corpus.py) after each batch keeping "
+                             "shaders")
+    parser.add_argument('--result-cache', dest="resultcache", default="",
+                        help="Reuse the outcome and buffers of shaders already executed with an unchanged driver "
+                             "from this cache file (e.g. result_cache.sqlite, disabled by default)")
+    parser.add_argument('--result-cache-size', dest="resultcachesize", default=1024, type=int,
+                        help="Maximum size of the result cache in MB, the least recently used results are evicted "
+                             "(by default: 1024)")
+    parser.add_argument('--journal', dest="journal", default="journal.jsonl",
+                        help="Specify the write-ahead journal of the batches (by default: journal.jsonl in the "
+                             "execution directory)")
+    parser.add_argument('--resume', dest="resume", action="store_true",
+                        help="Resume the interrupted batch recorded in the journal and continue its seed sequence")
+    parser.add_argument('--worker', dest="worker", default="",
+                        help="Run as a worker claiming seed ranges from the coordinator at HOST:PORT, only divergent "
+                             "results are sent back to the coordinator")
+    profiler.add_arguments(parser)
+    return parser.parse_args(sys.argv[1:])
+
+
+def start_timeout_lane(config_file, lane_dir, budgets, nice):
+    log_file = open("timeout_lane.log", "a")
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             "timeout_lane.py"),
+                                "--config-file", config_file, "--lane-dir", lane_dir, "--nice", str(nice),
+                                "--budgets"] + [str(budget) for budget in budgets],
+                               stdout=log_file, stderr=subprocess.STDOUT)
+    log_file.close()
+    print("Timeout lane started, logging in timeout_lane.log")
+    return process
+
+
+def get_generator_command(exec_dirs, shadercount, seed, output_directory):
+    cmd = ["mvn", "-f", exec_dirs.graphicsfuzz + "pom.xml", "-pl", "glslsmith", "-q", "-e"
+        , "exec:java", "-Dexec.mainClass=com.graphicsfuzz.GeneratorHandler"]
+
+    args = r'-Dexec.args=--shader-count ' + str(shadercount) + r' --output-directory ' + output_directory
+    if seed != -1:
+        args += r' --seed ' + str(seed)
+    cmd += [args]
+    return cmd
+
+
+def get_generated_seed(stdout, seed):
+    generated_seed = 0
+    if seed != -1:
+        generated_seed = int(seed)
+    for line in stdout.split("\n"):
+        if "Seed:" in line:
+            generated_seed = int(line.split(':')[1])
+    return generated_seed
+
+
+def generate_shaders(exec_dirs, shadercount, seed=-1, shards=1):
+    if shards > 1:
+        return generate_sharded_shaders(exec_dirs, shadercount, seed, shards)
+    cmd = get_generator_command(exec_dirs, shadercount, seed, exec_dirs.shaderoutput)
+    process_return = run(cmd, capture_output=True, text=True)
+    if ("ERROR") in process_return.stdout:
+        print("error with glslsmith, please fix them before running the script again")
+        print(process_return.stdout)
+        return None
+    for line in process_return.stdout.split("\n"):
+        if "Seed:" in line:
+            print(line)
+    generated_seed = get_generated_seed(process_return.stdout, seed)
+    write_seed_map(exec_dirs, generated_seed, [(0, shadercount)])
+
+    print("Generation of " + str(shadercount) + " shaders done")
+    return generated_seed
+
+
+def get_shard_ranges(shadercount, shards):
+    # Contiguous (start, count) ranges of shader ids, the shard of ids start..start+count-1 being generated from the
+    # seed of the batch plus start
+    bounds = [shard * shadercount // shards for shard in range(shards + 1)]
+    return [(bounds[shard], bounds[shard + 1] - bounds[shard]) for shard in range(shards)
+            if bounds[shard + 1] > bounds[shard]]
+
+
+def write_seed_map(exec_dirs, seed, shard_ranges):
+    # Seed of each generated shader and the generator call producing it (seed and index in the generated files)
+    seed_map = {}
+    for start, count in shard_ranges:
+        for index in range(count):
+            seed_map["test_" + str(start + index) + ".shadertrap"] = {"seed": seed + start + index,
+                                                                     "generator_seed": seed + start,
+                                                                     "generator_index": index}
+    g = open(exec_dirs.shaderoutput + SEED_MAP_FILE, "w")
+    json.dump(seed_map, g, indent=1, sort_keys=True)
+    g.close()
+
+
+def generate_sharded_shaders(exec_dirs, shadercount, seed, shards):
+    # The shards are generated by concurrent generator processes in their own directories, then renamed to the shader
+    # ids of the batch so that the shader test_i still corresponds to the seed of the batch plus i
+    if seed == -1:
+        # The seed of the batch is needed before the generation to split it
+        seed = random.randint(0, 2 ** 31 - 1 - shadercount)
+    shard_ranges = get_shard_ranges(shadercount, shards)
+    processes = []
+    for shard, (start, count) in enumerate(shard_ranges):
+        shard_dir = exec_dirs.shaderoutput + "shard_" + str(shard) + "/"
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        os.makedirs(shard_dir)
+        processes.append((shard_dir, start, count,
+                          subprocess.Popen(get_generator_command(exec_dirs, count, seed + start, shard_dir),
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)))
+    failed = False
+    for shard_dir, start, count, process in processes:
+        stdout, _ = process.communicate()
+        if "ERROR" in stdout:
+            print("error with glslsmith, please fix them before running the script again")
+            print(stdout)
+            failed = True
+        elif get_generated_seed(stdout, seed + start) != seed + start:
+            print("The generator ignored the seed " + str(seed + start) + " of the shard " + shard_dir)
+            failed = True
+        elif not failed:
+            for index in range(count):
+                if os.path.isfile(shard_dir + "test_" + str(index) + ".shadertrap"):
+                    os.replace(shard_dir + "test_" + str(index) + ".shadertrap",
+                               exec_dirs.shaderoutput + "test_" + str(start + index) + ".shadertrap")
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    if failed:
+        return None
+    write_seed_map(exec_dirs, seed, shard_ranges)
+    print("Seed: " + str(seed))
+    print("Generation of " + str(shadercount) + " shaders done in " + str(len(shard_ranges)) + " shards")
+    return seed
+
+
+def validate_compilers_setup(compilers, exec_dirs):
     for compiler in compilers:
-        compilers_dict[compiler.name] = compiler
-    batch_nb = 1
-    # go to generation location
-    seed = 0
-    if ns.seed != -1:
-        seed = ns.seed
-    os.chdir(exec_dirs.execdir)
-    while batch_nb == 1 or ns.continuous:
-        if not ns.diffonly:
-            if not ns.nogeneration:
-                # generate programs and seed reporting
-                cmd = ["mvn", "-f", exec_dirs.graphicsfuzz + "pom.xml", "-pl", "glslsmith", "-q", "-e"
-                    , "exec:java", "-Dexec.mainClass=com.graphicsfuzz.GeneratorHandler"]
-
-                args = r'-Dexec.args=--shader-count ' + str(
-                    ns.shadercount) + r' --output-directory ' + exec_dirs.shaderoutput
-                if ns.seed != -1:
-                    args += r' --seed ' + str(ns.seed)
-                cmd += [args]
-
-                process_return = run(cmd, capture_output=True, text=True)
-                if ("ERROR") in process_return.stdout:
-                    print("error with glslsmith, please fix them before running the script again")
-                    print(process_return.stdout)
-                    return
-                for line in process_return.stdout.split("\n"):
-                    if "Seed:" in line:
-                        print(line)
-                        seed = int(line.split(':')[1])
+        process_return = executors.get_executor(compiler, exec_dirs.shadertrap).execute("scripts/empty.shadertrap",
+                                                                                       None, ["--show-gl-info"])
+        buffers = common.find_buffer_file(os.getcwd())
+        common.clean_files(os.getcwd(), buffers)
+        if compiler.renderer not in process_return.stdout:
+            print("compiler not found or not working: " + compiler.name)
+            print(process_return.stdout)
+            print(process_return.stderr)
+            return False
+    print("compilers validated")
+    return True
 
-                print("Generation of " + str(ns.shadercount) + " shaders done")
-                if ns.generateonly:
-                    return
 
-            # execute actions on generated shaders
-            if ns.syntaxonly:
-                # Execute the program with the default implementation
-                for i in range(ns.shadercount):
-                    result = common.execute_compilation([compilers[0]], exec_dirs.graphicsfuzz, exec_dirs.shadertrap,
-                                                        exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap",
-                                                        verbose=True)
-                    if result[0] != "no_crash":
-                        print("Error on shader " + str(i))
-                    else:
-                        print("Shader " + str(i) + " validated")
-                # Clean the directory after usage and exit
-                buffers = common.find_buffer_file(os.getcwd())
-                common.clean_files(os.getcwd(), buffers)
-                print("Compilation of all programs done")
-                return
-            # Validate compilers on an empty program instance
-            if validate_compilers:
-                for compiler in compilers:
-                    cmd_ending = [exec_dirs.shadertrap, "--show-gl-info", "--require-vendor-renderer-substring",
-                                  compiler.renderer, "scripts/empty.shadertrap"]
-                    cmd = common.build_env_from_compiler(compiler) + cmd_ending
-                    process_return = run(cmd, capture_output=True, text=True)
-                    buffers = common.find_buffer_file(os.getcwd())
-                    common.clean_files(os.getcwd(), buffers)
-                    if compiler.renderer not in process_return.stdout:
-                        print("compiler not found or not working: " + compiler.name)
-                        print(process_return.stdout)
-                        print(process_return.stderr)
-                        return
-                print("compilers validated")
-                validate_compilers = False
-            buffers = common.find_buffer_file(exec_dirs.dumpbufferdir)
-            common.clean_files(exec_dirs.dumpbufferdir, buffers)
-            # Execute program compilation on each compiler and save the results for the batch
-            for i in range(ns.shadercount):
-                common.execute_compilation(compilers, exec_dirs.graphicsfuzz, exec_dirs.shadertrap,
-                                           exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap", str(i),
-                                           exec_dirs.dumpbufferdir, True)
-        # Compare outputs and save buffers
-        # Check that we can compare outputs across multiple compilers
-        if len(compilers) == 1:
-            print("Impossible to compare outputs for only one compiler")
-            return
-        identified_shaders = []
-        for i in range(ns.shadercount):
-            # Reference buffers for a given shader instance
-            buffers_files = []
-            for compiler in compilers:
-                buffers_files.append(exec_dirs.dumpbufferdir + "buffer_" + compiler.name + "_" + str(i) + ".txt")
-            # Compare and check back the results
+def execute_batch(compilers, exec_dirs, shadercount, packsize=1, journal=None, batch_nb=0, clean_buffers=True,
+                  jobs=1, shader_ids=None):
+    # Returns the status of each executed shader per compiler name (see batch_journal.get_compiler_status)
+    if shader_ids is None:
+        shader_ids = range(shadercount)
+    outcomes = {}
+    if clean_buffers:
+        buffers = common.find_buffer_file(exec_dirs.dumpbufferdir)
+        common.clean_files(exec_dirs.dumpbufferdir, buffers)
+    # Only execute the shader / compiler pairs without buffer (all of them unless a batch is resumed)
+    complete_shaders = []
+    partial_shaders = []
+    for i in shader_ids:
+        # Shaders rejected by the pre-validation or already kept are not in the output directory anymore
+        if not os.path.isfile(exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap"):
+            continue
+        missing_compilers = [compiler for compiler in compilers
+                             if not os.path.isfile(get_batch_buffer(exec_dirs, compiler, i))]
+        if len(missing_compilers) == len(compilers):
+            complete_shaders.append(i)
+        elif missing_compilers:
+            partial_shaders.append((i, missing_compilers))
+    # Execute program compilation on each compiler and save the results for the batch
+    for i, missing_compilers in partial_shaders:
+        results = common.execute_compilation(missing_compilers, exec_dirs.graphicsfuzz, exec_dirs.shadertrap,
+                                             exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap", str(i),
+                                             exec_dirs.dumpbufferdir, True)
+        record_outcomes(outcomes, i, missing_compilers, results)
+        if journal is not None:
+            journal.record_execution(batch_nb, i, missing_compilers, results)
+    if jobs > 1:
+        schedule_batch(compilers, exec_dirs, complete_shaders, packsize, jobs, journal, batch_nb, outcomes)
+    elif packsize > 1:
+        for pack_start in range(0, len(complete_shaders), packsize):
+            pack_ids = complete_shaders[pack_start:pack_start + packsize]
+            pack_results = shader_packer.execute_packed_compilation(compilers, exec_dirs.graphicsfuzz,
+                                                                    exec_dirs.shadertrap,
+                                                                    [exec_dirs.shaderoutput + "test_" + str(i)
+                                                                     + ".shadertrap" for i in pack_ids],
+                                                                    [str(i) for i in pack_ids],
+                                                                    exec_dirs.dumpbufferdir, True)
+            for i, results in zip(pack_ids, pack_results):
+                record_outcomes(outcomes, i, compilers, results)
+                if journal is not None:
+                    journal.record_execution(batch_nb, i, compilers, results)
+    else:
+        for i in complete_shaders:
+            results = common.execute_compilation(compilers, exec_dirs.graphicsfuzz, exec_dirs.shadertrap,
+                                                 exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap", str(i),
+                                                 exec_dirs.dumpbufferdir, True)
+            record_outcomes(outcomes, i, compilers, results)
+            if journal is not None:
+                journal.record_execution(batch_nb, i, compilers, results)
+    return outcomes
+
+
+def execute_tiered_batch(compilers, tier_compilers, exec_dirs, shadercount, seed, audit_rate, packsize=1, journal=None,
+                         batch_nb=0, resume_state=None, jobs=1):
+    # Returns the escalated shader ids with the reason of their escalation (see tiered_execution.py) and the status of
+    # the executed shaders
+    outcomes = {}
+    if resume_state is not None:
+        outcomes.update(resume_state["executed"])
+    for i, shader_outcomes in execute_batch(tier_compilers, exec_dirs, shadercount, packsize, journal, batch_nb,
+                                            resume_state is None, jobs).items():
+        outcomes.setdefault(i, {}).update(shader_outcomes)
+    escalations = tiered_execution.select_escalations(tier_compilers, exec_dirs, range(shadercount), outcomes,
+                                                      audit_rate, seed)
+    other_compilers = [compiler for compiler in compilers if compiler not in tier_compilers]
+    for i, shader_outcomes in execute_batch(other_compilers, exec_dirs, shadercount, packsize, journal, batch_nb,
+                                            False, jobs, sorted(escalations)).items():
+        outcomes.setdefault(i, {}).update(shader_outcomes)
+    return escalations, outcomes
+
+
+def record_outcomes(outcomes, shader_id, compilers, results):
+    if shader_id not in outcomes:
+        outcomes[shader_id] = {}
+    for compiler, result in zip(compilers, results):
+        outcomes[shader_id][compiler.name] = batch_journal.get_compiler_status(result)
+        metrics.inc("executions_total", compiler=compiler.name, family=compiler.family,
+                    status=outcomes[shader_id][compiler.name])
+
+
+def schedule_batch(compilers, exec_dirs, shader_ids, packsize, jobs, journal=None, batch_nb=0, outcomes=None):
+    # Concurrent execution respecting the slots of each compiler (see scheduler.py), a unit is a pack of shaders
+    units = [shader_ids[pack_start:pack_start + packsize] for pack_start in range(0, len(shader_ids), packsize)]
+
+    def prepare(unit):
+        harness_files, packed_names, packed_seeds, _ = shader_packer.postprocess_pack(
+            exec_dirs.graphicsfuzz, [exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap" for i in unit],
+            [str(i) for i in unit])
+        if not harness_files:
+            return None
+        return harness_files, packed_names, packed_seeds
+
+    def execute(unit, prepared, compiler, job_dir):
+        harness_files, packed_names, packed_seeds = prepared
+        file_results = [common.get_buffer_name(compiler, output_seed) for output_seed in packed_seeds]
+        return shader_packer.execute_pack(compiler, exec_dirs.shadertrap, harness_files, packed_names, file_results,
+                                          exec_dirs.dumpbufferdir, True, 10, job_dir)
+
+    def finish(unit, prepared, results):
+        packed_ids = []
+        if prepared is not None:
+            common.clean_files(os.getcwd(), prepared[0])
+            packed_ids = [int(output_seed) for output_seed in prepared[2]]
+        for i in unit:
+            unit_results = [False for _ in compilers]
+            if i in packed_ids:
+                position = packed_ids.index(i)
+                unit_results = [results[compiler.name][position] for compiler in compilers]
+            if outcomes is not None:
+                with outcomes_lock:
+                    record_outcomes(outcomes, i, compilers, unit_results)
+            if journal is not None:
+                journal.record_execution(batch_nb, i, compilers, unit_results)
+
+    outcomes_lock = threading.Lock()
+    scheduler.BatchScheduler(compilers, jobs).run(units, prepare, execute, finish)
+
+
+def report_variants(compilers, outcomes, divergent_shaders):
+    # Summary of the batch per variant and per driver family (only when variants are configured)
+    if all(compiler.variant == "" for compiler in compilers):
+        return
+    statuses = ["no_crash", "crash", "timeout", "divergent"]
+    counts = {}
+    for compiler in compilers:
+        counts[compiler.name] = dict((status, 0) for status in statuses)
+    for shader_outcomes in outcomes.values():
+        for name, status in shader_outcomes.items():
+            if name in counts and status in counts[name]:
+                counts[name][status] += 1
+    for _, groups in divergent_shaders:
+        for name in common.get_divergent_compilers(groups):
+            counts[name]["divergent"] += 1
+    families = {}
+    for compiler in compilers:
+        if compiler.family not in families:
+            families[compiler.family] = dict((status, 0) for status in statuses)
+        for status in statuses:
+            families[compiler.family][status] += counts[compiler.name][status]
+    for compiler in compilers:
+        print("Variant " + compiler.name + ": " + ", ".join(str(counts[compiler.name][status]) + " " + status
+                                                            for status in statuses))
+    for family, family_counts in families.items():
+        print("Family " + family + ": " + ", ".join(str(family_counts[status]) + " " + status
+                                                    for status in statuses))
+
+
+def count_batch_shaders(exec_dirs, shadercount):
+    # Shaders of the batch which have not been rejected by the pre-validation
+    return len([i for i in range(shadercount)
+                if os.path.isfile(exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap")])
+
+
+def get_batch_buffer(exec_dirs, compiler, shader_id):
+    return exec_dirs.dumpbufferdir + "buffer_" + compiler.name + "_" + str(shader_id) + ".txt"
+
+
+def compare_batch(compilers, exec_dirs, shadercount, tolerance=None, shader_ids=None):
+    # Returns the shaders ids showing differences with the groups of agreeing compiler names
+    # The buffers are compared numerically when a (ulp, relative) float tolerance is given
+    if shader_ids is None:
+        shader_ids = range(shadercount)
+    divergent_shaders = []
+    for i in shader_ids:
+        # Shaders kept before an interruption of the batch are not in the output directory anymore
+        if not os.path.isfile(exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap"):
+            continue
+        # Reference buffers for a given shader instance
+        buffers_files = []
+        buffers_compilers = {}
+        for compiler in compilers:
+            buffer_file = get_batch_buffer(exec_dirs, compiler, i)
+            buffers_files.append(buffer_file)
+            buffers_compilers[buffer_file] = compiler.name
+        # Compare and check back the results
+        if tolerance is None:
             values = common.comparison_helper(buffers_files)
-            if len(values) != 1:
-                print("Different results across implementations for shader " + str(seed + i))
-                # Move shader
-                identified_shaders.append(str(seed + i) + ".shadertrap")
-                shutil.move(exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap",
-                            exec_dirs.keptshaderdir + str(seed + i) + ".shadertrap")
-                # Move buffers
-                for compiler in compilers:
-                    shutil.move(exec_dirs.dumpbufferdir + "buffer_" + compiler.name + "_" + str(i) + ".txt",
-                                exec_dirs.keptbufferdir + compiler.name + "_" + str(seed + i) + ".txt")
+        else:
+            layout = buffer_comparison.parse_buffer_layout(exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap")
+            values, summary = buffer_comparison.numeric_comparison_helper(
+                buffers_files, layout, tolerance[0], tolerance[1], [compiler.name for compiler in compilers])
+            for line in summary:
+                print("Shader " + str(i) + ", " + line)
+        if len(values) != 1:
+            divergent_shaders.append((i, [[buffers_compilers[file] for file in group] for group in values]))
+    return divergent_shaders
 
-        # reduce with the default reducer if specified
-        if ns.reduce:
-            automate_reducer.batch_reduction(reducer, compilers_dict, exec_dirs, identified_shaders, -1,
-                                             ns.timeout)
-        # Set flag for while loop and print the number of batch
-        print("Batch " + str(batch_nb) + " processed")
-        batch_nb += 1
+
+def keep_shader(compilers, exec_dirs, shader_id, kept_seed):
+    # Move shader
+    shutil.move(exec_dirs.shaderoutput + "test_" + str(shader_id) + ".shadertrap",
+                exec_dirs.keptshaderdir + str(kept_seed) + ".shadertrap")
+    # Move buffers
+    for compiler in compilers:
+        shutil.move(get_batch_buffer(exec_dirs, compiler, shader_id),
+                    exec_dirs.keptbufferdir + compiler.name + "_" + str(kept_seed) + ".txt")
+    return str(kept_seed) + ".shadertrap"
 
 
 if __name__ == "__main__":
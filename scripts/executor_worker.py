@@ -0,0 +1,86 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import json
+import os
+import signal
+import sys
+
+import output_capture
+
+# Persistent worker of the worker executor (see executors.py): started once in the environment of a compiler, it
+# keeps the driver libraries of the compiler loaded, reads one json request per line on stdin and answers with one
+# json line on stdout. ShaderTrap is spawned directly by the worker, without the env wrapper of the local executor,
+# and finds the driver libraries already mapped and in the page cache.
+DRIVER_PREFIXES = ("libEGL", "libGL", "libvulkan", "libvk_")
+
+loaded_libraries = []
+
+
+def find_driver_libraries():
+    libraries = []
+    for icd_file in os.environ.get("VK_ICD_FILENAMES", "").split(os.pathsep):
+        if not os.path.isfile(icd_file):
+            continue
+        f = open(icd_file, "r")
+        try:
+            library = json.load(f)["ICD"]["library_path"]
+        except (ValueError, KeyError):
+            library = ""
+        f.close()
+        if library != "":
+            libraries.append(os.path.join(os.path.dirname(os.path.abspath(icd_file)), library))
+    for library_dir in os.environ.get("LD_LIBRARY_PATH", "").split(os.pathsep):
+        if not os.path.isdir(library_dir):
+            continue
+        for file in sorted(os.listdir(library_dir)):
+            if file.startswith(DRIVER_PREFIXES) and ".so" in file:
+                libraries.append(os.path.join(library_dir, file))
+    # The versioned names of a library are symlinks to the same file
+    unique_libraries = []
+    for library in libraries:
+        if os.path.isfile(library) and os.path.realpath(library) not in unique_libraries:
+            unique_libraries.append(os.path.realpath(library))
+    return unique_libraries
+
+
+def preload_driver():
+    for library in find_driver_libraries():
+        try:
+            loaded_libraries.append(ctypes.CDLL(library))
+        except OSError as error:
+            sys.stderr.write("executor worker: cannot preload " + library + ": " + str(error) + "\n")
+
+
+def stop(signum, frame):
+    # The executor stops a hung worker with SIGTERM: the ShaderTrap run in progress is in its own process group
+    output_capture.kill_running_runs()
+    sys.exit(128 + signum)
+
+
+def main():
+    signal.signal(signal.SIGTERM, stop)
+    preload_driver()
+    for line in sys.stdin:
+        request = json.loads(line)
+        stdout, stderr, timed_out, success = output_capture.run_with_capture(request["cmd"], request["timeout"],
+                                                                             request["log"], request["cwd"])
+        answer = {"stdout": stdout, "stderr": stderr, "timed_out": timed_out, "success": success}
+        sys.stdout.write(json.dumps(answer) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import atexit
+import base64
+import hashlib
+import json
+import os
+import select
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import common
+import output_capture
+
+
+# Executors run a ShaderTrap harness with a given compiler and leave the dumped buffers in the current directory.
+# The backend is chosen per compiler with the executor setting of the config file:
+# local: ShaderTrap subprocess with the compiler environment (default)
+# container: ShaderTrap called through a command prefix (executor_command), e.g. a chroot or docker run command
+# worker: a resident process per compiler (executor_worker.py), started once in the compiler environment with the
+# driver libraries loaded, which spawns ShaderTrap on request and is restarted when it stops or hangs
+# replay: serves the outputs stored in executor_record_dir without calling any driver
+# Except for replay, outputs are recorded in executor_record_dir when the setting is provided.
+
+# Delay given to a worker on top of the timeout of a run before it is considered hung
+WORKER_TIMEOUT_MARGIN = 30
+
+
+class ExecutionOutput:
+    def __init__(self, stdout, stderr, timed_out=False, success=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        # ShaderTrap reports successful executions with SUCCESS! on stderr
+        if success is None:
+            success = "SUCCESS!" in stderr
+        self.success = success
+
+
+class Executor(abc.ABC):
+    def __init__(self, compiler, shadertrap):
+        self.compiler = compiler
+        self.shadertrap = shadertrap
+
+    def build_command(self, shader_file, extra_args):
+        return [self.shadertrap] + extra_args + ["--require-vendor-renderer-substring", self.compiler.renderer,
+                                                 shader_file]
+
+    def execute(self, shader_file, timeout=10, extra_args=None, cwd=None):
+        # The buffers are dumped in cwd (by default the current directory)
+        if extra_args is None:
+            extra_args = []
+        if cwd is None:
+            cwd = os.getcwd()
+        shader_file = os.path.abspath(shader_file)
+        if self.compiler.executor_record_dir == "":
+            return self.run_command(shader_file, timeout, extra_args, cwd)
+        existing_buffers = common.find_buffer_file(cwd)
+        output = self.run_command(shader_file, timeout, extra_args, cwd)
+        record_output(self.compiler, shader_file, extra_args, output,
+                      [file for file in common.find_buffer_file(cwd) if file not in existing_buffers], cwd)
+        return output
+
+    @abc.abstractmethod
+    def run_command(self, shader_file, timeout, extra_args, cwd):
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalExecutor(Executor):
+    def get_command_prefix(self, cwd):
+        return []
+
+    def run_command(self, shader_file, timeout, extra_args, cwd):
+        cmd = self.get_command_prefix(cwd) + common.build_env_from_compiler(self.compiler) \
+              + self.build_command(shader_file, extra_args)
+        stdout, stderr, timed_out, success = output_capture.run_with_capture(
+            cmd, timeout, output_capture.get_run_log(self.compiler.name), cwd)
+        return ExecutionOutput(stdout, stderr, timed_out, success)
+
+
+class ContainerExecutor(LocalExecutor):
+    def get_command_prefix(self, cwd):
+        # The prefix can refer to the execution directory with {cwd} (e.g. to mount it in a container)
+        return shlex.split(self.compiler.executor_command.format(cwd=os.path.abspath(cwd)))
+
+
+class WorkerExecutor(Executor):
+    def __init__(self, compiler, shadertrap):
+        Executor.__init__(self, compiler, shadertrap)
+        self.process = None
+        self.pending = b""
+        self.lock = threading.Lock()
+
+    def start(self):
+        cmd = common.build_env_from_compiler(self.compiler) \
+              + [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "executor_worker.py")]
+        # The worker gets its own process group so that a hung worker can be killed without touching the harness
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True)
+        self.pending = b""
+
+    def stop(self):
+        # SIGTERM lets the worker kill the ShaderTrap run in progress, SIGKILL stops a worker which does not exit
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait(timeout=5)
+        except ProcessLookupError:
+            self.process.wait()
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process = None
+
+    def read_answer(self, timeout):
+        # Returns the next line written by the worker, "" if the worker stopped and None if it did not answer in time
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout + WORKER_TIMEOUT_MARGIN
+        while b"\n" not in self.pending:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+            ready, _, _ = select.select([self.process.stdout], [], [], remaining)
+            if not ready:
+                return None
+            data = os.read(self.process.stdout.fileno(), 65536)
+            if data == b"":
+                return ""
+            self.pending += data
+        line, self.pending = self.pending.split(b"\n", 1)
+        return line.decode()
+
+    def run_command(self, shader_file, timeout, extra_args, cwd):
+        run_log = output_capture.get_run_log(self.compiler.name)
+        if run_log != "":
+            run_log = os.path.abspath(run_log)
+        request = {"cmd": self.build_command(shader_file, extra_args), "cwd": os.path.abspath(cwd),
+                   "timeout": timeout, "log": run_log}
+        # A worker handles a single request at a time
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                if self.process is not None:
+                    self.stop()
+                self.start()
+            try:
+                self.process.stdin.write((json.dumps(request) + "\n").encode())
+                self.process.stdin.flush()
+                answer = self.read_answer(timeout)
+            except BrokenPipeError:
+                answer = ""
+            if answer is None or answer == "":
+                # The worker is restarted on the next request
+                self.stop()
+        if answer is None:
+            return ExecutionOutput("", "executor worker of " + self.compiler.name + " hung, it was restarted\n", True,
+                                   False)
+        if answer == "":
+            return ExecutionOutput("", "executor worker of " + self.compiler.name + " stopped unexpectedly\n")
+        answer = json.loads(answer)
+        return ExecutionOutput(answer["stdout"], answer["stderr"], answer["timed_out"], answer["success"])
+
+    def close(self):
+        if self.process is None:
+            return
+        # Closing stdin ends the loop of the worker
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=WORKER_TIMEOUT_MARGIN)
+        except (BrokenPipeError, subprocess.TimeoutExpired):
+            pass
+        if self.process.poll() is None:
+            self.stop()
+        else:
+            self.process.stdout.close()
+            self.process = None
+
+
+class ReplayExecutor(Executor):
+    def execute(self, shader_file, timeout=10, extra_args=None, cwd=None):
+        # The replayed outputs are not recorded again
+        if extra_args is None:
+            extra_args = []
+        if cwd is None:
+            cwd = os.getcwd()
+        return self.run_command(shader_file, timeout, extra_args, cwd)
+
+    def run_command(self, shader_file, timeout, extra_args, cwd):
+        record_file = get_record_file(self.compiler, shader_file, extra_args)
+        if not os.path.isfile(record_file):
+            return ExecutionOutput("", "no recorded output for " + shader_file + " with " + self.compiler.name + "\n")
+        f = open(record_file, "r")
+        record = json.load(f)
+        f.close()
+        for buffer_name, content in record["buffers"].items():
+            g = open(os.path.join(cwd, buffer_name), "wb")
+            g.write(base64.b64decode(content))
+            g.close()
+        return ExecutionOutput(record["stdout"], record["stderr"], record["timed_out"], record.get("success"))
+
+
+def get_record_file(compiler, shader_file, extra_args):
+    f = open(shader_file, "rb")
+    key = hashlib.sha256(f.read())
+    f.close()
+    key.update(" ".join(extra_args).encode())
+    return os.path.join(compiler.executor_record_dir, compiler.name + "_" + key.hexdigest() + ".json")
+
+
+def record_output(compiler, shader_file, extra_args, output, buffer_files, cwd):
+    os.makedirs(compiler.executor_record_dir, exist_ok=True)
+    buffers = {}
+    for buffer_name in buffer_files:
+        f = open(os.path.join(cwd, buffer_name), "rb")
+        buffers[buffer_name] = base64.b64encode(f.read()).decode()
+        f.close()
+    record = {"stdout": output.stdout, "stderr": output.stderr, "timed_out": output.timed_out,
+              "success": output.success, "buffers": buffers}
+    g = open(get_record_file(compiler, shader_file, extra_args), "w")
+    json.dump(record, g)
+    g.close()
+
+
+executor_classes = {"local": LocalExecutor, "container": ContainerExecutor, "worker": WorkerExecutor,
+                    "replay": ReplayExecutor}
+executors = {}
+executors_lock = threading.Lock()
+
+
+def get_executor(compiler, shadertrap):
+    with executors_lock:
+        if compiler.name not in executors:
+            if compiler.executor not in executor_classes:
+                exit("Unknown executor " + compiler.executor + " for compiler " + compiler.name)
+            executors[compiler.name] = executor_classes[compiler.executor](compiler, shadertrap)
+        return executors[compiler.name]
+
+
+@atexit.register
+def close_executors():
+    for executor in executors.values():
+        executor.close()
+    executors.clear()
@@ -0,0 +1,186 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import reduction_queue
+
+# Metrics of a run in the Prometheus text format, served over HTTP (/metrics) or periodically written to a file (e.g.
+# for the textfile collector of the node exporter). Updating a metric is a dictionary update under a lock and does
+# nothing when no output is configured, the gauges depending on the file system (reduction queue depth, disk usage of
+# the kept directories) are only computed when the metrics are rendered.
+
+PREFIX = "glslsmith_"
+PHASE_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+HELP = {
+    "shaders_generated_total": ("counter", "Generated shaders"),
+    "shaders_executed_total": ("counter", "Shaders executed on the compilers"),
+    "executions_total": ("counter", "Executions per compiler and status (no_crash, crash, timeout, missing)"),
+    "divergences_total": ("counter", "Divergent shaders per compiler outside the largest group of agreeing compilers"),
+    "timeouts_diverted_total": ("counter", "Shaders moved to the timeout lane"),
+    "batches_total": ("counter", "Processed batches"),
+    "batch_shaders_per_second": ("gauge", "Executed shaders per second during the last batch"),
+    "phase_duration_seconds": ("histogram", "Duration of the phases of the batches"),
+    "reduction_queue_depth": ("gauge", "Kept shaders per state of the reduction queue"),
+    "kept_directory_bytes": ("gauge", "Disk usage of the kept directories"),
+}
+
+registry = None
+
+
+class Registry:
+    def __init__(self, exec_dirs):
+        self.exec_dirs = exec_dirs
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.phase = None
+
+    def inc(self, name, value, labels):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels):
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {"buckets": [0 for _ in PHASE_BUCKETS], "sum": 0.0, "count": 0}
+            histogram = self.histograms[key]
+            for i, bound in enumerate(PHASE_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def collect_files(self):
+        # Gauges read from the file system at rendering time
+        queue_file = self.exec_dirs.keptshaderdir + reduction_queue.QUEUE_FILE
+        if os.path.isfile(queue_file):
+            try:
+                for state, count in reduction_queue.ReductionQueue(queue_file).get_counts().items():
+                    self.set("reduction_queue_depth", count, (("state", state),))
+            except ValueError:
+                # The queue is being rewritten
+                pass
+        for directory in [self.exec_dirs.keptshaderdir, self.exec_dirs.keptbufferdir]:
+            size = 0
+            if os.path.isdir(directory):
+                for entry in os.scandir(directory):
+                    if entry.is_file():
+                        size += entry.stat().st_size
+            self.set("kept_directory_bytes", size, (("directory", os.path.basename(os.path.normpath(directory))),))
+
+    def render(self):
+        self.collect_files()
+        lines = []
+        with self.lock:
+            for name, (kind, description) in HELP.items():
+                samples = sorted([(labels, value) for (metric, labels), value in self.values.items()
+                                  if metric == name])
+                histograms = sorted([(labels, histogram) for (metric, labels), histogram in self.histograms.items()
+                                     if metric == name])
+                if not samples and not histograms:
+                    continue
+                lines.append("# HELP " + PREFIX + name + " " + description)
+                lines.append("# TYPE " + PREFIX + name + " " + kind)
+                for labels, value in samples:
+                    lines.append(PREFIX + name + format_labels(labels) + " " + str(value))
+                for labels, histogram in histograms:
+                    for bound, count in zip(PHASE_BUCKETS, histogram["buckets"]):
+                        lines.append(PREFIX + name + "_bucket" + format_labels(labels + (("le", str(bound)),)) + " "
+                                     + str(count))
+                    lines.append(PREFIX + name + "_bucket" + format_labels(labels + (("le", "+Inf"),)) + " "
+                                 + str(histogram["count"]))
+                    lines.append(PREFIX + name + "_sum" + format_labels(labels) + " " + str(round(histogram["sum"], 3)))
+                    lines.append(PREFIX + name + "_count" + format_labels(labels) + " " + str(histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                          for name, value in labels) + "}"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_metrics(filename, interval):
+    while True:
+        tmp_file = filename + ".tmp"
+        g = open(tmp_file, "w")
+        g.write(registry.render())
+        g.close()
+        os.replace(tmp_file, filename)
+        time.sleep(interval)
+
+
+def start(exec_dirs, port=0, address="127.0.0.1", filename="", interval=15):
+    # Enables the metrics if an HTTP port or a file is given
+    global registry
+    if port == 0 and filename == "":
+        return
+    registry = Registry(exec_dirs)
+    if port != 0:
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print("Metrics served on http://" + address + ":" + str(port) + "/metrics")
+    if filename != "":
+        threading.Thread(target=write_metrics, args=(os.path.abspath(filename), interval), daemon=True).start()
+
+
+def inc(name, value=1, **labels):
+    if registry is not None:
+        registry.inc(name, value, tuple(sorted(labels.items())))
+
+
+def set_gauge(name, value, **labels):
+    if registry is not None:
+        registry.set(name, value, tuple(sorted(labels.items())))
+
+
+def start_phase(phase):
+    # Observes the duration of the current phase (if any) and starts timing the given one
+    end_phase()
+    if registry is not None:
+        registry.phase = (phase, time.time())
+
+
+def end_phase():
+    if registry is not None and registry.phase is not None:
+        phase, start_time = registry.phase
+        registry.phase = None
+        registry.observe("phase_duration_seconds", time.time() - start_time, (("phase", phase),))
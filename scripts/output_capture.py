@@ -0,0 +1,139 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+import signal
+import subprocess
+import tarfile
+import threading
+
+# Driver outputs are streamed to a log file per run (when a log directory is configured) and only a bounded head and
+# tail of each stream is kept in memory for the classification of the run.
+HEAD_SIZE = 16384
+TAIL_SIZE = 16384
+CHUNK_SIZE = 65536
+SUCCESS_MARKER = b"SUCCESS!"
+
+# Directory receiving the logs of the current batch (no log file if empty)
+log_dir = ""
+run_counter = itertools.count()
+# Process groups of the runs in progress, killed by kill_running_runs when the caller is stopped
+running_groups = set()
+
+
+class BoundedStream:
+    def __init__(self, marker=b""):
+        self.head = b""
+        self.tail = b""
+        self.total = 0
+        self.marker = marker
+        self.found_marker = False
+        # Last bytes of the previous chunk to find a marker split across two chunks
+        self.carry = b""
+
+    def add(self, chunk):
+        if self.marker and not self.found_marker:
+            self.found_marker = self.marker in self.carry + chunk
+            self.carry = (self.carry + chunk)[-(len(self.marker) - 1):]
+        self.total += len(chunk)
+        if len(self.head) < HEAD_SIZE:
+            kept = HEAD_SIZE - len(self.head)
+            self.head += chunk[:kept]
+            chunk = chunk[kept:]
+        self.tail = (self.tail + chunk)[-TAIL_SIZE:]
+
+    def get_text(self):
+        skipped = self.total - len(self.head) - len(self.tail)
+        text = self.head.decode("utf-8", "replace")
+        if skipped > 0:
+            text += "\n[... " + str(skipped) + " bytes skipped, see the run log ...]\n"
+        return text + self.tail.decode("utf-8", "replace")
+
+
+def pump(pipe, stream, log_file, log_lock):
+    for chunk in iter(lambda: pipe.read(CHUNK_SIZE), b""):
+        stream.add(chunk)
+        if log_file is not None:
+            with log_lock:
+                log_file.write(chunk)
+    pipe.close()
+
+
+def get_run_log(name):
+    if log_dir == "":
+        return ""
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, str(next(run_counter)) + "_" + name + ".log")
+
+
+def run_with_capture(cmd, timeout=None, run_log="", cwd=None):
+    # Returns (stdout, stderr, timed_out, success) with bounded stdout and stderr texts
+    log_file = None
+    if run_log != "":
+        log_file = open(run_log, "wb")
+        log_file.write((" ".join(cmd) + "\n").encode())
+    log_lock = threading.Lock()
+    stdout = BoundedStream()
+    stderr = BoundedStream(SUCCESS_MARKER)
+    # The run gets its own process group so that the processes spawned by the driver are killed on timeouts
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, start_new_session=True)
+    running_groups.add(process.pid)
+    pumps = [threading.Thread(target=pump, args=(process.stdout, stdout, log_file, log_lock)),
+             threading.Thread(target=pump, args=(process.stderr, stderr, log_file, log_lock))]
+    for thread in pumps:
+        thread.start()
+    timed_out = False
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+        timed_out = True
+    running_groups.discard(process.pid)
+    for thread in pumps:
+        thread.join()
+    if log_file is not None:
+        log_file.close()
+    return stdout.get_text(), stderr.get_text(), timed_out, stderr.found_marker
+
+
+def kill_running_runs():
+    # Called from signal handlers: no lock, the set is copied in a single step
+    for group in running_groups.copy():
+        try:
+            os.killpg(group, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def rotate_logs(batch_name, keep=10):
+    # Compress the logs of the batch in a single archive and only keep the most recent archives
+    if log_dir == "" or not os.path.isdir(log_dir):
+        return
+    log_files = sorted([file for file in os.listdir(log_dir) if file.endswith(".log")])
+    if log_files:
+        archive = tarfile.open(os.path.join(log_dir, batch_name + ".tar.gz"), "w:gz")
+        for file in log_files:
+            archive.add(os.path.join(log_dir, file), file)
+        archive.close()
+        for file in log_files:
+            os.remove(os.path.join(log_dir, file))
+    archives = sorted([file for file in os.listdir(log_dir) if file.endswith(".tar.gz")],
+                      key=lambda file: os.path.getmtime(os.path.join(log_dir, file)))
+    for file in archives[:-keep]:
+        os.remove(os.path.join(log_dir, file))
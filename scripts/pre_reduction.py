@@ -0,0 +1,134 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import queue
+import re
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import reducer_portfolio
+
+# Line level delta debugging of the extracted shader before the external reducer: chunks of lines (halves, quarters,
+# ... down to single lines) are removed as long as the shader stays interesting. Only chunks with balanced braces
+# which do not contain the version, the work group layout or the main signature are tried. Candidates are evaluated in
+# parallel, each evaluation running the interestingness test in its own workspace (see reducer_portfolio.py).
+
+
+def is_protected(line):
+    return line.strip().startswith("#version") or (line.strip().startswith("layout") and " in;" in line) \
+           or "main(" in line
+
+
+def is_removable(lines):
+    depth = 0
+    for line in lines:
+        if is_protected(line):
+            return False
+        depth += line.count("{") - line.count("}")
+        if depth < 0:
+            return False
+    return depth == 0
+
+
+def get_chunks(lines, size):
+    return [(start, min(start + size, len(lines))) for start in range(0, len(lines), size)
+            if is_removable(lines[start:start + size])]
+
+
+def delta_debugging(lines, is_interesting, jobs=1):
+    # Returns the reduced lines and the number of interestingness calls
+    calls = 0
+    granularity = 2
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while len(lines) > 1:
+            size = max(1, len(lines) // granularity)
+            chunks = get_chunks(lines, size)
+            removed = False
+            for batch_start in range(0, len(chunks), jobs):
+                batch = chunks[batch_start:batch_start + jobs]
+                results = list(pool.map(lambda chunk: is_interesting(lines[:chunk[0]] + lines[chunk[1]:]), batch))
+                calls += len(batch)
+                # The first interesting candidate of the batch is kept to stay deterministic
+                for (start, end), result in zip(batch, results):
+                    if result:
+                        lines = lines[:start] + lines[end:]
+                        removed = True
+                        break
+                if removed:
+                    break
+            if removed:
+                continue
+            if size == 1:
+                break
+            granularity *= 2
+    return lines, calls
+
+
+def pre_reduce(exec_dirs, harness_file, shader_file, interesting_test, jobs=1):
+    # Reduces shader_file in place with the interestingness test of the execution directory
+    execdir = os.path.abspath(exec_dirs.execdir)
+    config_file = os.path.join(execdir, "scripts", "config.xml")
+    f = open(shader_file, "r")
+    original = f.read()
+    f.close()
+    start = time.time()
+    # One workspace per evaluator with its own harness and interestingness test
+    workspaces = queue.Queue()
+    workspace_list = []
+    f = open(os.path.join(execdir, interesting_test), "r")
+    test_code = f.read()
+    f.close()
+    for i in range(jobs):
+        workspace = reducer_portfolio.create_workspace(execdir, config_file, "pre_reduction_" + str(i))
+        shutil.copy(harness_file, os.path.join(workspace, os.path.basename(harness_file)))
+        g = open(os.path.join(workspace, interesting_test), "w")
+        g.write(re.sub(r'^ROOT=".*"$', 'ROOT="' + workspace + '"', test_code, flags=re.MULTILINE))
+        g.close()
+        workspaces.put(workspace)
+        workspace_list.append(workspace)
+    call_durations = []
+
+    def is_interesting(lines):
+        workspace = workspaces.get()
+        candidate = os.path.join(workspace, "candidate.comp")
+        g = open(candidate, "w")
+        g.write("".join(lines))
+        g.close()
+        call_start = time.time()
+        process_return = subprocess.run(["bash", os.path.join(workspace, interesting_test), "candidate.comp"],
+                                        cwd=workspace, capture_output=True)
+        call_durations.append(time.time() - call_start)
+        workspaces.put(workspace)
+        return process_return.returncode == 0
+
+    lines, calls = delta_debugging(original.splitlines(True), is_interesting, jobs)
+    for workspace in workspace_list:
+        shutil.rmtree(workspace, ignore_errors=True)
+    reduced = "".join(lines)
+    g = open(shader_file, "w")
+    g.write(reduced)
+    g.close()
+    duration = time.time() - start
+    removed_lines = len(original.splitlines()) - len(lines)
+    print("Pre-reduction: " + str(len(original)) + " -> " + str(len(reduced)) + " bytes ("
+          + str(removed_lines) + " lines removed) in " + str(round(duration, 1)) + "s with " + str(calls)
+          + " interestingness calls")
+    if call_durations:
+        # The external reducer needs at least one interestingness call per removed line
+        saved = removed_lines * sum(call_durations) / len(call_durations) - duration
+        print("Pre-reduction: estimated reduction time saved " + str(round(saved, 1)) + "s")
+    return len(original), len(reduced), duration
@@ -0,0 +1,137 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import splitter_merger
+
+# Location of the error in the glslangValidator messages (ERROR: file:line: 'token' : message)
+ERROR_REGEX = re.compile(r"^ERROR: [^:]*:[0-9]+: (.*)$")
+
+
+def get_rejection_reason(output):
+    # First error reported by the front end
+    for line in output.split("\n"):
+        match = ERROR_REGEX.match(line.strip())
+        if match:
+            return match.group(1).strip()
+    for line in output.split("\n"):
+        if line.startswith("ERROR"):
+            return line.strip()
+    return "unknown error"
+
+
+def get_reason_kind(reason):
+    # Reason without the shader specific tokens, used to group rejections in the statistics
+    return re.sub(r"'[^']*'", "''", reason)
+
+
+def validate_shader(validator, shadername, workdir, timeout=10):
+    # Returns None if the compute shader of the harness is accepted by the front end, else the rejection reason
+    glsl_file = os.path.join(workdir, os.path.basename(shadername).replace(".shadertrap", "") + ".comp")
+    splitter_merger.split(shadername, glsl_file)
+    f = open(glsl_file, "r")
+    code = f.read()
+    f.close()
+    if code.strip() == "":
+        return "no compute shader in the harness"
+    try:
+        process_return = subprocess.run([validator, glsl_file], capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # Do not drop a shader because of the front end, the drivers will decide
+        print("Validation timeout on " + shadername)
+        return None
+    finally:
+        os.remove(glsl_file)
+    if process_return.returncode != 0:
+        return get_rejection_reason(process_return.stdout + process_return.stderr)
+    return None
+
+
+def prevalidate_files(validator, shadernames, jobs=1):
+    # Validates the shaders in parallel, returns the rejection reasons (None for the valid shaders)
+    workdir = tempfile.mkdtemp(prefix="prevalidation_", dir=os.getcwd())
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        reasons = list(pool.map(lambda shadername: validate_shader(validator, shadername, workdir), shadernames))
+    shutil.rmtree(workdir, ignore_errors=True)
+    return reasons
+
+
+def quarantine_shader(shadername, reason, quarantine_dir, kept_name):
+    # Rejected shaders are kept with their rejection reason in the quarantine directory (or dropped without it)
+    if quarantine_dir == "":
+        os.remove(shadername)
+        return
+    os.makedirs(quarantine_dir, exist_ok=True)
+    shutil.move(shadername, os.path.join(quarantine_dir, kept_name + ".shadertrap"))
+    g = open(os.path.join(quarantine_dir, kept_name + ".reason"), "w")
+    g.write(reason + "\n")
+    g.close()
+
+
+def prevalidate_batch(validator, exec_dirs, shader_ids, seed, jobs=1, quarantine_dir="", stats_file=""):
+    # Removes the invalid shaders of the batch from the shader output directory, returns the rejected shader ids
+    shadernames = [exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap" for i in shader_ids]
+    start = time.time()
+    reasons = prevalidate_files(validator, shadernames, jobs)
+    rejected = []
+    reason_counts = {}
+    for i, shadername, reason in zip(shader_ids, shadernames, reasons):
+        if reason is None:
+            continue
+        print("Shader " + str(seed + i) + " rejected by pre-validation: " + reason)
+        quarantine_shader(shadername, reason, quarantine_dir, str(seed + i))
+        rejected.append(i)
+        reason_counts[get_reason_kind(reason)] = reason_counts.get(get_reason_kind(reason), 0) + 1
+    stats = {"seed": seed, "checked": len(shader_ids), "rejected": len(rejected),
+             "duration": round(time.time() - start, 3), "reasons": reason_counts}
+    print("Pre-validation: " + str(len(rejected)) + " of " + str(len(shader_ids)) + " shaders rejected")
+    if stats_file != "":
+        g = open(stats_file, "a")
+        g.write(json.dumps(stats) + "\n")
+        g.close()
+    return rejected, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the compute shaders of shadertrap harnesses with a local "
+                                                 "GLSL front end before any driver execution")
+    parser.add_argument("--validator", dest="validator", default="glslangValidator",
+                        help="specify the front end command (by default: glslangValidator)")
+    parser.add_argument("--shaders", dest="shaders", nargs="+", required=True,
+                        help="harnesses to validate")
+    parser.add_argument("--jobs", dest="jobs", default=os.cpu_count(), type=int,
+                        help="number of concurrent validations (by default: the number of cpus)")
+    ns = parser.parse_args(sys.argv[1:])
+    reasons = prevalidate_files(ns.validator, ns.shaders, ns.jobs)
+    for shadername, reason in zip(ns.shaders, reasons):
+        if reason is None:
+            print(shadername + ": valid")
+        else:
+            print(shadername + ": " + reason)
+    if any(reason is not None for reason in reasons):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
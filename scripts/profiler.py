@@ -0,0 +1,202 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import os
+import signal
+import sys
+import threading
+import time
+
+# Sampling profiler of the harness process (--profile of the entry points): a daemon thread periodically records the
+# Python stack of every other thread. A sample is counted as cpu when the thread consumed cpu time since the previous
+# sample (per-thread cpu clocks, the first sample of a thread is skipped), otherwise as a wait classified by the
+# innermost frames only (subprocess, lock, file or network wait, e.g. a select call is a subprocess wait below
+# subprocess.communicate). Waits in builtins called from other modules (sleep, reads) are other waits. The samples are
+# written at exit, on SIGTERM and on SIGUSR1 (without stopping):
+# PREFIX_PID.collapsed: collapsed stacks ("frame;frame;... count", the input of flamegraph.pl, inferno or speedscope),
+#                       the waits ending with a [wait:KIND] frame
+# PREFIX_PID.txt: wait-vs-cpu breakdown, cpu times of the process and of its children, most sampled functions
+
+WAIT_KINDS = [("subprocess", ["subprocess.py", "output_capture.py"]), ("lock", ["threading.py", "queue.py"]),
+              ("network", ["socket.py", "socketserver.py", "server.py"]),
+              ("file", ["shutil.py", "filecmp.py", "genericpath.py", "os.py", "tempfile.py"])]
+# Number of innermost frames classifying a wait, the frames of the modules waiting for another one are skipped
+WAIT_DEPTH = 3
+FORWARDING_FILES = ["selectors.py"]
+# Frames of threading.py at the bottom of every thread which are not lock waits
+THREAD_BOOTSTRAP = ["_bootstrap", "_bootstrap_inner", "run"]
+
+profiler = None
+
+
+def get_frame_name(frame):
+    code = frame.f_code
+    return os.path.basename(code.co_filename) + ":" + code.co_name
+
+
+def get_wait_kind(frame):
+    depth = 0
+    while frame is not None and depth < WAIT_DEPTH:
+        filename = os.path.basename(frame.f_code.co_filename)
+        if filename in FORWARDING_FILES:
+            frame = frame.f_back
+            continue
+        if filename != "threading.py" or frame.f_code.co_name not in THREAD_BOOTSTRAP:
+            for kind, filenames in WAIT_KINDS:
+                if filename in filenames:
+                    return kind
+        frame = frame.f_back
+        depth += 1
+    return "other"
+
+
+def get_thread_cpu_time(thread_id):
+    # None when the platform has no per-thread cpu clocks
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (AttributeError, OSError):
+        return None
+
+
+class Profiler:
+    def __init__(self, prefix, interval=0.01):
+        self.prefix = os.path.abspath(prefix) + "_" + str(os.getpid())
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.states = {}
+        self.functions = {}
+        self.samples = 0
+        self.cpu_times = {}
+        self.start_time = time.time()
+        self.start_times = os.times()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self, wall_delta):
+        own_id = threading.get_ident()
+        frames = sys._current_frames()
+        # Forget the finished threads, their ids can be reused
+        for thread_id in list(self.cpu_times.keys()):
+            if thread_id not in frames:
+                del self.cpu_times[thread_id]
+        for thread_id, frame in frames.items():
+            if thread_id == own_id:
+                continue
+            cpu_time = get_thread_cpu_time(thread_id)
+            state = "cpu"
+            if cpu_time is None:
+                state = "unknown"
+            elif thread_id not in self.cpu_times:
+                # No previous cpu time to tell whether the thread was running
+                self.cpu_times[thread_id] = cpu_time
+                continue
+            elif cpu_time - self.cpu_times[thread_id] < wall_delta / 2:
+                state = "wait:" + get_wait_kind(frame)
+            self.cpu_times[thread_id] = cpu_time
+            names = []
+            leaf = get_frame_name(frame)
+            while frame is not None:
+                names.append(get_frame_name(frame))
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            if state.startswith("wait"):
+                stack += ";[" + state + "]"
+            with self.lock:
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.states[state] = self.states.get(state, 0) + 1
+                if state == "cpu":
+                    self.functions[leaf] = self.functions.get(leaf, 0) + 1
+                self.samples += 1
+
+    def run(self):
+        last = time.time()
+        while not self.stop_event.wait(self.interval):
+            now = time.time()
+            self.sample(now - last)
+            last = now
+
+    def write(self):
+        with self.lock:
+            stacks = dict(self.stacks)
+            states = dict(self.states)
+            functions = dict(self.functions)
+            samples = self.samples
+        g = open(self.prefix + ".collapsed", "w")
+        for stack, count in sorted(stacks.items()):
+            g.write(stack + " " + str(count) + "\n")
+        g.close()
+        times = os.times()
+        wall = time.time() - self.start_time
+        lines = ["wall time: " + str(round(wall, 3)) + "s, " + str(samples) + " samples every "
+                 + str(self.interval) + "s",
+                 "process cpu: user " + str(round(times.user - self.start_times.user, 3)) + "s, system "
+                 + str(round(times.system - self.start_times.system, 3)) + "s",
+                 "children cpu (drivers, generator, reducers): user "
+                 + str(round(times.children_user - self.start_times.children_user, 3)) + "s, system "
+                 + str(round(times.children_system - self.start_times.children_system, 3)) + "s",
+                 "", "samples per state (all threads):"]
+        for state, count in sorted(states.items(), key=lambda item: -item[1]):
+            lines.append("  " + state + ": " + str(count) + " (" + str(round(100 * count / max(samples, 1), 1))
+                         + "%)")
+        lines += ["", "most sampled functions on cpu:"]
+        for function, count in sorted(functions.items(), key=lambda item: -item[1])[:20]:
+            lines.append("  " + function + ": " + str(count))
+        g = open(self.prefix + ".txt", "w")
+        g.write("\n".join(lines) + "\n")
+        g.close()
+
+    def stop(self):
+        self.stop_event.set()
+        self.write()
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', dest='profile', default="", nargs="?", const="profile",
+                        help="Sample the stacks of the harness and write PREFIX_PID.collapsed (flamegraph input) and "
+                             "PREFIX_PID.txt (wait-vs-cpu breakdown) at exit or on SIGUSR1 (by default: profile)")
+    parser.add_argument('--profile-interval', dest='profileinterval', default=10, type=int,
+                        help="Interval in milliseconds between two samples of the profiler (by default: 10)")
+
+
+def stop():
+    global profiler
+    if profiler is not None:
+        profiler.stop()
+        profiler = None
+
+
+def handle_sigusr1(signum, frame):
+    if profiler is not None:
+        profiler.write()
+
+
+def handle_sigterm(signum, frame):
+    stop()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def start(prefix, interval=10):
+    # Starts the profiler if a prefix is given (to call from the main thread)
+    global profiler
+    if prefix == "" or profiler is not None:
+        return
+    profiler = Profiler(prefix, interval / 1000)
+    profiler.thread.start()
+    atexit.register(stop)
+    signal.signal(signal.SIGUSR1, handle_sigusr1)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    print("Profiling to " + profiler.prefix + ".collapsed and " + profiler.prefix + ".txt")
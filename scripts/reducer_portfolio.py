@@ -0,0 +1,198 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from xml.dom import minidom
+
+# Portfolio reduction: several reducers race on copies of the same shader, each one in its own workspace.
+# A workspace is a directory of the execution directory mirroring it: the directories of the execution directory
+# are symlinked, the scripts directory contains links to the scripts and a copy of the config file pointing to the
+# workspace (execdir and reducer commands), so that the interestingness tests never share their temporary files.
+# Once a reducer finishes, the others get a grace period before being killed, the smallest result which still shows
+# the original error code is kept and the wins of each reducer are recorded in a statistics file.
+
+WORKSPACE_DIR = "portfolio"
+
+
+def create_workspace(execdir, config_file, reducer_name):
+    # config_file must be absolute, the reductions run from the execution directory
+    root = os.path.abspath(execdir)
+    workspace = os.path.join(root, WORKSPACE_DIR, reducer_name)
+    shutil.rmtree(workspace, ignore_errors=True)
+    os.makedirs(os.path.join(workspace, "scripts"))
+    # Only directories are shared, files written by the reductions stay in the workspace
+    for entry in os.listdir(root):
+        if entry not in ["scripts", WORKSPACE_DIR] and os.path.isdir(os.path.join(root, entry)):
+            os.symlink(os.path.join(root, entry), os.path.join(workspace, entry))
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    for entry in os.listdir(scripts_dir):
+        if entry.endswith(".py") or entry.endswith(".shadertrap"):
+            os.symlink(os.path.join(scripts_dir, entry), os.path.join(workspace, "scripts", entry))
+    xmldoc = minidom.parse(config_file)
+    xmldoc.getElementsByTagName("execdir")[0].childNodes[0].data = workspace + "/"
+    for command in xmldoc.getElementsByTagName("command"):
+        command.childNodes[0].data = command.childNodes[0].data.replace(root, workspace)
+    g = open(os.path.join(workspace, "scripts", "config.xml"), "w")
+    g.write(xmldoc.toxml())
+    g.close()
+    return workspace
+
+
+def get_error_code(workspace, shader_file, ref=-1):
+    # Error code of the shader as computed by the interestingness tests (see reduction_helper.py)
+    cmd = [sys.executable, os.path.join(workspace, "scripts", "reduction_helper.py"), "--config-file",
+           os.path.join(workspace, "scripts", "config.xml"), "--shader-name", shader_file]
+    if ref != -1:
+        cmd += ["--ref", str(ref)]
+    process_return = subprocess.run(cmd, capture_output=True, text=True, cwd=workspace)
+    return process_return.stderr.strip()
+
+
+def kill_reduction(process, grace=10):
+    # SIGTERM lets automate_reducer kill the process group of its reducer, SIGKILL stops what is left
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(timeout=grace)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            pass
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+class Portfolio:
+    def __init__(self, reducers, config_file, time_budget=3600, grace=0, stats_file="reducer_stats.json"):
+        self.reducers = reducers
+        self.config_file = os.path.abspath(config_file)
+        self.time_budget = time_budget
+        self.grace = grace
+        self.stats_file = os.path.abspath(stats_file)
+
+    def load_stats(self):
+        if not os.path.isfile(self.stats_file):
+            return {}
+        f = open(self.stats_file, "r")
+        stats = json.load(f)
+        f.close()
+        return stats
+
+    def save_stats(self, stats):
+        g = open(self.stats_file + ".tmp", "w")
+        json.dump(stats, g, indent=1, sort_keys=True)
+        g.close()
+        os.replace(self.stats_file + ".tmp", self.stats_file)
+
+    def select(self, size):
+        # Keep the reducers with the best win rate, reducers without statistics first to evaluate them
+        stats = self.load_stats()
+
+        def win_rate(reducer):
+            if reducer.name not in stats or stats[reducer.name]["races"] == 0:
+                return 2
+            return stats[reducer.name]["wins"] / stats[reducer.name]["races"]
+        self.reducers = sorted(self.reducers, key=win_rate, reverse=True)[:size]
+
+    def run(self, exec_dirs, test_input, test_output, ref, reduce_timeout):
+        # Returns the name of the winning reducer (None if no reducer produced an interesting result)
+        workspaces = {}
+        processes = {}
+        for reducer in self.reducers:
+            workspace = create_workspace(exec_dirs.execdir, self.config_file, reducer.name)
+            workspaces[reducer.name] = workspace
+            shutil.copy(test_input, os.path.join(workspace, "original_test.shadertrap"))
+        original_code = get_error_code(workspaces[self.reducers[0].name],
+                                       os.path.join(workspaces[self.reducers[0].name], "original_test.shadertrap"),
+                                       ref)
+        print("Racing " + ", ".join(workspaces.keys()) + " on error code " + original_code)
+        start = time.time()
+        for reducer in self.reducers:
+            workspace = workspaces[reducer.name]
+            cmd = [sys.executable, os.path.join(workspace, "scripts", "automate_reducer.py"), "--config-file",
+                   os.path.join(workspace, "scripts", "config.xml"), "--reducer", reducer.name, "--test-file-name",
+                   "original_test.shadertrap", "--output-file", "test_reduced.shadertrap", "--ref", str(ref)]
+            if reduce_timeout:
+                cmd.append("--reduce-timeout")
+            log_file = open(os.path.join(workspace, "reduction.log"), "w")
+            processes[reducer.name] = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT, cwd=workspace,
+                                                       start_new_session=True)
+            log_file.close()
+        # Wait for the first reducer to finish with a result (within the time budget) and the grace period of the others
+        durations = {}
+        first_finish = None
+        while len(durations) < len(processes):
+            for name, process in processes.items():
+                if name not in durations and process.poll() is not None:
+                    durations[name] = time.time() - start
+                    # Reducers failing without result do not stop the race
+                    if first_finish is None \
+                            and os.path.isfile(os.path.join(workspaces[name], "test_reduced.shadertrap")):
+                        first_finish = time.time()
+                        print(name + " finished first after " + str(round(durations[name], 1)) + "s")
+            if first_finish is not None and time.time() - first_finish >= self.grace:
+                break
+            if time.time() - start >= self.time_budget:
+                print("Time budget exhausted")
+                break
+            time.sleep(1)
+        for name, process in processes.items():
+            if name not in durations:
+                print("Stopping " + name)
+            kill_reduction(process)
+        # Keep the smallest result still showing the original error code
+        sizes = {}
+        for name in durations:
+            candidate = os.path.join(workspaces[name], "test_reduced.shadertrap")
+            if not os.path.isfile(candidate):
+                continue
+            if get_error_code(workspaces[name], candidate, ref) != original_code:
+                print("Result of " + name + " is not interesting anymore")
+                continue
+            sizes[name] = os.path.getsize(candidate)
+        winner = None
+        if sizes:
+            winner = min(sizes, key=lambda name: (sizes[name], durations[name]))
+            shutil.copy(os.path.join(workspaces[winner], "test_reduced.shadertrap"), test_output)
+            print("Reduction won by " + winner + " (" + str(sizes[winner]) + " bytes)")
+        else:
+            print("No reducer produced an interesting result")
+        self.record(workspaces.keys(), durations, sizes, winner)
+        for workspace in workspaces.values():
+            shutil.rmtree(workspace, ignore_errors=True)
+        return winner
+
+    def record(self, names, durations, sizes, winner):
+        stats = self.load_stats()
+        for name in names:
+            if name not in stats:
+                stats[name] = {"races": 0, "wins": 0, "finished": 0, "interesting": 0, "total_time": 0.0}
+            stats[name]["races"] += 1
+            if name in durations:
+                stats[name]["finished"] += 1
+                stats[name]["total_time"] += durations[name]
+            if name in sizes:
+                stats[name]["interesting"] += 1
+            if name == winner:
+                stats[name]["wins"] += 1
+        self.save_stats(stats)
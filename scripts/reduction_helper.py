@@ -18,6 +18,8 @@ import os
 import sys
 
 import common
+import profiler
+import result_cache
 
 
 # Internal error code on exit have been distributed as follow
@@ -46,7 +48,12 @@ def main():
                         help="Do not clean buffers and post-processed shaders after execution")
     parser.add_argument('--config-file', dest='config', default="config.xml",
                         help="specify a different configuration file from the default")
+    parser.add_argument('--result-cache', dest='resultcache', default="",
+                        help="Reuse the results of already executed shaders from this cache file (disabled by "
+                             "default)")
+    profiler.add_arguments(parser)
     ns = parser.parse_args(sys.argv[1:])
+    profiler.start(ns.profile, ns.profileinterval)
     # Parse directory config
     exec_dirs = common.load_dir_settings(ns.config)
     compilers = common.load_compilers_settings(ns.config)
@@ -55,6 +62,7 @@ def main():
         if not ns.restrict_compilers or compiler in ns.restrict_compilers:
             compilers_dict[compiler.name] = compiler
     os.chdir(exec_dirs.execdir)
+    result_cache.open_cache(ns.resultcache)
     execute_reduction(compilers_dict, exec_dirs, ns.shader, ns.ref, ns.clean, ns.postprocessing)
 
 
@@ -66,6 +74,22 @@ def execute_reduction(compilers_dict, exec_dirs, shader_name, ref, clean_dir, po
                                          verbose=True, postprocessing=postprocessing)
     if clean_dir:
         common.clean_files(os.getcwd(), ["tmp.shadertrap"])
+    ref_buffer = ""
+    if ref != -1:
+        ref_buffer = exec_dirs.keptbufferdir + str(ref) + ".txt"
+    error_code = classify_execution(compilers, results, ["buffer_" + compiler.name + ".txt" for compiler in compilers],
+                                    ref_buffer)
+    if clean_dir:
+        common.clean_files(os.getcwd(), common.find_buffer_file(os.getcwd()))
+    if error_code == "0000":
+        sys.stderr.write("0000")
+        sys.exit(0)
+    sys.exit(error_code)
+
+
+def classify_execution(compilers, results, buffer_files, ref_buffer=""):
+    # Returns the error code of an execution (see above, 0000 without difference) from the results and the combined
+    # buffers of the compilers
     crash_flag = False
     all_crashed = True
     timeout_flag = False
@@ -83,60 +107,45 @@ def execute_reduction(compilers_dict, exec_dirs, shader_name, ref, clean_dir, po
             all_crashed = False
         i += 1
     if all_crashed:
-        sys.exit(str(1000))
+        return str(1000)
     elif crash_flag:
-        sys.exit(str(1000 + cp_codes_crash))
+        return str(1000 + cp_codes_crash)
     elif timeout_flag:
-        sys.exit(str(2000 + cp_codes_timeout))
+        return str(2000 + cp_codes_timeout)
     print("No crash")
-    if ref != -1:
-        for compiler_name in compilers_dict.keys():
-            comparison_result = common.comparison_helper(
-                ["buffer_" + compiler_name + ".txt", exec_dirs.keptbufferdir + str(ref) + ".txt"])
+    buffers_compilers = {}
+    for compiler, buffer_file in zip(compilers, buffer_files):
+        buffers_compilers[buffer_file] = compiler
+    if ref_buffer != "":
+        for compiler, buffer_file in zip(compilers, buffer_files):
+            comparison_result = common.comparison_helper([buffer_file, ref_buffer])
             if len(comparison_result) == 2:
-                print("Buffer difference between test and reference result: " + compiler_name)
-                sys.exit(str(5000 + compilers[compiler_name].compilercode))
+                print("Buffer difference between test and reference result: " + compiler.name)
+                return str(5000 + compiler.compilercode)
         print("No difference between tests and references")
-    buffers = []
-    for compiler_name in compilers_dict.keys():
-        buffers.append("buffer_" + compiler_name + ".txt")
-    comparison_result = common.comparison_helper(buffers)
+    comparison_result = common.comparison_helper(buffer_files)
 
     if len(comparison_result) == 2:
         if len(comparison_result[0]) == 1 or len(comparison_result[1]) == 1:
             if len(comparison_result[0]) == 1:
-                compiler_name = comparison_result[0][0].split("_")[1].split(".")[0]
+                compiler = buffers_compilers[comparison_result[0][0]]
             else:
-                compiler_name = comparison_result[1][0].split("_")[1].split(".")[0]
-            if clean_dir:
-                common.clean_files(os.getcwd(), common.find_buffer_file(os.getcwd()))
-            sys.exit(str(3000 + 1 << compilers_dict[compiler_name].compilercode))
+                compiler = buffers_compilers[comparison_result[1][0]]
+            return str(3000 + 1 << compiler.compilercode)
         # Try if we are in the angle case
-        if (all(compilers_dict[buffer_name.split("_")[1].split(".")[0]].type == "angle"
-                for buffer_name in comparison_result[0])
-            and all(compilers_dict[buffer_name.split("_")[1].split(".")[0]].type == "independent"
-                    for buffer_name in comparison_result[1])) \
-                or (all(compilers_dict[buffer_name.split("_")[1].split(".")[0]].type == "angle"
-                        for buffer_name in comparison_result[1])
-                    and all(compilers_dict[buffer_name.split("_")[1].split(".")[0]].type == "independent"
+        if (all(buffers_compilers[buffer_name].type == "angle" for buffer_name in comparison_result[0])
+            and all(buffers_compilers[buffer_name].type == "independent" for buffer_name in comparison_result[1])) \
+                or (all(buffers_compilers[buffer_name].type == "angle" for buffer_name in comparison_result[1])
+                    and all(buffers_compilers[buffer_name].type == "independent"
                             for buffer_name in comparison_result[0])):
-            if clean_dir:
-                common.clean_files(os.getcwd(), common.find_buffer_file(os.getcwd()))
-            sys.exit(str(3099))
+            return str(3099)
         else:
-            if clean_dir:
-                common.clean_files(os.getcwd(), common.find_buffer_file(os.getcwd()))
-            sys.exit(str(4000) + " " + str(comparison_result))
+            return str(4000) + " " + str(comparison_result)
     elif len(comparison_result) >= 3:
-        if clean_dir:
-            common.clean_files(os.getcwd(), common.find_buffer_file(os.getcwd()))
-        sys.exit(str(4000) + " " + str(comparison_result))
+        return str(4000) + " " + str(comparison_result)
     else:
         print("No differences between implementations")
-        if clean_dir:
-            common.clean_files(os.getcwd(), common.find_buffer_file(os.getcwd()))
-        sys.stderr.write("0000")
-        sys.exit(0)
+        return "0000"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,231 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import fcntl
+import json
+import os
+import socket
+import sys
+import time
+
+import common
+import regression
+
+# Persistent queue of the kept shaders to reduce (stored in the keptshaders directory), one entry per kept shader:
+# state: pending, running, reduced, failed or skipped-timeout
+# size, classification (see regression.py) and kept_time: used to order the pending shaders
+# worker: host and pid of the worker reducing the shader, attempts: number of reductions started
+# heartbeat: last time the worker reducing the shader was known alive
+# The queue file is locked during each update so that several workers can take shaders from the same queue. Shaders
+# left running by a dead worker are pending again: the pid of the workers of the same host is checked, the shaders of
+# the other hosts are pending again once their heartbeat is older than HEARTBEAT_TIMEOUT seconds.
+QUEUE_FILE = "reduction_queue.json"
+STATES = ["pending", "running", "reduced", "failed", "skipped-timeout"]
+# smallest shader, rarest classification among the kept shaders, most recently kept shader
+PRIORITIES = ["size", "rarity", "newest"]
+HEARTBEAT_INTERVAL = 60
+HEARTBEAT_TIMEOUT = 600
+
+
+def get_worker_id():
+    return socket.gethostname() + ":" + str(os.getpid())
+
+
+def is_dead_worker(entry):
+    if time.time() - entry.get("heartbeat", entry.get("start_time", 0)) > HEARTBEAT_TIMEOUT:
+        return True
+    host, pid = entry["worker"].rsplit(":", 1)
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def get_priority_key(file, entry, order, class_counts):
+    key = []
+    for criterion in order:
+        if criterion == "size":
+            key.append(entry["size"])
+        elif criterion == "rarity":
+            key.append(class_counts[entry["classification"]])
+        elif criterion == "newest":
+            key.append(-entry["kept_time"])
+    return key + [file]
+
+
+class ReductionQueue:
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return {}
+        f = open(self.filename, "r")
+        entries = json.load(f)
+        f.close()
+        return entries
+
+    def save(self, entries):
+        g = open(self.filename + ".tmp", "w")
+        json.dump(entries, g, indent=1, sort_keys=True)
+        g.close()
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def update(self, function):
+        # Applies function to the entries under the queue lock and saves them
+        lock_file = open(self.filename + ".lock", "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            entries = self.load()
+            result = function(entries)
+            self.save(entries)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        return result
+
+    def refresh(self, keptshaderdir, kept_files, files_to_reduce):
+        # Indexes the new kept shaders, files_to_reduce being the kept shaders without reduced version
+        metadata = regression.load_metadata(keptshaderdir)
+        kept_files = set(kept_files)
+        files_to_reduce = set(files_to_reduce)
+
+        def index(entries):
+            for file in list(entries.keys()):
+                if file not in kept_files:
+                    del entries[file]
+                elif file not in files_to_reduce and entries[file]["state"] != "running":
+                    entries[file]["state"] = "reduced"
+            for file in files_to_reduce:
+                if file in entries:
+                    continue
+                file_metadata = metadata.get(file, {})
+                entries[file] = {"state": "pending", "size": os.path.getsize(keptshaderdir + file),
+                                 "classification": file_metadata.get("classification", "unknown"),
+                                 "kept_time": file_metadata.get("kept_time",
+                                                                os.path.getmtime(keptshaderdir + file)),
+                                 "worker": "", "attempts": 0}
+            return len(entries)
+        return self.update(index)
+
+    def claim(self, order, states=("pending",), excluded=()):
+        # Marks the first shader in priority order as running and returns its name (None if nothing is left)
+        worker = get_worker_id()
+
+        def take(entries):
+            class_counts = {}
+            for file, entry in entries.items():
+                class_counts[entry["classification"]] = class_counts.get(entry["classification"], 0) + 1
+                if entry["state"] == "running" and is_dead_worker(entry):
+                    print("Worker " + entry["worker"] + " died, " + file + " is pending again")
+                    entry["state"] = "pending"
+            candidates = [file for file, entry in entries.items() if entry["state"] in states
+                          and file not in excluded]
+            if not candidates:
+                return None
+            file = min(candidates, key=lambda candidate: get_priority_key(candidate, entries[candidate], order,
+                                                                          class_counts))
+            entries[file]["state"] = "running"
+            entries[file]["worker"] = worker
+            entries[file]["attempts"] += 1
+            entries[file]["start_time"] = time.time()
+            entries[file]["heartbeat"] = entries[file]["start_time"]
+            return file
+        return self.update(take)
+
+    def keep_alive(self, file, stop_event):
+        # Updates the heartbeat of a shader claimed by this worker until stop_event is set (to run in a thread)
+        worker = get_worker_id()
+
+        def beat(entries):
+            if file in entries and entries[file]["worker"] == worker:
+                entries[file]["heartbeat"] = time.time()
+        while not stop_event.wait(HEARTBEAT_INTERVAL):
+            self.update(beat)
+
+    def complete(self, file, state):
+        def finish(entries):
+            if file in entries:
+                entries[file]["state"] = state
+                entries[file]["worker"] = ""
+                entries[file]["duration"] = time.time() - entries[file]["start_time"]
+        self.update(finish)
+
+    def reset(self, states):
+        def to_pending(entries):
+            count = 0
+            for entry in entries.values():
+                if entry["state"] in states:
+                    entry["state"] = "pending"
+                    count += 1
+            return count
+        return self.update(to_pending)
+
+    def get_counts(self):
+        entries = self.load()
+        return {state: len([entry for entry in entries.values() if entry["state"] == state]) for state in STATES}
+
+
+def parse_priority(priority):
+    order = [criterion.strip() for criterion in priority.split(",") if criterion.strip() != ""]
+    for criterion in order:
+        if criterion not in PRIORITIES:
+            exit("Unknown priority " + criterion + ", please use a list of " + ", ".join(PRIORITIES))
+    return order
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the reduction queue of the kept shaders")
+    parser.add_argument('--config-file', dest='config', default="config.xml",
+                        help="specify a different configuration file from the default")
+    parser.add_argument('--queue-file', dest='queue_file', default="",
+                        help="specify the queue file (by default: " + QUEUE_FILE + " in the keptshaders directory)")
+    parser.add_argument('--priority', dest='priority', default="rarity,size",
+                        help="order in which the pending shaders are listed (see --priority of automate_reducer.py)")
+    parser.add_argument('--reset', dest='reset', nargs="+", default=[], choices=STATES,
+                        help="set the shaders in these states back to pending")
+    parser.add_argument('--list', dest='list', action="store_true", help="list the pending shaders in priority order")
+    ns = parser.parse_args(sys.argv[1:])
+    exec_dirs = common.load_dir_settings(ns.config)
+    os.chdir(exec_dirs.execdir)
+    queue_file = ns.queue_file
+    if queue_file == "":
+        queue_file = exec_dirs.keptshaderdir + QUEUE_FILE
+    if not os.path.isfile(queue_file):
+        exit("No queue file " + queue_file)
+    reduction_queue = ReductionQueue(queue_file)
+    if ns.reset:
+        print(str(reduction_queue.reset(ns.reset)) + " shaders set back to pending")
+    for state, count in reduction_queue.get_counts().items():
+        print(state + ": " + str(count))
+    if ns.list:
+        order = parse_priority(ns.priority)
+        entries = reduction_queue.load()
+        class_counts = {}
+        for entry in entries.values():
+            class_counts[entry["classification"]] = class_counts.get(entry["classification"], 0) + 1
+        pending = [file for file, entry in entries.items() if entry["state"] == "pending"]
+        for file in sorted(pending, key=lambda file: get_priority_key(file, entries[file], order, class_counts)):
+            print("    " + file + " (" + str(entries[file]["size"]) + " bytes, "
+                  + entries[file]["classification"] + ")")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import batch_journal
+import common
+import scheduler
+
+# Metadata of the kept shaders (stored in the keptshaders directory), one entry per kept or reduced shader file:
+# classification: divergence of the buffers (conform, the name of the single differing compiler, angle or
+#                 more_than_two, see common.classify_divergence)
+# outcomes: status of each compiler (no_crash, crash, timeout) when known
+# status: kept, fixed, still_failing or new_behaviour (result of the last regression run)
+# history: previous regression results
+# The newly kept shaders are appended to a log (one json line per shader) merged into the metadata file by the next
+# save or once the log exceeds METADATA_LOG_MAX_SIZE bytes.
+METADATA_FILE = "kept_metadata.json"
+METADATA_LOG_FILE = "kept_metadata.jsonl"
+METADATA_LOG_MAX_SIZE = 1024 * 1024
+metadata_lock = threading.Lock()
+
+
+def lock_metadata_file(keptshaderdir):
+    # Lock between the processes writing the metadata (e.g. the timeout lane), to release with unlock_metadata_file
+    lock_file = open(keptshaderdir + METADATA_FILE + ".lock", "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def unlock_metadata_file(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+
+def load_metadata(keptshaderdir):
+    metadata = {}
+    if os.path.isfile(keptshaderdir + METADATA_FILE):
+        f = open(keptshaderdir + METADATA_FILE, "r")
+        metadata = json.load(f)
+        f.close()
+    if os.path.isfile(keptshaderdir + METADATA_LOG_FILE):
+        f = open(keptshaderdir + METADATA_LOG_FILE, "r")
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Line left incomplete by a killed process
+                continue
+            metadata[record["file"]] = record["metadata"]
+        f.close()
+    return metadata
+
+
+def save_metadata(keptshaderdir, metadata):
+    # The log is merged in metadata by load_metadata, to call with the metadata file locked
+    tmp_file = keptshaderdir + METADATA_FILE + ".tmp"
+    g = open(tmp_file, "w")
+    json.dump(metadata, g, indent=1, sort_keys=True)
+    g.close()
+    os.replace(tmp_file, keptshaderdir + METADATA_FILE)
+    common.clean_files(keptshaderdir, [METADATA_LOG_FILE])
+
+
+def update_metadata(keptshaderdir, function):
+    # Applies function to the current metadata and saves it
+    with metadata_lock:
+        lock_file = lock_metadata_file(keptshaderdir)
+        try:
+            metadata = load_metadata(keptshaderdir)
+            function(metadata)
+            save_metadata(keptshaderdir, metadata)
+        finally:
+            unlock_metadata_file(lock_file)
+
+
+def record_kept_shader(keptshaderdir, file, classification, outcomes=None):
+    entry = {"classification": classification, "status": "kept", "kept_time": time.time(), "history": []}
+    if outcomes is not None:
+        entry["outcomes"] = outcomes
+    with metadata_lock:
+        lock_file = lock_metadata_file(keptshaderdir)
+        try:
+            g = open(keptshaderdir + METADATA_LOG_FILE, "a")
+            g.write(json.dumps({"file": file, "metadata": entry}) + "\n")
+            g.close()
+            compact = os.path.getsize(keptshaderdir + METADATA_LOG_FILE) > METADATA_LOG_MAX_SIZE
+        finally:
+            unlock_metadata_file(lock_file)
+    if compact:
+        update_metadata(keptshaderdir, lambda metadata: None)
+
+
+def get_classification(groups, compilers_dict):
+    if len(groups) <= 1:
+        return "conform"
+    return common.classify_divergence(groups, compilers_dict)
+
+
+def get_original_name(file):
+    # Reduced shaders (SEED_reduced.shadertrap) share the buffers and metadata of their original shader
+    return file.split("_")[0].split(".")[0] + ".shadertrap"
+
+
+def get_kept_classification(exec_dirs, file, compilers, compilers_dict):
+    # Classification of the shaders kept without metadata, rebuilt from the kept buffers
+    seed = get_original_name(file).split(".")[0]
+    buffer_files = [exec_dirs.keptbufferdir + compiler.name + "_" + seed + ".txt" for compiler in compilers]
+    if not all(os.path.isfile(buffer_file) for buffer_file in buffer_files):
+        return None
+    buffers_compilers = {}
+    for compiler, buffer_file in zip(compilers, buffer_files):
+        buffers_compilers[buffer_file] = compiler.name
+    groups = [[buffers_compilers[buffer_file] for buffer_file in group]
+              for group in common.comparison_helper(buffer_files)]
+    return get_classification(groups, compilers_dict)
+
+
+def get_baseline(exec_dirs, metadata, file, compilers, compilers_dict):
+    if file in metadata:
+        return metadata[file]
+    if get_original_name(file) in metadata:
+        return metadata[get_original_name(file)]
+    classification = get_kept_classification(exec_dirs, file, compilers, compilers_dict)
+    if classification is None:
+        return None
+    return {"classification": classification, "status": "kept", "history": []}
+
+
+def compare_to_baseline(baseline, classification, outcomes):
+    if classification == "conform" and all(outcome == "no_crash" for outcome in outcomes.values()):
+        return "fixed"
+    if baseline is None:
+        return "new_behaviour"
+    if baseline["classification"] == classification \
+            and ("outcomes" not in baseline or baseline["outcomes"] == outcomes):
+        return "still_failing"
+    return "new_behaviour"
+
+
+def get_postprocessed_harness(graphicsfuzz, shader_file, postprocessing_cache):
+    # Post-processing does not depend on the drivers: the post-processed harnesses are kept by source hash
+    f = open(shader_file, "rb")
+    source_hash = hashlib.sha256(f.read()).hexdigest()
+    f.close()
+    os.makedirs(postprocessing_cache, exist_ok=True)
+    harness_file = os.path.join(postprocessing_cache, source_hash + ".shadertrap")
+    if not os.path.isfile(harness_file):
+        tmp_file = harness_file + "." + str(threading.get_ident()) + ".tmp"
+        if not common.postprocess_shader(graphicsfuzz, shader_file, tmp_file):
+            return None
+        os.replace(tmp_file, harness_file)
+    return harness_file
+
+
+def run_regression(compilers, exec_dirs, files, jobs, timeout=10, postprocessing_cache="postprocessed/"):
+    # Re-executes the kept shaders on the current compilers and compares them to their stored classification
+    compilers_dict = {}
+    for compiler in compilers:
+        compilers_dict[compiler.name] = compiler
+    metadata = load_metadata(exec_dirs.keptshaderdir)
+    buffer_dir = os.path.abspath("regression_buffers") + "/"
+    os.makedirs(buffer_dir, exist_ok=True)
+    report = {"fixed": [], "still_failing": [], "new_behaviour": [], "not_executed": []}
+    run_time = time.time()
+
+    def prepare(file):
+        return get_postprocessed_harness(exec_dirs.graphicsfuzz, exec_dirs.keptshaderdir + file,
+                                         postprocessing_cache)
+
+    def execute(file, harness_file, compiler, job_dir):
+        return common.execute_compiler(compiler, exec_dirs.shadertrap, harness_file, file,
+                                       common.get_buffer_name(compiler, file.split(".")[0]), buffer_dir, False,
+                                       timeout, cwd=job_dir)
+
+    def finish(file, harness_file, results):
+        if harness_file is None:
+            report["not_executed"].append(file)
+            return
+        buffer_files = [buffer_dir + common.get_buffer_name(compiler, file.split(".")[0]) for compiler in compilers]
+        buffers_compilers = {}
+        for compiler, buffer_file in zip(compilers, buffer_files):
+            buffers_compilers[buffer_file] = compiler.name
+        groups = [[buffers_compilers[buffer_file] for buffer_file in group]
+                  for group in common.comparison_helper(buffer_files)]
+        common.clean_files(buffer_dir, [os.path.basename(buffer_file) for buffer_file in buffer_files])
+        classification = get_classification(groups, compilers_dict)
+        outcomes = {}
+        for compiler in compilers:
+            outcomes[compiler.name] = batch_journal.get_compiler_status(results[compiler.name])
+        baseline = get_baseline(exec_dirs, metadata, file, compilers, compilers_dict)
+        status = compare_to_baseline(baseline, classification, outcomes)
+        with metadata_lock:
+            report[status].append(file)
+            entry = metadata.get(file)
+            if entry is None:
+                entry = {"classification": classification if baseline is None else baseline["classification"],
+                         "status": "kept", "history": []}
+                metadata[file] = entry
+            entry["history"].append({"time": run_time, "classification": classification, "outcomes": outcomes,
+                                     "status": status})
+            entry["status"] = status
+            # The stored classification follows the current behaviour of the drivers
+            if status != "fixed":
+                entry["classification"] = classification
+                entry["outcomes"] = outcomes
+
+    scheduler.BatchScheduler(compilers, jobs).run(files, prepare, execute, finish)
+    shutil.rmtree(buffer_dir, ignore_errors=True)
+
+    def merge(current_metadata):
+        # Merge with the shaders kept while the regression was running
+        current_metadata.update({file: metadata[file] for file in files if file in metadata})
+
+    update_metadata(exec_dirs.keptshaderdir, merge)
+    for status in report:
+        report[status].sort()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-execute the kept and reduced shaders against the current "
+                                                 "compilers and report the fixed and still failing shaders")
+    parser.add_argument('--config-file', dest='config', default="config.xml",
+                        help="specify a different configuration file from the default")
+    parser.add_argument('--shaders', dest='shaders', nargs="+", default=[],
+                        help="Restrict the regression to these files of the keptshaders directory")
+    parser.add_argument('--shaders-file', dest='shaders_file', default="",
+                        help="Restrict the regression to the files of the keptshaders directory listed in this file, "
+                             "one per line (e.g. the smoke corpus, see smoke_corpus.py)")
+    parser.add_argument('--jobs', dest='jobs', default=os.cpu_count(), type=int,
+                        help="Number of concurrent executions, each compiler being limited to its max_slots setting "
+                             "(by default: the number of cpus)")
+    parser.add_argument('--timeout', dest='timeout', default=10, type=int,
+                        help="Timeout of an execution in seconds (by default: 10)")
+    parser.add_argument('--postprocessing-cache', dest='postprocessingcache', default="postprocessed/",
+                        help="Directory keeping the post-processed harnesses across runs (by default: postprocessed/ "
+                             "in the execution directory)")
+    parser.add_argument('--report', dest='report', default="regression_report.json",
+                        help="Specify the json report file (by default: regression_report.json in the execution "
+                             "directory)")
+    ns = parser.parse_args(sys.argv[1:])
+    exec_dirs = common.load_dir_settings(ns.config)
+    compilers = common.load_compilers_settings(ns.config)
+    if ns.shaders_file != "":
+        ns.shaders_file = os.path.abspath(ns.shaders_file)
+    os.chdir(exec_dirs.execdir)
+    files = ns.shaders
+    if ns.shaders_file != "":
+        f = open(ns.shaders_file, "r")
+        files += [line.strip() for line in f if line.strip() != ""]
+        f.close()
+    if not files:
+        files = sorted([file for file in os.listdir(exec_dirs.keptshaderdir) if file.endswith(".shadertrap")])
+    start = time.time()
+    report = run_regression(compilers, exec_dirs, files, ns.jobs, ns.timeout, ns.postprocessingcache)
+    g = open(ns.report, "w")
+    json.dump(report, g, indent=1)
+    g.close()
+    for status in ["fixed", "still_failing", "new_behaviour", "not_executed"]:
+        print(status + ": " + str(len(report[status])))
+        if status != "still_failing":
+            for file in report[status]:
+                print("    " + file)
+    print("Regression of " + str(len(files)) + " shaders done in " + str(round(time.time() - start, 1)) + "s")
+
+
+if __name__ == "__main__":
+    main()
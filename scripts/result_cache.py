@@ -0,0 +1,213 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# Persistent cache of the execution results: the outcome and the combined buffer of a post-processed shader are
+# stored per compiler fingerprint (compiler settings, driver files and their modification times). Entries of a
+# compiler are dropped as soon as its fingerprint changes (new driver build) and the least recently used entries are
+# evicted when the cache exceeds its maximum size. Only successful executions are cached: timeouts depend on the
+# machine load and crashes are re-run to check that they still reproduce.
+# The total size of the entries is kept up to date by triggers in the cache_size table, so that a store only reads it
+# instead of summing the sizes of every entry.
+
+# A full cache is trimmed below this ratio of its maximum size so that it is not trimmed again on the next store
+EVICTION_RATIO = 0.9
+
+cache = None
+
+
+class ResultCache:
+    def __init__(self, filename, max_size=1024 * 1024 * 1024):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        # The rows replaced by INSERT OR REPLACE only fire the delete trigger with recursive triggers
+        self.connection.execute("PRAGMA recursive_triggers = ON")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (shader_hash TEXT, compiler TEXT, "
+                                "fingerprint TEXT, outcome TEXT, buffer_digest TEXT, buffer BLOB, size INTEGER, "
+                                "last_used REAL, PRIMARY KEY (shader_hash, compiler, fingerprint))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache_size (total INTEGER)")
+        self.connection.execute("CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results BEGIN "
+                                "UPDATE cache_size SET total = total + new.size; END")
+        self.connection.execute("CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results BEGIN "
+                                "UPDATE cache_size SET total = total - old.size; END")
+        # Caches created before the size table get their total once
+        self.connection.execute("INSERT INTO cache_size SELECT COALESCE(SUM(size), 0) FROM results "
+                                "WHERE NOT EXISTS (SELECT 1 FROM cache_size)")
+        self.connection.commit()
+
+    def get_fingerprint(self, compiler, shadertrap):
+        # Computed once per batch (see reset_fingerprints), stale entries of the compiler are invalidated
+        with self.lock:
+            if compiler.name not in self.fingerprints:
+                fingerprint = compute_fingerprint(compiler, shadertrap)
+                self.connection.execute("DELETE FROM results WHERE compiler = ? AND fingerprint != ?",
+                                        (compiler.name, fingerprint))
+                self.connection.commit()
+                self.fingerprints[compiler.name] = fingerprint
+            return self.fingerprints[compiler.name]
+
+    def reset_fingerprints(self):
+        with self.lock:
+            self.fingerprints = {}
+
+    def lookup(self, compiler, shadertrap, shader_file):
+        # Returns (outcome, buffer content) or None
+        key = (get_shader_hash(shader_file), compiler.name, self.get_fingerprint(compiler, shadertrap))
+        with self.lock:
+            row = self.connection.execute("SELECT outcome, buffer FROM results WHERE shader_hash = ? AND "
+                                          "compiler = ? AND fingerprint = ?", key).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE results SET last_used = ? WHERE shader_hash = ? AND compiler = ? AND "
+                                    "fingerprint = ?", (time.time(),) + key)
+            self.connection.commit()
+        return row[0], bytes(row[1])
+
+    def store(self, compiler, shadertrap, shader_file, outcome, buffer_file):
+        if outcome != "no_crash" or not os.path.isfile(buffer_file):
+            return
+        f = open(buffer_file, "rb")
+        buffer = f.read()
+        f.close()
+        key = (get_shader_hash(shader_file), compiler.name, self.get_fingerprint(compiler, shadertrap))
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    key + (outcome, hashlib.sha256(buffer).hexdigest(), sqlite3.Binary(buffer),
+                                           len(buffer) + len(outcome), time.time()))
+            self.evict()
+            self.connection.commit()
+
+    def get_total_size(self):
+        return self.connection.execute("SELECT total FROM cache_size").fetchone()[0]
+
+    def evict(self):
+        total = self.get_total_size()
+        if total <= self.max_size:
+            return
+        evicted = []
+        for rowid, size in self.connection.execute("SELECT rowid, size FROM results ORDER BY last_used"):
+            if total <= self.max_size * EVICTION_RATIO:
+                break
+            evicted.append((rowid,))
+            total -= size
+        self.connection.executemany("DELETE FROM results WHERE rowid = ?", evicted)
+
+    def get_stats(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT compiler, COUNT(*), COALESCE(SUM(size), 0) FROM results "
+                                           "GROUP BY compiler").fetchall()
+        return {compiler: {"entries": count, "size": size} for compiler, count, size in rows}
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM results")
+            self.connection.commit()
+            self.connection.execute("VACUUM")
+
+    def close(self):
+        self.connection.close()
+
+
+def get_shader_hash(shader_file):
+    f = open(shader_file, "rb")
+    shader_hash = hashlib.sha256(f.read()).hexdigest()
+    f.close()
+    return shader_hash
+
+
+def get_file_signature(path):
+    if not os.path.isfile(path):
+        return path + ":missing"
+    stat = os.stat(path)
+    return path + ":" + str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+
+
+def compute_fingerprint(compiler, shadertrap):
+    # Settings of the compiler and signature of the files defining the driver build
+    signatures = [compiler.name, compiler.renderer, compiler.type, compiler.ldpath, compiler.vkfilename,
+                  compiler.executor, compiler.executor_command] + compiler.otherenvs
+    signatures.append(get_file_signature(os.path.abspath(shadertrap)))
+    for library_dir in compiler.ldpath.strip().split(":"):
+        if library_dir != "" and os.path.isdir(library_dir):
+            for file in sorted(os.listdir(library_dir)):
+                if ".so" in file:
+                    signatures.append(get_file_signature(os.path.join(library_dir, file)))
+    for icd_file in compiler.vkfilename.strip().split(":"):
+        if icd_file == "":
+            continue
+        signatures.append(get_file_signature(icd_file))
+        # The ICD manifest points to the Vulkan driver library
+        try:
+            f = open(icd_file, "r")
+            library_path = json.load(f)["ICD"]["library_path"]
+            f.close()
+            signatures.append(get_file_signature(os.path.join(os.path.dirname(icd_file), library_path)))
+        except (OSError, ValueError, KeyError):
+            pass
+    return hashlib.sha256("\n".join(signatures).encode()).hexdigest()
+
+
+def open_cache(filename, max_size_mb=1024):
+    global cache
+    if filename == "":
+        return
+    cache = ResultCache(filename, max_size_mb * 1024 * 1024)
+
+
+def lookup(compiler, shadertrap, shader_file):
+    if cache is None:
+        return None
+    return cache.lookup(compiler, shadertrap, shader_file)
+
+
+def store(compiler, shadertrap, shader_file, outcome, buffer_file):
+    if cache is not None:
+        cache.store(compiler, shadertrap, shader_file, outcome, buffer_file)
+
+
+def reset_fingerprints():
+    if cache is not None:
+        cache.reset_fingerprints()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or clear the execution result cache")
+    parser.add_argument("--cache-file", dest="cache_file", default="result_cache.sqlite",
+                        help="specify the cache file (by default: result_cache.sqlite)")
+    parser.add_argument("--clear", dest="clear", action="store_true", help="remove every entry of the cache")
+    ns = parser.parse_args(sys.argv[1:])
+    if not os.path.isfile(ns.cache_file):
+        exit("No cache file " + ns.cache_file)
+    result_cache = ResultCache(ns.cache_file)
+    if ns.clear:
+        result_cache.clear()
+        print("Cache cleared")
+    for compiler, stats in result_cache.get_stats().items():
+        print(compiler + ": " + str(stats["entries"]) + " entries, " + str(stats["size"]) + " bytes")
+    result_cache.close()
+
+
+if __name__ == "__main__":
+    main()
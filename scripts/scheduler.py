@@ -0,0 +1,129 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import os
+import shutil
+import tempfile
+import threading
+
+
+# Schedules the execution of a batch on a pool of workers:
+# - each unit (a shader or a pack of shaders) is first prepared (post-processing) then executed on every compiler
+# - a compiler never runs more than max_slots executions at the same time, the variants of a driver (same family)
+#   share these slots
+# - the executions of the oldest unit are run first (most costly families first) so that all the results of a shader
+#   are available as early as possible, free workers take the next executable job to keep every driver busy
+# - the executions of a unit are grouped by family: the variants of a driver are queued next to each other and take the
+#   slots of the family in turn, so that they run the shader close together while the caches of the driver are warm
+#   (strictly one after the other only when max_slots is 1)
+# - units are prepared ahead of time (at most lookahead units waiting for their executions)
+class BatchScheduler:
+    def __init__(self, compilers, nb_workers, lookahead=0):
+        self.compilers = compilers
+        self.nb_workers = nb_workers
+        self.lookahead = lookahead if lookahead > 0 else nb_workers
+        self.condition = threading.Condition()
+        self.running = {}
+        family_costs = {}
+        family_indices = {}
+        for compiler_index, compiler in enumerate(compilers):
+            self.running[compiler.family] = 0
+            family_costs[compiler.family] = max(family_costs.get(compiler.family, compiler.cost), compiler.cost)
+            family_indices.setdefault(compiler.family, compiler_index)
+        # Order of the executions of a unit: most costly families first, the variants of a family together
+        self.job_orders = [(-family_costs[compiler.family], family_indices[compiler.family], compiler_index)
+                           for compiler_index, compiler in enumerate(compilers)]
+        self.units_to_prepare = []
+        self.ready_jobs = []
+        self.pending_units = 0
+        self.results = {}
+        self.prepared = {}
+        self.active_jobs = 0
+
+    def next_job(self):
+        # Executions of the already prepared units first, in priority order
+        for position, (unit_index, _, _, compiler_index) in enumerate(self.ready_jobs):
+            compiler = self.compilers[compiler_index]
+            if self.running[compiler.family] < compiler.max_slots:
+                del self.ready_jobs[position]
+                self.running[compiler.family] += 1
+                return "execute", unit_index, compiler
+        # Then prepare the next unit if not too many units are waiting
+        if self.units_to_prepare and self.pending_units < self.lookahead:
+            self.pending_units += 1
+            return "prepare", self.units_to_prepare.pop(0), None
+        return None
+
+    def is_finished(self):
+        return not self.units_to_prepare and not self.ready_jobs and self.active_jobs == 0
+
+    def worker(self, units, prepare, execute, finish):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None and not self.is_finished():
+                    self.condition.wait()
+                    job = self.next_job()
+                if job is None:
+                    self.condition.notify_all()
+                    return
+                self.active_jobs += 1
+            kind, unit_index, compiler = job
+            unit = units[unit_index]
+            if kind == "prepare":
+                try:
+                    prepared = prepare(unit)
+                except Exception as e:
+                    print("Preparation of " + str(unit) + " failed: " + str(e))
+                    prepared = None
+                with self.condition:
+                    self.prepared[unit_index] = prepared
+                    self.results[unit_index] = {}
+                    if prepared is not None:
+                        for job_order in self.job_orders:
+                            bisect.insort(self.ready_jobs, (unit_index,) + job_order)
+                done = prepared is None
+            else:
+                job_dir = tempfile.mkdtemp(prefix="job_", dir=os.getcwd())
+                try:
+                    result = execute(unit, self.prepared[unit_index], compiler, job_dir)
+                except Exception as e:
+                    result = "Execution error with " + compiler.name + ": " + str(e)
+                shutil.rmtree(job_dir, ignore_errors=True)
+                with self.condition:
+                    self.running[compiler.family] -= 1
+                    self.results[unit_index][compiler.name] = result
+                    done = len(self.results[unit_index]) == len(self.compilers)
+            if done:
+                finish(unit, self.prepared[unit_index], self.results[unit_index])
+            with self.condition:
+                if done:
+                    self.pending_units -= 1
+                    del self.prepared[unit_index]
+                    del self.results[unit_index]
+                self.active_jobs -= 1
+                self.condition.notify_all()
+
+    def run(self, units, prepare, execute, finish):
+        # prepare(unit) returns the prepared unit (None on failure), execute(unit, prepared, compiler, job_dir)
+        # returns the result of a compiler, finish(unit, prepared, results per compiler name) is called once all the
+        # executions of a unit are done
+        self.units_to_prepare = list(range(len(units)))
+        workers = [threading.Thread(target=self.worker, args=(units, prepare, execute, finish))
+                   for _ in range(self.nb_workers)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
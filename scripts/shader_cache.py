@@ -0,0 +1,238 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import atexit
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+# Policies of the on-disk shader caches of the drivers (Mesa, NVIDIA and the caches written under XDG_CACHE_HOME, e.g.
+# by ANGLE), chosen per compiler with the shader_cache setting of the config file:
+# unset: the driver default, usually a cache growing in $HOME which can serve binaries compiled by an older build
+# disabled: the caches are turned off, every execution compiles the shader
+# isolated: an empty cache directory per run and driver family, removed at the end of the run
+# shared: a warm cache directory per driver family kept across runs (on tmpfs by default), trimmed to shader_cache_size
+# The variants of a driver share its cache directory, the drivers include their debug flags in the cache keys.
+# The directories are prepared on the first execution of each compiler. The duration of the executions is accumulated
+# per compiler and appended with the policy to a statistics file after each batch to compare the policies.
+
+POLICIES = ["disabled", "isolated", "shared"]
+DEFAULT_SIZE = "1G"
+STATS_FILE = "shader_cache_stats.jsonl"
+SIZE_UNITS = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+
+lock = threading.Lock()
+# Environment variables and cache directory (None if disabled) of each prepared compiler
+prepared = {}
+# Isolated cache directories of this run
+run_dirs = set()
+# Number of executions and total duration per compiler since the last batch
+durations = {}
+
+
+def get_default_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm/glslsmith_shader_cache/"
+    return os.path.join(tempfile.gettempdir(), "glslsmith_shader_cache", "")
+
+
+def get_base_dir(compiler):
+    if compiler.shader_cache_dir != "":
+        return os.path.join(os.path.abspath(compiler.shader_cache_dir), "")
+    return get_default_dir()
+
+
+def get_run_name():
+    return "run_" + socket.gethostname() + "_" + str(os.getpid())
+
+
+def parse_size(size):
+    # Sizes as given to MESA_SHADER_CACHE_MAX_SIZE: a number with a K, M or G suffix (G if omitted)
+    size = size.strip().upper()
+    if size[-1:] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(float(size) * SIZE_UNITS["G"])
+
+
+def clean_dead_runs(base_dir):
+    # Removes the isolated caches left by killed runs of this host
+    if not os.path.isdir(base_dir):
+        return
+    prefix = "run_" + socket.gethostname() + "_"
+    for entry in os.listdir(base_dir):
+        if not entry.startswith(prefix) or not entry[len(prefix):].isdigit():
+            continue
+        try:
+            os.kill(int(entry[len(prefix):]), 0)
+        except ProcessLookupError:
+            shutil.rmtree(base_dir + entry, ignore_errors=True)
+        except PermissionError:
+            pass
+
+
+@atexit.register
+def clean_run_caches():
+    for run_dir in run_dirs:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    run_dirs.clear()
+
+
+def prepare(compiler):
+    # Returns the environment variables of the cache policy of the compiler and its cache directory
+    if compiler.shader_cache == "disabled":
+        # A cache home which cannot be created disables the caches of the other drivers
+        return ["MESA_SHADER_CACHE_DISABLE=true", "MESA_GLSL_CACHE_DISABLE=true", "__GL_SHADER_DISK_CACHE=0",
+                "XDG_CACHE_HOME=/dev/null"], None
+    base_dir = get_base_dir(compiler)
+    if compiler.shader_cache == "shared":
+        cache_dir = base_dir + "shared/" + compiler.family + "/"
+    else:
+        clean_dead_runs(base_dir)
+        run_dirs.add(base_dir + get_run_name())
+        cache_dir = base_dir + get_run_name() + "/" + compiler.family + "/"
+    os.makedirs(cache_dir, exist_ok=True)
+    size = get_size(compiler)
+    return ["MESA_SHADER_CACHE_DIR=" + cache_dir, "MESA_SHADER_CACHE_MAX_SIZE=" + size,
+            "__GL_SHADER_DISK_CACHE_PATH=" + cache_dir, "__GL_SHADER_DISK_CACHE_SIZE=" + str(parse_size(size)),
+            "XDG_CACHE_HOME=" + cache_dir], cache_dir
+
+
+def get_size(compiler):
+    if compiler.shader_cache_size != "":
+        return compiler.shader_cache_size
+    return DEFAULT_SIZE
+
+
+def get_cache_envs(compiler):
+    # Environment variables added by common.build_env_from_compiler
+    if compiler.shader_cache == "":
+        return []
+    with lock:
+        if compiler.name not in prepared:
+            prepared[compiler.name] = prepare(compiler)
+        return prepared[compiler.name][0]
+
+
+def record_execution(compiler, duration):
+    with lock:
+        count, total = durations.get(compiler.name, (0, 0.0))
+        durations[compiler.name] = (count + 1, total + duration)
+
+
+def get_dir_size(directory):
+    size = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return size
+
+
+def trim_cache(cache_dir, max_size):
+    # Removes the least recently modified files until the cache fits in its size (drivers without their own limit)
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for file in files:
+            try:
+                stat = os.stat(os.path.join(root, file))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def end_batch(compilers, batch_nb, stats_file=STATS_FILE):
+    # Trims the shared caches, prints and records the execution times of the batch per compiler and policy
+    with lock:
+        batch_durations = dict(durations)
+        durations.clear()
+    g = open(stats_file, "a")
+    for compiler in compilers:
+        count, total = batch_durations.get(compiler.name, (0, 0.0))
+        cache_dir = prepared.get(compiler.name, ([], None))[1]
+        entry = {"time": time.time(), "batch": batch_nb, "compiler": compiler.name,
+                 "policy": compiler.shader_cache if compiler.shader_cache != "" else "default", "executions": count,
+                 "duration": round(total, 3)}
+        if cache_dir is not None:
+            if compiler.shader_cache == "shared":
+                entry["trimmed_files"] = trim_cache(cache_dir, parse_size(get_size(compiler)))
+            entry["cache_size"] = get_dir_size(cache_dir)
+        g.write(json.dumps(entry) + "\n")
+        if count > 0:
+            print("Shader cache " + entry["policy"] + " of " + compiler.name + ": " + str(count) + " executions, "
+                  + str(round(total / count, 3)) + "s per execution"
+                  + ("" if cache_dir is None else ", " + str(entry["cache_size"] // 1024) + "KB cached"))
+    g.close()
+
+
+def summarize(stats_file):
+    # Mean execution time per compiler and policy over every recorded batch
+    totals = {}
+    f = open(stats_file, "r")
+    for line in f:
+        if line.strip() == "":
+            continue
+        entry = json.loads(line)
+        key = (entry["compiler"], entry["policy"])
+        count, total = totals.get(key, (0, 0.0))
+        totals[key] = (count + entry["executions"], total + entry["duration"])
+    f.close()
+    for (compiler, policy), (count, total) in sorted(totals.items()):
+        if count == 0:
+            continue
+        print(compiler + " (" + policy + "): " + str(count) + " executions, " + str(round(total / count, 3))
+              + "s per execution, " + str(round(count * 3600 / max(total, 0.001))) + " executions/h")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the execution times of the shader cache policies or remove "
+                                                 "the shader caches")
+    parser.add_argument("--stats-file", dest="stats_file", default=STATS_FILE,
+                        help="specify the statistics file (by default: " + STATS_FILE + ")")
+    parser.add_argument("--clean-dir", dest="clean_dir", default="",
+                        help="remove the shared caches and the caches of dead runs in this directory (e.g. "
+                             + get_default_dir() + ")")
+    ns = parser.parse_args(sys.argv[1:])
+    if ns.clean_dir != "":
+        base_dir = os.path.join(ns.clean_dir, "")
+        clean_dead_runs(base_dir)
+        shutil.rmtree(base_dir + "shared", ignore_errors=True)
+        print("Shader caches of " + base_dir + " removed")
+        return
+    if not os.path.isfile(ns.stats_file):
+        exit("No statistics file " + ns.stats_file)
+    summarize(ns.stats_file)
+
+
+if __name__ == "__main__":
+    main()
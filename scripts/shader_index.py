@@ -0,0 +1,250 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import common
+import regression
+
+# Search index of the kept, reduced and partially reduced shaders (sqlite file in the keptshaders directory):
+# shader_text: full-text index (sqlite FTS5) of the token sequence of each shader, the positions of the tokens answer
+#              n-gram and snippet queries, snippets are then matched exactly against the whitespace-normalized text
+# shaders: file, kind (kept, reduced, partial), size and modification time of the indexed file, classification and
+#          status from the kept metadata (see regression.py)
+# divergences: compilers outside the largest group of agreeing compilers, computed from the kept buffers
+# The index is updated incrementally: only new or modified files are tokenized, removed files are dropped and the
+# metadata columns are refreshed when the metadata file changes. The files are only compared to the index when the
+# modification time of the directory changed (added, removed or renamed files) unless a rescan is requested.
+
+INDEX_FILE = "shader_index.sqlite"
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_]+|[^\sA-Za-z0-9_]")
+WORD_PATTERN = re.compile(r"[A-Za-z0-9_]+")
+KINDS = ["kept", "reduced", "partial"]
+
+
+def normalize(text):
+    # Tokens separated by single spaces (with leading and trailing spaces to match whole tokens)
+    return " " + " ".join(TOKEN_PATTERN.findall(text)) + " "
+
+
+def get_kind(file):
+    suffix = file[:-len(".shadertrap")].split("_")[-1] if "_" in file else ""
+    if suffix in KINDS:
+        return suffix
+    return "kept"
+
+
+def get_phrase(words):
+    return '"' + " ".join(words) + '"'
+
+
+class ShaderIndex:
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        # A persistent journal does not change the modification time of the directory of the index at each commit
+        self.connection.execute("PRAGMA journal_mode = PERSIST")
+        self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS shader_text USING fts5(content, "
+                                "tokenize = \"unicode61 tokenchars '_'\")")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shaders (id INTEGER PRIMARY KEY, file TEXT UNIQUE, "
+                                "kind TEXT, size INTEGER, mtime_ns INTEGER, classification TEXT, status TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS divergences (compiler TEXT, shader INTEGER, "
+                                "PRIMARY KEY (compiler, shader)) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def get_state(self, key):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def remove(self, shader_id):
+        self.connection.execute("DELETE FROM shader_text WHERE rowid = ?", (shader_id,))
+        self.connection.execute("DELETE FROM divergences WHERE shader = ?", (shader_id,))
+        self.connection.execute("DELETE FROM shaders WHERE id = ?", (shader_id,))
+
+    def add(self, exec_dirs, compilers, file, stat):
+        f = open(exec_dirs.keptshaderdir + file, "r", errors="replace")
+        content = normalize(f.read())
+        f.close()
+        cursor = self.connection.execute("INSERT INTO shaders (file, kind, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                                         (file, get_kind(file), stat.st_size, stat.st_mtime_ns))
+        shader_id = cursor.lastrowid
+        self.connection.execute("INSERT INTO shader_text (rowid, content) VALUES (?, ?)", (shader_id, content))
+        # Reduced shaders share the buffers of their original shader
+        seed = regression.get_original_name(file).split(".")[0]
+        buffers_compilers = {}
+        for compiler in compilers:
+            buffer_file = exec_dirs.keptbufferdir + compiler.name + "_" + seed + ".txt"
+            if os.path.isfile(buffer_file):
+                buffers_compilers[buffer_file] = compiler.name
+        groups = [[buffers_compilers[buffer_file] for buffer_file in group]
+                  for group in common.comparison_helper(list(buffers_compilers))]
+        self.connection.executemany("INSERT INTO divergences VALUES (?, ?)",
+                                    [(name, shader_id) for name in common.get_divergent_compilers(groups)])
+
+    def update(self, exec_dirs, compilers, rescan=False):
+        # Returns the number of (re)indexed and removed files
+        metadata_mtime = ""
+        for metadata_file in [regression.METADATA_FILE, regression.METADATA_LOG_FILE]:
+            metadata_file = exec_dirs.keptshaderdir + metadata_file
+            metadata_mtime += str(os.stat(metadata_file).st_mtime_ns) + ";" if os.path.isfile(metadata_file) else ";"
+        dir_mtime = ""
+        if os.path.isdir(exec_dirs.keptshaderdir):
+            dir_mtime = str(os.stat(exec_dirs.keptshaderdir).st_mtime_ns)
+        if not rescan and dir_mtime == self.get_state("dir_mtime") \
+                and metadata_mtime == self.get_state("metadata_mtime"):
+            return 0, 0
+        indexed = {}
+        for shader_id, file, size, mtime_ns in self.connection.execute("SELECT id, file, size, mtime_ns FROM shaders"):
+            indexed[file] = (shader_id, size, mtime_ns)
+        added = 0
+        files = set()
+        if os.path.isdir(exec_dirs.keptshaderdir):
+            for entry in os.scandir(exec_dirs.keptshaderdir):
+                if not entry.name.endswith(".shadertrap") or not entry.is_file():
+                    continue
+                files.add(entry.name)
+                stat = entry.stat()
+                if entry.name in indexed:
+                    shader_id, size, mtime_ns = indexed[entry.name]
+                    if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+                        continue
+                    self.remove(shader_id)
+                self.add(exec_dirs, compilers, entry.name, stat)
+                added += 1
+        removed = [shader_id for file, (shader_id, _, _) in indexed.items() if file not in files]
+        for shader_id in removed:
+            self.remove(shader_id)
+        if added > 0 or metadata_mtime != self.get_state("metadata_mtime"):
+            metadata = regression.load_metadata(exec_dirs.keptshaderdir)
+            rows = []
+            for shader_id, file in self.connection.execute("SELECT id, file FROM shaders").fetchall():
+                entry = metadata.get(regression.get_original_name(file), {})
+                rows.append((entry.get("classification", ""), entry.get("status", ""), shader_id))
+            self.connection.executemany("UPDATE shaders SET classification = ?, status = ? WHERE id = ?", rows)
+            self.connection.execute("INSERT OR REPLACE INTO state VALUES ('metadata_mtime', ?)", (metadata_mtime,))
+        self.connection.execute("INSERT OR REPLACE INTO state VALUES ('dir_mtime', ?)", (dir_mtime,))
+        self.connection.commit()
+        return added, len(removed)
+
+    def search(self, tokens=None, snippet="", divergent=None, classification="", status="", kind="", limit=0):
+        # Returns the (file, classification, status) of the matching shaders, every criterion must hold
+        conditions = []
+        params = []
+        text_queries = [get_phrase([token]) for token in (tokens or [])]
+        if snippet != "":
+            words = WORD_PATTERN.findall(snippet)
+            if words:
+                text_queries.append(get_phrase(words))
+        if text_queries:
+            conditions.append("s.id IN (SELECT rowid FROM shader_text WHERE shader_text MATCH ?"
+                              + (" AND instr(content, ?) > 0" if snippet != "" else "") + ")")
+            params.append(" AND ".join(text_queries))
+            if snippet != "":
+                params.append(normalize(snippet))
+        elif snippet != "":
+            # Snippets without identifiers or numbers are only matched against the normalized text
+            conditions.append("s.id IN (SELECT rowid FROM shader_text WHERE instr(content, ?) > 0)")
+            params.append(normalize(snippet))
+        for name in (divergent or []):
+            conditions.append("s.id IN (SELECT shader FROM divergences WHERE compiler = ?)")
+            params.append(name)
+        for column, value in [("classification", classification), ("status", status), ("kind", kind)]:
+            if value != "":
+                conditions.append("s." + column + " = ?")
+                params.append(value)
+        query = "SELECT s.file, s.classification, s.status FROM shaders s"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY s.file"
+        if limit > 0:
+            query += " LIMIT " + str(limit)
+        return self.connection.execute(query, params).fetchall()
+
+    def get_count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM shaders").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the kept and reduced shaders by tokens, code snippet, "
+                                                 "divergent compilers and classification")
+    parser.add_argument('--config-file', dest='config', default="config.xml",
+                        help="specify a different configuration file from the default")
+    parser.add_argument('--index-file', dest='index_file', default="",
+                        help="Specify the index file (by default: " + INDEX_FILE + " in the keptshaders directory)")
+    parser.add_argument('--token', dest='tokens', nargs="+", default=[],
+                        help="Only list the shaders containing all these tokens (identifiers, keywords or numbers, "
+                             "case-insensitive)")
+    parser.add_argument('--snippet', dest='snippet', default="",
+                        help="Only list the shaders containing this code snippet (whitespace-insensitive)")
+    parser.add_argument('--snippet-file', dest='snippet_file', default="",
+                        help="Read the snippet from this file (e.g. a reduced shader excerpt)")
+    parser.add_argument('--divergent', dest='divergent', nargs="+", default=[],
+                        help="Only list the shaders for which all these compilers diverge from the largest group of "
+                             "agreeing compilers")
+    parser.add_argument('--classification', dest='classification', default="",
+                        help="Only list the shaders with this classification (a compiler name, angle, more_than_two "
+                             "or conform)")
+    parser.add_argument('--status', dest='status', default="",
+                        help="Only list the shaders with this regression status (kept, fixed, still_failing or "
+                             "new_behaviour)")
+    parser.add_argument('--kind', dest='kind', default="", choices=[""] + KINDS,
+                        help="Only list the kept, reduced or partially reduced shaders")
+    parser.add_argument('--limit', dest='limit', default=0, type=int,
+                        help="Maximum number of listed shaders (by default: no limit)")
+    parser.add_argument('--count', dest='count', action='store_true', help="Only print the number of matching shaders")
+    parser.add_argument('--no-update', dest='update', action='store_false',
+                        help="Query the index without indexing the new and modified shaders first")
+    parser.add_argument('--rescan', dest='rescan', action='store_true',
+                        help="Compare every file to the index even if no file was added or removed (e.g. after "
+                             "shaders were rewritten in place)")
+    parser.add_argument('--rebuild', dest='rebuild', action='store_true', help="Rebuild the index from scratch")
+    ns = parser.parse_args(sys.argv[1:])
+    exec_dirs = common.load_dir_settings(ns.config)
+    compilers = common.load_compilers_settings(ns.config)
+    os.chdir(exec_dirs.execdir)
+    index_file = ns.index_file if ns.index_file != "" else exec_dirs.keptshaderdir + INDEX_FILE
+    if ns.rebuild and os.path.isfile(index_file):
+        os.remove(index_file)
+    snippet = ns.snippet
+    if ns.snippet_file != "":
+        f = open(ns.snippet_file, "r")
+        snippet = f.read()
+        f.close()
+    index = ShaderIndex(index_file)
+    if ns.update:
+        start = time.time()
+        added, removed = index.update(exec_dirs, compilers, ns.rescan)
+        if added > 0 or removed > 0:
+            print("Index updated: " + str(added) + " shaders indexed, " + str(removed) + " removed in "
+                  + str(round(time.time() - start, 3)) + "s")
+    start = time.time()
+    results = index.search(ns.tokens, snippet, ns.divergent, ns.classification, ns.status, ns.kind, ns.limit)
+    duration = time.time() - start
+    if not ns.count:
+        for file, classification, status in results:
+            print(file + " " + (classification or "-") + " " + (status or "-"))
+    print(str(len(results)) + "/" + str(index.get_count()) + " shaders found in " + str(round(duration, 3)) + "s")
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
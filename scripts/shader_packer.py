@@ -0,0 +1,237 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import re
+import sys
+
+import common
+import result_cache
+
+# Tokens of a ShaderTrap command line: quoted strings are kept as a single token
+TOKEN_REGEX = re.compile(r'"[^"]*"|\S+')
+
+
+def get_pack_prefix(index):
+    return "p" + str(index) + "_"
+
+
+def is_declaring_command(command):
+    return command.startswith("DECLARE_") or command.startswith("CREATE_") or command.startswith("COMPILE_")
+
+
+def parse_harness(harness_file):
+    # Split a harness into its version line and its body (shader code is kept verbatim)
+    f = open(harness_file, "r")
+    lines = f.readlines()
+    f.close()
+    version = ""
+    body = []
+    declared_names = []
+    in_shader = False
+    for line in lines:
+        if in_shader:
+            body.append((True, line))
+            if line.strip() == "END":
+                in_shader = False
+            continue
+        tokens = TOKEN_REGEX.findall(line)
+        if len(tokens) == 0 or tokens[0].startswith("#"):
+            body.append((True, line))
+            continue
+        if tokens[0] in ["GL", "GLES"] and version == "":
+            version = line.strip()
+            continue
+        if is_declaring_command(tokens[0]) and len(tokens) > 1:
+            declared_names.append(tokens[1])
+        if tokens[0] == "DECLARE_SHADER":
+            in_shader = True
+        body.append((False, line))
+    return version, body, declared_names
+
+
+def parse_version(version):
+    # "GLES 3.1" -> ("GLES", (3, 1)), versions are compared numerically
+    tokens = version.split()
+    if not tokens:
+        return "", ()
+    return tokens[0], tuple(int(number) for number in re.findall(r"[0-9]+", " ".join(tokens[1:])))
+
+
+def get_harness_api(harness_file):
+    return parse_version(parse_harness(harness_file)[0])[0]
+
+
+def rename_command(line, prefix, declared_names):
+    tokens = TOKEN_REGEX.findall(line)
+    renamed = []
+    previous = ""
+    for token in tokens:
+        if token in declared_names:
+            renamed.append(prefix + token)
+        # Only output files are renamed, other quoted strings (buffer format, uniform names) are part of the test
+        elif previous == "FILE" and token.startswith('"'):
+            renamed.append('"' + prefix + token[1:])
+        else:
+            renamed.append(token)
+        previous = token
+    return " ".join(renamed) + "\n"
+
+
+def pack_harnesses(harness_files, packed_file):
+    # Merge already post-processed harnesses into a single ShaderTrap script, the i-th harness getting the i-th prefix
+    versions = []
+    packed_body = ""
+    for index, harness_file in enumerate(harness_files):
+        version, body, declared_names = parse_harness(harness_file)
+        if version != "":
+            versions.append(version)
+        packed_body += "\n# Packed harness " + os.path.basename(harness_file) + "\n"
+        for verbatim, line in body:
+            if verbatim:
+                packed_body += line
+            else:
+                packed_body += rename_command(line, get_pack_prefix(index), declared_names)
+        if not packed_body.endswith("\n"):
+            packed_body += "\n"
+    if len(set(parse_version(version)[0] for version in versions)) > 1:
+        exit("GL and GLES harnesses cannot be packed together")
+    # All harnesses share the version of the most recent one (GLES 3.2 > GLES 3.1)
+    header = max(versions, key=lambda version: parse_version(version)[1]) + "\n" if versions else ""
+    g = open(packed_file, "w")
+    g.write(header + packed_body)
+    g.close()
+
+
+def find_packed_buffers(index, cwd):
+    prefix = get_pack_prefix(index)
+    return [file for file in common.find_buffer_file(cwd) if file.startswith(prefix)]
+
+
+def execute_pack(compiler, shadertrap, harness_files, shader_names, file_results, move_dir, verbose, timeout,
+                 cwd=None):
+    # The pack is executed in cwd (by default the current directory)
+    if cwd is None:
+        cwd = os.getcwd()
+    if len(harness_files) == 1:
+        return [common.execute_compiler(compiler, shadertrap, harness_files[0], shader_names[0], file_results[0],
+                                        move_dir, verbose, timeout, cwd=cwd)]
+    # GL and GLES harnesses cannot share a ShaderTrap script, each API gets its own pack
+    apis = [get_harness_api(harness_file) for harness_file in harness_files]
+    if len(set(apis)) > 1:
+        results = [None for _ in harness_files]
+        for api in sorted(set(apis)):
+            indices = [index for index, harness_api in enumerate(apis) if harness_api == api]
+            api_results = execute_pack(compiler, shadertrap, [harness_files[index] for index in indices],
+                                       [shader_names[index] for index in indices],
+                                       [file_results[index] for index in indices], move_dir, verbose, timeout, cwd)
+            for index, result in zip(indices, api_results):
+                results[index] = result
+        return results
+    # Shaders with a cached result are not packed (see result_cache.py)
+    results = [common.restore_cached_result(compiler, shadertrap, harness_file, shader_name, file_result, move_dir,
+                                            verbose, cwd)
+               for harness_file, shader_name, file_result in zip(harness_files, shader_names, file_results)]
+    missing = [index for index, result in enumerate(results) if result is None]
+    if len(missing) != len(harness_files):
+        if missing:
+            missing_results = execute_pack(compiler, shadertrap, [harness_files[index] for index in missing],
+                                           [shader_names[index] for index in missing],
+                                           [file_results[index] for index in missing], move_dir, verbose, timeout,
+                                           cwd)
+            for index, result in zip(missing, missing_results):
+                results[index] = result
+        return results
+    pack_name = os.path.join(cwd, "pack_" + compiler.name + ".shadertrap")
+    pack_harnesses(harness_files, pack_name)
+    # The timeout scales with the number of packed shaders
+    result = common.run_shadertrap(compiler, shadertrap, pack_name, "pack of " + str(len(harness_files)), verbose,
+                                   timeout * len(harness_files), cwd)
+    common.clean_files(cwd, [pack_name])
+    if result == "no_crash":
+        for index, file_result in enumerate(file_results):
+            common.collect_buffers(file_result, find_packed_buffers(index, cwd), move_dir, cwd)
+            result_cache.store(compiler, shadertrap, harness_files[index], result,
+                               common.get_result_file(file_result, move_dir, cwd))
+        return [result for _ in harness_files]
+    # Bisect the pack to isolate the shaders which crash or time out
+    common.clean_files(cwd, [file for file in common.find_buffer_file(cwd) if re.match(r"p[0-9]+_", file)])
+    print("Packed execution failed with " + compiler.name + ", bisecting " + str(len(harness_files)) + " shaders")
+    middle = len(harness_files) // 2
+    return execute_pack(compiler, shadertrap, harness_files[:middle], shader_names[:middle],
+                        file_results[:middle], move_dir, verbose, timeout, cwd) \
+        + execute_pack(compiler, shadertrap, harness_files[middle:], shader_names[middle:], file_results[middle:],
+                       move_dir, verbose, timeout, cwd)
+
+
+def postprocess_pack(graphicsfuzz, shadernames, output_seeds, postprocessing=True):
+    # Returns the harnesses to pack with their shader names and seeds, and the failed shaders
+    harness_files = []
+    packed_names = []
+    packed_seeds = []
+    failed_names = []
+    for shadername, output_seed in zip(shadernames, output_seeds):
+        if not os.path.isfile(shadername):
+            print(shadername + " not found")
+            failed_names.append(shadername)
+            continue
+        harness_file = shadername
+        if postprocessing:
+            harness_file = "tmp_" + str(output_seed) + ".shadertrap"
+            if not common.postprocess_shader(graphicsfuzz, shadername, harness_file):
+                failed_names.append(shadername)
+                continue
+        harness_files.append(harness_file)
+        packed_names.append(shadername)
+        packed_seeds.append(output_seed)
+    return harness_files, packed_names, packed_seeds, failed_names
+
+
+def execute_packed_compilation(compilers, graphicsfuzz, shadertrap, shadernames, output_seeds, move_dir="./",
+                               verbose=False, timeout=10, postprocessing=True):
+    # Post-process every shader of the pack before any execution
+    harness_files, packed_names, packed_seeds, failed_names = postprocess_pack(graphicsfuzz, shadernames,
+                                                                               output_seeds, postprocessing)
+    results = {}
+    for shadername in failed_names:
+        results[shadername] = [False for _ in compilers]
+    for shadername in packed_names:
+        results[shadername] = []
+
+    # Execute the pack once per compiler
+    if harness_files:
+        for compiler in compilers:
+            file_results = [common.get_buffer_name(compiler, output_seed) for output_seed in packed_seeds]
+            pack_results = execute_pack(compiler, shadertrap, harness_files, packed_names, file_results, move_dir,
+                                        verbose, timeout)
+            for shadername, result in zip(packed_names, pack_results):
+                results[shadername].append(result)
+    if postprocessing:
+        common.clean_files(os.getcwd(), harness_files)
+    return [results[shadername] for shadername in shadernames]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge post-processed shadertrap harnesses into a single harness")
+    parser.add_argument("--pack", dest="pack_files", nargs="+", required=True,
+                        help="harnesses to merge, each harness being renamed with the p[INDEX]_ prefix")
+    parser.add_argument("--output", dest="output", default="pack.shadertrap",
+                        help="specify the name of the packed harness (by default: pack.shadertrap)")
+    ns = parser.parse_args(sys.argv[1:])
+    pack_harnesses(ns.pack_files, ns.output)
+
+
+if __name__ == "__main__":
+    main()
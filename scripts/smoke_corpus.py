@@ -0,0 +1,249 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import heapq
+import json
+import os
+import shutil
+import sys
+import time
+
+import common
+import regression
+import scheduler
+import shader_index
+
+# Smoke corpus: the cheapest set of kept shaders covering every signature of the kept corpus, to re-run on a new driver
+# build with regression.py. The signatures of a shader are:
+# divergence:PARTITION: groups of agreeing compilers of its kept buffers (e.g. divergence:buggy|crashy,good)
+# classification:CLASS: its classification in the kept metadata (see regression.py)
+# crash:COMPILER, timeout:COMPILER: the outcomes of the compilers in the kept metadata
+# Reduced and partially reduced shaders carry the signatures of their original shader. The corpus is chosen by a
+# greedy weighted set cover: the shader covering the most uncovered signatures per second of execution is added until
+# every signature is covered, reduced shaders first on ties. The execution time of a shader is its measured duration
+# on every compiler (--measure) or an estimate from its size. The state (smoke_corpus.json in the keptshaders
+# directory) keeps the signatures and durations of the shaders: only the new or modified shaders are analysed and the
+# previous corpus is only extended with the shaders covering the new signatures unless a full recomputation is
+# requested.
+
+STATE_FILE = "smoke_corpus.json"
+CORPUS_FILE = "smoke_corpus.txt"
+KIND_ORDER = {"reduced": 0, "partial": 1, "kept": 2}
+# Estimated duration of an execution: start-up of the driver plus a cost per KB of shader
+ESTIMATED_START = 0.2
+ESTIMATED_PER_KB = 0.02
+
+
+def load_state(keptshaderdir):
+    if not os.path.isfile(keptshaderdir + STATE_FILE):
+        return {"shaders": {}, "corpus": []}
+    f = open(keptshaderdir + STATE_FILE, "r")
+    state = json.load(f)
+    f.close()
+    return state
+
+
+def save_state(keptshaderdir, state):
+    g = open(keptshaderdir + STATE_FILE + ".tmp", "w")
+    json.dump(state, g, indent=1, sort_keys=True)
+    g.close()
+    os.replace(keptshaderdir + STATE_FILE + ".tmp", keptshaderdir + STATE_FILE)
+
+
+def get_partition(exec_dirs, compilers, file):
+    # Groups of agreeing compilers of the kept buffers, empty if fewer than two buffers are kept
+    seed = regression.get_original_name(file).split(".")[0]
+    buffers_compilers = {}
+    for compiler in compilers:
+        buffer_file = exec_dirs.keptbufferdir + compiler.name + "_" + seed + ".txt"
+        if os.path.isfile(buffer_file):
+            buffers_compilers[buffer_file] = compiler.name
+    if len(buffers_compilers) < 2:
+        return ""
+    groups = [sorted(buffers_compilers[buffer_file] for buffer_file in group)
+              for group in common.comparison_helper(list(buffers_compilers))]
+    return "|".join(sorted(",".join(group) for group in groups))
+
+
+def get_signatures(entry, metadata_entry):
+    signatures = []
+    if "|" in entry["partition"]:
+        signatures.append("divergence:" + entry["partition"])
+    classification = metadata_entry.get("classification", "")
+    if classification not in ["", "conform"]:
+        signatures.append("classification:" + classification)
+    for compiler, outcome in sorted(metadata_entry.get("outcomes", {}).items()):
+        if outcome in ["crash", "timeout"]:
+            signatures.append(outcome + ":" + compiler)
+    return signatures
+
+
+def get_cost(entry, metadata_entry, nb_compilers, timeout):
+    if "duration" in entry:
+        return entry["duration"]
+    timeouts = list(metadata_entry.get("outcomes", {}).values()).count("timeout")
+    return (nb_compilers - timeouts) * (ESTIMATED_START + ESTIMATED_PER_KB * entry["size"] / 1024) + timeouts * timeout
+
+
+def update_state(exec_dirs, compilers, state):
+    # Analyses the new and modified shaders, returns the number of added and removed shaders
+    shaders = state["shaders"]
+    files = {}
+    if os.path.isdir(exec_dirs.keptshaderdir):
+        for entry in os.scandir(exec_dirs.keptshaderdir):
+            if entry.name.endswith(".shadertrap") and entry.is_file():
+                files[entry.name] = entry.stat()
+    removed = [file for file in shaders if file not in files]
+    for file in removed:
+        del shaders[file]
+    added = 0
+    for file, stat in files.items():
+        if file in shaders and shaders[file]["mtime_ns"] == stat.st_mtime_ns:
+            continue
+        shaders[file] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                         "partition": get_partition(exec_dirs, compilers, file)}
+        added += 1
+    return added, len(removed)
+
+
+def get_candidates(exec_dirs, compilers, state, timeout):
+    # Signatures and cost of the shaders with at least one signature
+    metadata = regression.load_metadata(exec_dirs.keptshaderdir)
+    candidates = {}
+    for file, entry in state["shaders"].items():
+        metadata_entry = metadata.get(file, metadata.get(regression.get_original_name(file), {}))
+        signatures = get_signatures(entry, metadata_entry)
+        if signatures:
+            candidates[file] = (set(signatures), get_cost(entry, metadata_entry, len(compilers), timeout))
+    return candidates
+
+
+def select_corpus(candidates, corpus=None):
+    # Greedy weighted set cover starting from the given corpus, the ratios are re-evaluated lazily (the number of
+    # uncovered signatures of a shader can only decrease)
+    selected = [file for file in (corpus or []) if file in candidates]
+    covered = set()
+    for file in selected:
+        covered |= candidates[file][0]
+    uncovered = set()
+    for signatures, _ in candidates.values():
+        uncovered |= signatures - covered
+    heap = []
+    for file, (signatures, cost) in candidates.items():
+        if file not in selected and signatures & uncovered:
+            heap.append((max(cost, 0.001) / len(signatures & uncovered), KIND_ORDER[shader_index.get_kind(file)],
+                         file))
+    heapq.heapify(heap)
+    while uncovered and heap:
+        _, kind_order, file = heapq.heappop(heap)
+        signatures, cost = candidates[file]
+        gain = len(signatures & uncovered)
+        if gain == 0:
+            continue
+        ratio = max(cost, 0.001) / gain
+        if heap and (ratio, kind_order, file) > heap[0]:
+            heapq.heappush(heap, (ratio, kind_order, file))
+            continue
+        selected.append(file)
+        uncovered -= signatures
+    return selected
+
+
+def measure_durations(compilers, exec_dirs, state, files, jobs, timeout, postprocessing_cache):
+    # Executes the shaders once on every compiler and records their total execution time
+    buffer_dir = os.path.abspath("smoke_buffers") + "/"
+    os.makedirs(buffer_dir, exist_ok=True)
+
+    def prepare(file):
+        return regression.get_postprocessed_harness(exec_dirs.graphicsfuzz, exec_dirs.keptshaderdir + file,
+                                                    postprocessing_cache)
+
+    def execute(file, harness_file, compiler, job_dir):
+        start = time.time()
+        common.execute_compiler(compiler, exec_dirs.shadertrap, harness_file, file,
+                                common.get_buffer_name(compiler, file.split(".")[0]), buffer_dir, False, timeout,
+                                cwd=job_dir)
+        return time.time() - start
+
+    def finish(file, harness_file, results):
+        if harness_file is not None:
+            state["shaders"][file]["duration"] = round(sum(results.values()), 3)
+
+    scheduler.BatchScheduler(compilers, jobs).run(files, prepare, execute, finish)
+    shutil.rmtree(buffer_dir, ignore_errors=True)
+
+
+def update_corpus(exec_dirs, compilers, recompute=False, timeout=10, corpus_file=CORPUS_FILE):
+    # Updates the state and the corpus, returns the corpus and the candidates
+    state = load_state(exec_dirs.keptshaderdir)
+    update_state(exec_dirs, compilers, state)
+    candidates = get_candidates(exec_dirs, compilers, state, timeout)
+    state["corpus"] = select_corpus(candidates, None if recompute else state["corpus"])
+    save_state(exec_dirs.keptshaderdir, state)
+    g = open(corpus_file, "w")
+    g.write("".join(file + "\n" for file in state["corpus"]))
+    g.close()
+    return state["corpus"], candidates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Select the cheapest set of kept shaders covering every divergence "
+                                                 "pattern and failure signature of the kept shaders")
+    parser.add_argument('--config-file', dest='config', default="config.xml",
+                        help="specify a different configuration file from the default")
+    parser.add_argument('--corpus-file', dest='corpus_file', default=CORPUS_FILE,
+                        help="Specify the file receiving the selected shaders, one per line (by default: "
+                             + CORPUS_FILE + " in the execution directory)")
+    parser.add_argument('--recompute', dest='recompute', action='store_true',
+                        help="Select the corpus from scratch instead of extending the previous one")
+    parser.add_argument('--measure', dest='measure', action='store_true',
+                        help="Execute the shaders without measured duration once on every compiler to weight them by "
+                             "their execution time instead of their size")
+    parser.add_argument('--jobs', dest='jobs', default=os.cpu_count(), type=int,
+                        help="Number of concurrent executions of --measure (by default: the number of cpus)")
+    parser.add_argument('--timeout', dest='timeout', default=10, type=int,
+                        help="Timeout of an execution in seconds (by default: 10)")
+    parser.add_argument('--postprocessing-cache', dest='postprocessingcache', default="postprocessed/",
+                        help="Directory keeping the post-processed harnesses across runs (by default: postprocessed/ "
+                             "in the execution directory)")
+    parser.add_argument('--list', dest='list', action='store_true',
+                        help="Print the selected shaders with their signatures")
+    ns = parser.parse_args(sys.argv[1:])
+    exec_dirs = common.load_dir_settings(ns.config)
+    compilers = common.load_compilers_settings(ns.config)
+    os.chdir(exec_dirs.execdir)
+    if ns.measure:
+        state = load_state(exec_dirs.keptshaderdir)
+        update_state(exec_dirs, compilers, state)
+        candidates = get_candidates(exec_dirs, compilers, state, ns.timeout)
+        files = sorted([file for file in candidates if "duration" not in state["shaders"][file]])
+        print("Measuring " + str(len(files)) + " shaders")
+        measure_durations(compilers, exec_dirs, state, files, ns.jobs, ns.timeout, ns.postprocessingcache)
+        save_state(exec_dirs.keptshaderdir, state)
+    corpus, candidates = update_corpus(exec_dirs, compilers, ns.recompute, ns.timeout, ns.corpus_file)
+    signatures = set()
+    for file_signatures, _ in candidates.values():
+        signatures |= file_signatures
+    if ns.list:
+        for file in corpus:
+            print(file + " " + str(round(candidates[file][1], 2)) + "s " + " ".join(sorted(candidates[file][0])))
+    print("Smoke corpus: " + str(len(corpus)) + " shaders covering " + str(len(signatures)) + " signatures in about "
+          + str(round(sum(candidates[file][1] for file in corpus), 1)) + "s (" + str(len(candidates))
+          + " candidate shaders in about " + str(round(sum(cost for _, cost in candidates.values()), 1)) + "s)")
+    print("Run it with: python3 regression.py --shaders-file " + os.path.abspath(ns.corpus_file))
+
+
+if __name__ == "__main__":
+    main()
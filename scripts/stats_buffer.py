@@ -18,6 +18,7 @@ import argparse
 import sys
 from subprocess import run
 import common
+import profiler
 
 
 def report_line_nb(seed, dir):
@@ -41,7 +42,9 @@ def main():
     parser.add_argument('--verbose', dest="verbose", action="store_true", help="Gives the detail of agreeing compiler "
                                                                                "for non-trivial case")
     parser.add_argument('--config-file', dest='config', default="config.xml", help="Provides a different config file ")
+    profiler.add_arguments(parser)
     ns = parser.parse_args(sys.argv[1:])
+    profiler.start(ns.profile, ns.profileinterval)
     # Parse directory config
     exec_dirs = common.load_dir_settings(ns.config)
     compilers = common.load_compilers_settings(ns.config)
@@ -73,31 +76,20 @@ def main():
             correct_seed_buffers.append(exec_dirs.keptbufferdir + compiler.name + "_" + seed + ".txt")
         results = common.comparison_helper(correct_seed_buffers)
         # Read back results from the comparison
-        if len(results) == 2:
-            compiler_name = ""
-            if len(results[0]) == 1 or len(results[1]) == 1:
-                if len(results[0]) == 1:
-                    compiler_name = get_compiler_name_from_buffer(results[0][0])
-                else:
-                    compiler_name = get_compiler_name_from_buffer(results[1][0])
-                if compiler_name in ns.compilers or "all" in ns.compilers:
-                    print(compiler_name + ", lines: " + report_line_nb(seed,
-                                                                       exec_dirs.keptshaderdir) + ", seed: " + seed)
-                compiler_differences[compiler_name] += 1
-                continue
-            # Try if we are in the angle case
-            if (all(compilers_dict[get_compiler_name_from_buffer(buffer_name)].type == "angle"
-                    for buffer_name in results[0])
-                and all(compilers_dict[get_compiler_name_from_buffer(buffer_name)].type == "independent"
-                        for buffer_name in results[1])) \
-                    or (all(compilers_dict[get_compiler_name_from_buffer(buffer_name)].type == "angle"
-                            for buffer_name in results[1])
-                        and all(compilers_dict[get_compiler_name_from_buffer(buffer_name)].type == "independent"
-                                for buffer_name in results[0])):
-                if "angle" in ns.compilers or "all" in ns.compilers:
-                    print("angle" + ", lines: " + report_line_nb(seed, exec_dirs.keptshaderdir) + ", seed: " + seed)
-                compiler_differences["angle"] += 1
-                continue
+        classification = common.classify_divergence(
+            [[get_compiler_name_from_buffer(buffer_name) for buffer_name in group] for group in results],
+            compilers_dict)
+        if classification == "angle":
+            if "angle" in ns.compilers or "all" in ns.compilers:
+                print("angle" + ", lines: " + report_line_nb(seed, exec_dirs.keptshaderdir) + ", seed: " + seed)
+            compiler_differences["angle"] += 1
+            continue
+        if classification != "more_than_two":
+            if classification in ns.compilers or "all" in ns.compilers:
+                print(classification + ", lines: " + report_line_nb(seed,
+                                                                    exec_dirs.keptshaderdir) + ", seed: " + seed)
+            compiler_differences[classification] += 1
+            continue
 
         # Everything else where a cause is difficult to identify
         compiler_differences["more_than_two"] += 1
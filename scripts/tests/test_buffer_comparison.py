@@ -0,0 +1,128 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import buffer_comparison
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HARNESS = """GLES 3.1
+CREATE_BUFFER values SIZE_BYTES 12 INIT_VALUES int 1 2 float 0.5
+CREATE_BUFFER raw SIZE_BYTES 4
+DECLARE_SHADER shader KIND COMPUTE
+CREATE_BUFFER ignored SIZE_BYTES 4
+END
+DUMP_BUFFER_BINARY BUFFER values FILE "buffer_1.bin"
+DUMP_BUFFER_BINARY BUFFER raw FILE "buffer_0.bin"
+DUMP_BUFFER_TEXT BUFFER values FILE "buffer_2.txt" FORMAT "ints " int 2 SKIP_BYTES 4 " float " float 1
+"""
+
+
+def next_float(value, ulp=1):
+    return struct.unpack("<f", struct.pack("<i", struct.unpack("<i", struct.pack("<f", value))[0] + ulp))[0]
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class BufferComparisonTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        harness_file = os.path.join(self.dir, "test.shadertrap")
+        f = open(harness_file, "w")
+        f.write(HARNESS)
+        f.close()
+        self.layout = buffer_comparison.parse_buffer_layout(harness_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get_buffers(self, ints=(1, 2), value=0.5, raw=b"abcd"):
+        # Concatenation of the dumps in the order of their file names
+        return raw + struct.pack("<2if", ints[0], ints[1], value) \
+            + ("ints " + str(ints[0]) + " " + str(ints[1]) + " float " + repr(value) + "\n").encode()
+
+    def write_buffer(self, name, content):
+        buffer_file = os.path.join(self.dir, name)
+        f = open(buffer_file, "wb")
+        f.write(content)
+        f.close()
+        return buffer_file
+
+    def test_parse_buffer_layout(self):
+        self.assertEqual([segment.dump_file for segment in self.layout], ["buffer_0.bin", "buffer_1.bin",
+                                                                          "buffer_2.txt"])
+        self.assertEqual(self.layout[0].fields, [("byte", 4)])
+        self.assertEqual(self.layout[1].fields, [("int", 2), ("float", 1)])
+        self.assertTrue(self.layout[1].binary)
+        self.assertFalse(self.layout[2].binary)
+        self.assertEqual(self.layout[2].text_format, [("literal", "ints "), ("int", 2), ("skip", 4),
+                                                      ("literal", " float "), ("float", 1)])
+
+    def test_decode_buffers(self):
+        decoded = buffer_comparison.decode_buffers(self.get_buffers(), self.layout)
+        self.assertEqual(list(decoded[0][0][1]), list(b"abcd"))
+        self.assertEqual([(field_type, list(array)) for field_type, array in decoded[1]],
+                         [("int", [1, 2]), ("float", [0.5])])
+        self.assertEqual([(field_type, list(array)) for field_type, array in decoded[2]],
+                         [("int", [1, 2]), ("float", [0.5])])
+
+    def test_decode_buffers_rejects_other_layouts(self):
+        self.assertIsNone(buffer_comparison.decode_buffers(b"timeout", self.layout))
+        self.assertIsNone(buffer_comparison.decode_buffers(self.get_buffers() + b"extra", self.layout))
+
+    def test_float_differences(self):
+        a = numpy.array([1.0, numpy.nan, 2.0, 100.0], dtype=numpy.float32)
+        b = numpy.array([next_float(1.0), numpy.nan, next_float(2.0, 3), 101.0], dtype=numpy.float32)
+        self.assertEqual(list(buffer_comparison.float_differences(a, b, 0, 0.0)), [0, 2, 3])
+        self.assertEqual(list(buffer_comparison.float_differences(a, b, 1, 0.0)), [2, 3])
+        self.assertEqual(list(buffer_comparison.float_differences(a, b, 0, 0.02)), [])
+
+    def test_numeric_comparison_merges_within_tolerance(self):
+        files = [self.write_buffer("a.txt", self.get_buffers()),
+                 self.write_buffer("b.txt", self.get_buffers(value=next_float(0.5))),
+                 self.write_buffer("c.txt", self.get_buffers())]
+        groups, summary = buffer_comparison.numeric_comparison_helper(files, self.layout, 0)
+        self.assertEqual(groups, [[files[0], files[2]], [files[1]]])
+        self.assertEqual(len(summary), 2)
+        self.assertTrue(summary[0].startswith(files[1] + " vs " + files[0] + ": values 1 different values: [2] "))
+        groups, summary = buffer_comparison.numeric_comparison_helper(files, self.layout, 1)
+        self.assertEqual(groups, [[files[0], files[2], files[1]]])
+        self.assertEqual(summary, [])
+
+    def test_numeric_comparison_reports_integer_differences(self):
+        files = [self.write_buffer("a.txt", self.get_buffers()),
+                 self.write_buffer("b.txt", self.get_buffers(ints=(1, 3)))]
+        groups, summary = buffer_comparison.numeric_comparison_helper(files, self.layout, 10, 0.1,
+                                                                      ["good", "bad"])
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(summary[0], "bad vs good: values 1 different values: [1] 3 != 2")
+
+    def test_numeric_comparison_of_undecodable_buffers(self):
+        files = [self.write_buffer("a.txt", self.get_buffers()), self.write_buffer("b.txt", b"timeout"),
+                 self.write_buffer("c.txt", b"timeout")]
+        groups, summary = buffer_comparison.numeric_comparison_helper(files, self.layout, 1)
+        self.assertEqual(groups, [[files[0]], [files[1], files[2]]])
+        self.assertEqual(summary, [files[1] + " vs " + files[0] + ": buffers cannot be decoded with the harness "
+                                                                   "layout, byte comparison only"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import pre_reduction
+
+SHADER = """#version 310 es
+layout(local_size_x = 1) in;
+int unused = 1;
+int f(int x)
+{
+  return x + 1;
+}
+void main()
+{
+  int a = 2;
+  int b = f(a);
+  int bug = a * 3;
+  a = a + 1;
+}
+""".splitlines(True)
+
+
+def is_interesting(lines):
+    # The bug needs its line and the shader must still have balanced braces
+    text = "".join(lines)
+    return "int bug" in text and text.count("{") == text.count("}")
+
+
+class PreReductionTest(unittest.TestCase):
+    def test_protected_lines(self):
+        self.assertTrue(pre_reduction.is_protected(SHADER[0]))
+        self.assertTrue(pre_reduction.is_protected(SHADER[1]))
+        self.assertTrue(pre_reduction.is_protected(SHADER[7]))
+        self.assertFalse(pre_reduction.is_protected(SHADER[2]))
+
+    def test_removable_chunks(self):
+        self.assertTrue(pre_reduction.is_removable(SHADER[2:7]))
+        self.assertFalse(pre_reduction.is_removable(SHADER[3:5]))
+        self.assertFalse(pre_reduction.is_removable(SHADER[5:7]))
+        self.assertFalse(pre_reduction.is_removable(SHADER[6:9]))
+        self.assertEqual(pre_reduction.get_chunks(SHADER, 1), [(2, 3), (3, 4), (5, 6), (9, 10), (10, 11), (11, 12),
+                                                               (12, 13)])
+        self.assertEqual(pre_reduction.get_chunks(SHADER, 16), [])
+
+    def test_delta_debugging(self):
+        # The braces of f are only removable together with its body, the remaining braces are left to the reducer
+        lines, calls = pre_reduction.delta_debugging(SHADER, is_interesting)
+        self.assertEqual("".join(lines), "#version 310 es\n"
+                                         "layout(local_size_x = 1) in;\n"
+                                         "{\n"
+                                         "}\n"
+                                         "void main()\n"
+                                         "{\n"
+                                         "  int bug = a * 3;\n"
+                                         "}\n")
+        self.assertGreater(calls, 0)
+
+    def test_parallel_delta_debugging_is_deterministic(self):
+        reduced, _ = pre_reduction.delta_debugging(SHADER, is_interesting)
+        for jobs in [2, 4]:
+            self.assertEqual(pre_reduction.delta_debugging(SHADER, is_interesting, jobs)[0], reduced)
+
+    def test_uninteresting_candidates_are_kept(self):
+        lines, _ = pre_reduction.delta_debugging(SHADER, lambda lines: False)
+        self.assertEqual(lines, SHADER)
+
+
+if __name__ == "__main__":
+    unittest.main()
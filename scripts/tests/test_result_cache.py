@@ -0,0 +1,126 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import types
+import unittest
+
+import result_cache
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shadertrap = self.write_file("shadertrap", b"binary")
+        self.compiler = types.SimpleNamespace(name="llvmpipe", renderer="llvmpipe", type="independent", ldpath=" ",
+                                              vkfilename=" ", executor="local", executor_command="", otherenvs=[])
+        self.cache = result_cache.ResultCache(os.path.join(self.dir, "cache.sqlite"), 1000)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def write_file(self, name, content):
+        path = os.path.join(self.dir, name)
+        f = open(path, "wb")
+        f.write(content)
+        f.close()
+        return path
+
+    def store(self, shader, outcome="no_crash", buffer=b"buffer"):
+        self.cache.store(self.compiler, self.shadertrap, self.write_file(shader, shader.encode()), outcome,
+                         self.write_file("buffer.txt", buffer))
+
+    def lookup(self, shader):
+        return self.cache.lookup(self.compiler, self.shadertrap, self.write_file(shader, shader.encode()))
+
+    def check_total_size(self):
+        total = self.cache.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        self.assertEqual(self.cache.get_total_size(), total)
+        return total
+
+    def test_store_and_lookup(self):
+        self.assertIsNone(self.lookup("a"))
+        self.store("a")
+        self.assertEqual(self.lookup("a"), ("no_crash", b"buffer"))
+        self.assertIsNone(self.lookup("b"))
+
+    def test_only_successful_executions_are_cached(self):
+        self.store("a", "timeout")
+        self.store("b", "Execution error with llvmpipe: assertion failed")
+        self.assertIsNone(self.lookup("a"))
+        self.assertIsNone(self.lookup("b"))
+
+    def test_new_driver_build_invalidates_entries(self):
+        library_dir = os.path.join(self.dir, "lib")
+        os.makedirs(library_dir)
+        library = os.path.join(library_dir, "libGL.so.1")
+        f = open(library, "w")
+        f.write("build 1")
+        f.close()
+        self.compiler.ldpath = library_dir
+        self.store("a")
+        self.cache.reset_fingerprints()
+        self.assertIsNotNone(self.lookup("a"))
+        os.utime(library, ns=(0, time.time_ns() + 10 ** 9))
+        self.cache.reset_fingerprints()
+        self.assertIsNone(self.lookup("a"))
+        self.assertEqual(self.check_total_size(), 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        # Each entry uses 100 bytes (buffer and outcome)
+        for index in range(10):
+            self.store(str(index), buffer=b"x" * 92)
+        self.assertEqual(self.check_total_size(), 1000)
+        self.lookup("0")
+        self.store("10", buffer=b"x" * 92)
+        # The cache is trimmed below 90% of its maximum size
+        self.assertEqual(self.check_total_size(), 900)
+        self.assertIsNotNone(self.lookup("0"))
+        self.assertIsNone(self.lookup("1"))
+        self.assertIsNone(self.lookup("2"))
+        self.assertIsNotNone(self.lookup("3"))
+
+    def test_total_size_follows_replaced_entries(self):
+        self.store("a", buffer=b"x" * 100)
+        self.store("a", buffer=b"x" * 10)
+        self.assertEqual(self.check_total_size(), 18)
+        self.cache.clear()
+        self.assertEqual(self.check_total_size(), 0)
+
+    def test_total_size_of_existing_caches(self):
+        cache_file = os.path.join(self.dir, "old.sqlite")
+        connection = sqlite3.connect(cache_file)
+        connection.execute("CREATE TABLE results (shader_hash TEXT, compiler TEXT, fingerprint TEXT, outcome TEXT, "
+                           "buffer_digest TEXT, buffer BLOB, size INTEGER, last_used REAL, "
+                           "PRIMARY KEY (shader_hash, compiler, fingerprint))")
+        connection.execute("INSERT INTO results VALUES ('hash', 'llvmpipe', 'fingerprint', 'no_crash', 'digest', "
+                           "x'00', 42, 0)")
+        connection.commit()
+        connection.close()
+        cache = result_cache.ResultCache(cache_file)
+        self.assertEqual(cache.get_total_size(), 42)
+        cache.close()
+        # The total is only computed once
+        cache = result_cache.ResultCache(cache_file)
+        self.assertEqual(cache.get_total_size(), 42)
+        cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
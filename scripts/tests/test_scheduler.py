@@ -0,0 +1,102 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+import scheduler
+
+
+def get_compiler(name, family=None, max_slots=1, cost=1):
+    return types.SimpleNamespace(name=name, family=family or name, max_slots=max_slots, cost=cost)
+
+
+class BatchSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        # The job directories are created in the current directory
+        self.previous_dir = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.lock = threading.Lock()
+        self.finished = {}
+        self.executions = []
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.dir)
+
+    def finish(self, unit, prepared, results):
+        with self.lock:
+            self.finished[unit] = (prepared, dict(results))
+
+    def test_every_unit_is_finished(self):
+        compilers = [get_compiler("a"), get_compiler("b")]
+
+        def execute(unit, prepared, compiler, job_dir):
+            self.assertTrue(os.path.isdir(job_dir))
+            if compiler.name == "b" and unit == 2:
+                raise RuntimeError("driver lost")
+            return prepared + "_" + compiler.name
+
+        def prepare(unit):
+            return None if unit == 3 else "unit" + str(unit)
+
+        scheduler.BatchScheduler(compilers, 4).run([0, 1, 2, 3], prepare, execute, self.finish)
+        self.assertEqual(self.finished[0], ("unit0", {"a": "unit0_a", "b": "unit0_b"}))
+        self.assertEqual(self.finished[2][1]["b"], "Execution error with b: driver lost")
+        # Units failing their preparation are finished without any execution
+        self.assertEqual(self.finished[3], (None, {}))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_slots_are_shared_by_family(self):
+        compilers = [get_compiler("radv-default", "radv", 2), get_compiler("radv-aco", "radv", 2),
+                     get_compiler("llvmpipe", max_slots=1)]
+        running = {"radv": 0, "llvmpipe": 0}
+        maximum = {"radv": 0, "llvmpipe": 0}
+
+        def execute(unit, prepared, compiler, job_dir):
+            with self.lock:
+                running[compiler.family] += 1
+                maximum[compiler.family] = max(maximum[compiler.family], running[compiler.family])
+            time.sleep(0.01)
+            with self.lock:
+                running[compiler.family] -= 1
+            return "no_crash"
+
+        scheduler.BatchScheduler(compilers, 8).run(list(range(10)), lambda unit: unit, execute, self.finish)
+        self.assertEqual(len(self.finished), 10)
+        self.assertLessEqual(maximum["radv"], 2)
+        self.assertLessEqual(maximum["llvmpipe"], 1)
+
+    def test_order_of_the_executions(self):
+        # Most costly families first, the variants of a family next to each other, the oldest unit first
+        compilers = [get_compiler("a-1", "a"), get_compiler("b", cost=5), get_compiler("a-2", "a"),
+                     get_compiler("c", cost=2)]
+
+        def execute(unit, prepared, compiler, job_dir):
+            self.executions.append((unit, compiler.name))
+            return "no_crash"
+
+        scheduler.BatchScheduler(compilers, 1).run([0, 1], lambda unit: unit, execute, self.finish)
+        self.assertEqual(self.executions, [(0, "b"), (0, "c"), (0, "a-1"), (0, "a-2"),
+                                           (1, "b"), (1, "c"), (1, "a-1"), (1, "a-2")])
+
+
+if __name__ == "__main__":
+    unittest.main()
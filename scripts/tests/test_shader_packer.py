@@ -0,0 +1,159 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+import common
+import shader_packer
+
+HARNESS = """{version}
+CREATE_BUFFER buf SIZE_BYTES 4 INIT_VALUES int {value}
+BIND_SHADER_STORAGE_BUFFER BUFFER buf BINDING 0
+DECLARE_SHADER shader KIND COMPUTE
+#version 310 es
+// buf shader {marker}
+END
+COMPILE_SHADER shader_compiled SHADER shader
+DUMP_BUFFER_TEXT BUFFER buf FILE "buffer_out.txt" FORMAT "buf " int 1
+"""
+
+
+class ShaderPackerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.runs = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_harness(self, name, version="GLES 3.1", value=1, marker=""):
+        harness_file = os.path.join(self.dir, name)
+        f = open(harness_file, "w")
+        f.write(HARNESS.format(version=version, value=value, marker=marker))
+        f.close()
+        return harness_file
+
+    def fake_shadertrap(self, compiler, shadertrap, shader_file, shadername, verbose, timeout, cwd):
+        # Dumps the value of each buffer in its file, fails on the harnesses marked with CRASH
+        f = open(shader_file, "r")
+        lines = f.readlines()
+        f.close()
+        self.runs.append((shadername, timeout))
+        if any("CRASH" in line for line in lines):
+            return "crash"
+        values = {}
+        for line in lines:
+            tokens = shader_packer.TOKEN_REGEX.findall(line)
+            if tokens and tokens[0] == "CREATE_BUFFER":
+                values[tokens[1]] = tokens[-1]
+            elif tokens and tokens[0] == "DUMP_BUFFER_TEXT":
+                g = open(os.path.join(cwd, tokens[4].strip('"')), "w")
+                g.write(values[tokens[2]])
+                g.close()
+        return "no_crash"
+
+    def test_parse_harness(self):
+        version, body, declared_names = shader_packer.parse_harness(self.write_harness("a.shadertrap"))
+        self.assertEqual(version, "GLES 3.1")
+        self.assertEqual(declared_names, ["buf", "shader", "shader_compiled"])
+        # The shader code is kept verbatim
+        self.assertIn((True, "// buf shader \n"), body)
+
+    def test_rename_command(self):
+        self.assertEqual(shader_packer.rename_command('DUMP_BUFFER_TEXT BUFFER buf FILE "buffer_out.txt" FORMAT "buf " '
+                                                     'int 1\n', "p3_", ["buf"]),
+                         'DUMP_BUFFER_TEXT BUFFER p3_buf FILE "p3_buffer_out.txt" FORMAT "buf " int 1\n')
+
+    def test_pack_renames_each_harness(self):
+        packed_file = os.path.join(self.dir, "pack.shadertrap")
+        shader_packer.pack_harnesses([self.write_harness("a.shadertrap"), self.write_harness("b.shadertrap")],
+                                     packed_file)
+        f = open(packed_file, "r")
+        packed = f.read()
+        f.close()
+        self.assertTrue(packed.startswith("GLES 3.1\n"))
+        self.assertEqual(packed.count("GLES 3.1"), 1)
+        self.assertIn("CREATE_BUFFER p0_buf", packed)
+        self.assertIn("CREATE_BUFFER p1_buf", packed)
+        self.assertIn('FILE "p1_buffer_out.txt"', packed)
+        self.assertIn("COMPILE_SHADER p1_shader_compiled SHADER p1_shader", packed)
+
+    def test_pack_uses_most_recent_version(self):
+        self.assertEqual(shader_packer.parse_version("GLES 3.10"), ("GLES", (3, 10)))
+        packed_file = os.path.join(self.dir, "pack.shadertrap")
+        shader_packer.pack_harnesses([self.write_harness("a.shadertrap", "GLES 3.10"),
+                                      self.write_harness("b.shadertrap", "GLES 3.2")], packed_file)
+        f = open(packed_file, "r")
+        self.assertEqual(f.readline(), "GLES 3.10\n")
+        f.close()
+
+    def test_pack_rejects_mixed_apis(self):
+        with self.assertRaises(SystemExit):
+            shader_packer.pack_harnesses([self.write_harness("a.shadertrap", "GLES 3.1"),
+                                          self.write_harness("b.shadertrap", "GL 4.5")],
+                                         os.path.join(self.dir, "pack.shadertrap"))
+
+    def execute_pack(self, harness_files):
+        compiler = types.SimpleNamespace(name="fake")
+        file_results = ["buffer_fake_" + str(index) + ".txt" for index in range(len(harness_files))]
+        # As in the batches, the results are moved out of the execution directory
+        move_dir = os.path.join(self.dir, "results", "")
+        os.makedirs(move_dir)
+        original = common.run_shadertrap
+        common.run_shadertrap = self.fake_shadertrap
+        try:
+            results = shader_packer.execute_pack(compiler, "shadertrap", harness_files, harness_files, file_results,
+                                                 move_dir, False, 10, self.dir)
+        finally:
+            common.run_shadertrap = original
+        buffers = []
+        for file_result in file_results:
+            f = open(os.path.join(move_dir, file_result), "r")
+            buffers.append(f.read())
+            f.close()
+        return results, buffers
+
+    def test_execute_pack_splits_buffers(self):
+        harness_files = [self.write_harness(str(index) + ".shadertrap", value=index) for index in range(3)]
+        results, buffers = self.execute_pack(harness_files)
+        self.assertEqual(results, ["no_crash", "no_crash", "no_crash"])
+        self.assertEqual(buffers, ["0", "1", "2"])
+        # A single run with a timeout scaled to the pack
+        self.assertEqual(self.runs, [("pack of 3", 30)])
+
+    def test_execute_pack_bisects_failures(self):
+        harness_files = [self.write_harness(str(index) + ".shadertrap", value=index, marker="CRASH" * (index == 2))
+                         for index in range(4)]
+        results, buffers = self.execute_pack(harness_files)
+        self.assertEqual(results, ["no_crash", "no_crash", "crash", "no_crash"])
+        self.assertEqual(buffers[:2] + buffers[3:], ["0", "1", "3"])
+        self.assertEqual([run[0] for run in self.runs], ["pack of 4", "pack of 2", "pack of 2", harness_files[2],
+                                                          harness_files[3]])
+
+    def test_execute_pack_separates_apis(self):
+        harness_files = [self.write_harness("0.shadertrap", "GLES 3.1", 0),
+                         self.write_harness("1.shadertrap", "GL 4.5", 1),
+                         self.write_harness("2.shadertrap", "GLES 3.2", 2)]
+        results, buffers = self.execute_pack(harness_files)
+        self.assertEqual(results, ["no_crash", "no_crash", "no_crash"])
+        self.assertEqual(buffers, ["0", "1", "2"])
+        self.assertEqual(sorted(run[0] for run in self.runs), sorted([harness_files[1], "pack of 2"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import smoke_corpus
+
+
+class SelectCorpusTest(unittest.TestCase):
+    def test_every_signature_is_covered_at_the_lowest_cost(self):
+        candidates = {"1.shadertrap": ({"crash:a", "timeout:b"}, 2.0),
+                      "2.shadertrap": ({"crash:a"}, 0.5),
+                      "3.shadertrap": ({"timeout:b"}, 0.5)}
+        self.assertEqual(smoke_corpus.select_corpus(candidates), ["2.shadertrap", "3.shadertrap"])
+
+    def test_ratios_are_updated_with_the_coverage(self):
+        # Once 2 is selected, 1 only covers a single new signature for a high cost
+        candidates = {"1.shadertrap": ({"crash:a", "crash:b", "crash:c"}, 3.0),
+                      "2.shadertrap": ({"crash:a", "crash:b"}, 1.2),
+                      "3.shadertrap": ({"crash:c"}, 0.9)}
+        self.assertEqual(smoke_corpus.select_corpus(candidates), ["2.shadertrap", "3.shadertrap"])
+
+    def test_reduced_shaders_first_on_ties(self):
+        candidates = {"1.shadertrap": ({"crash:a"}, 1.0),
+                      "1_partial.shadertrap": ({"crash:a"}, 1.0),
+                      "1_reduced.shadertrap": ({"crash:a"}, 1.0)}
+        self.assertEqual(smoke_corpus.select_corpus(candidates), ["1_reduced.shadertrap"])
+
+    def test_previous_corpus_is_extended(self):
+        candidates = {"1.shadertrap": ({"crash:a"}, 5.0),
+                      "2.shadertrap": ({"crash:a", "timeout:b"}, 1.0),
+                      "3.shadertrap": ({"timeout:b"}, 0.1)}
+        # Removed shaders leave the corpus
+        self.assertEqual(smoke_corpus.select_corpus(candidates, ["1.shadertrap", "4.shadertrap"]),
+                         ["1.shadertrap", "3.shadertrap"])
+        self.assertEqual(smoke_corpus.select_corpus(candidates), ["3.shadertrap", "2.shadertrap"])
+
+    def test_signatures(self):
+        entry = {"partition": "a,b|c", "size": 2048}
+        metadata_entry = {"classification": "miscompilation", "outcomes": {"c": "timeout", "b": "crash",
+                                                                            "a": "no_crash"}}
+        self.assertEqual(smoke_corpus.get_signatures(entry, metadata_entry),
+                         ["divergence:a,b|c", "classification:miscompilation", "crash:b", "timeout:c"])
+        self.assertEqual(smoke_corpus.get_signatures({"partition": "a,b,c"}, {"classification": "conform"}), [])
+
+    def test_cost(self):
+        entry = {"partition": "", "size": 2048}
+        metadata_entry = {"outcomes": {"a": "no_crash", "b": "timeout"}}
+        self.assertAlmostEqual(smoke_corpus.get_cost(entry, metadata_entry, 3, 10),
+                               2 * (smoke_corpus.ESTIMATED_START + 2 * smoke_corpus.ESTIMATED_PER_KB) + 10)
+        entry["duration"] = 1.5
+        self.assertEqual(smoke_corpus.get_cost(entry, metadata_entry, 3, 10), 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
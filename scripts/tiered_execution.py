@@ -0,0 +1,112 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import math
+import os
+import random
+
+import common
+
+# Tiered execution: the shaders of a batch are first executed on a cheap tier of compilers and only escalated to the
+# other compilers when the cheap tier crashes, times out or diverges, or when they belong to the random audit sample.
+# Audited shaders agree on the cheap tier: a divergence found on the full set of compilers is a bug that the cheap tier
+# alone would have missed, the audit therefore estimates the proportion of missed bugs among the shaders which are not
+# escalated. The counters are accumulated across batches in a statistics file.
+
+
+def get_escalation_reason(tier_compilers, buffer_files, shader_outcomes):
+    for status in ["crash", "timeout"]:
+        if any(shader_outcomes.get(compiler.name) == status for compiler in tier_compilers):
+            return status
+    if len(tier_compilers) > 1 and len(common.comparison_helper(buffer_files)) != 1:
+        return "divergence"
+    return None
+
+
+def select_escalations(tier_compilers, exec_dirs, shader_ids, outcomes, audit_rate, seed):
+    # Returns the reason of escalation of each escalated shader id
+    # The audit sample only depends on the seed of the batch so that a resumed batch escalates the same shaders
+    sampler = random.Random(seed)
+    escalations = {}
+    for i in shader_ids:
+        audited = sampler.random() < audit_rate
+        if not os.path.isfile(exec_dirs.shaderoutput + "test_" + str(i) + ".shadertrap"):
+            continue
+        buffer_files = [exec_dirs.dumpbufferdir + "buffer_" + compiler.name + "_" + str(i) + ".txt"
+                        for compiler in tier_compilers]
+        reason = get_escalation_reason(tier_compilers, buffer_files, outcomes.get(i, {}))
+        if reason is None and audited:
+            reason = "audit"
+        if reason is not None:
+            escalations[i] = reason
+    return escalations
+
+
+def get_batch_stats(executed, escalations, divergent_ids):
+    reasons = list(escalations.values())
+    return {"executed": executed, "escalated": len(escalations), "crash": reasons.count("crash"),
+            "timeout": reasons.count("timeout"), "divergence": reasons.count("divergence"),
+            "audited": reasons.count("audit"),
+            "audit_divergences": len([i for i in divergent_ids if escalations.get(i) == "audit"])}
+
+
+def load_stats(stats_file):
+    if not os.path.isfile(stats_file):
+        return {}
+    f = open(stats_file, "r")
+    stats = json.load(f)
+    f.close()
+    return stats
+
+
+def record_stats(stats_file, batch_stats):
+    # Returns the accumulated statistics
+    stats = load_stats(stats_file)
+    for key, value in batch_stats.items():
+        stats[key] = stats.get(key, 0) + value
+    g = open(stats_file + ".tmp", "w")
+    json.dump(stats, g, indent=1, sort_keys=True)
+    g.close()
+    os.replace(stats_file + ".tmp", stats_file)
+    return stats
+
+
+def get_missed_risk(audited, audit_divergences):
+    # Estimated proportion of missed bugs among the shaders which are not escalated with its 95% upper bound
+    # (rule of three when no audited shader diverged, normal approximation otherwise)
+    if audited == 0:
+        return None, None
+    rate = audit_divergences / audited
+    if audit_divergences == 0:
+        return rate, min(1.0, 3 / audited)
+    return rate, min(1.0, rate + 1.96 * math.sqrt(rate * (1 - rate) / audited))
+
+
+def report(stats, label):
+    if stats["executed"] == 0:
+        return
+    print(label + ": " + str(stats["escalated"]) + "/" + str(stats["executed"]) + " shaders escalated ("
+          + str(round(100 * stats["escalated"] / stats["executed"], 2)) + "%), "
+          + ", ".join(str(stats[reason]) + " " + reason for reason in ["crash", "timeout", "divergence"]) + ", "
+          + str(stats["audited"]) + " audited")
+    rate, upper_bound = get_missed_risk(stats["audited"], stats["audit_divergences"])
+    if rate is None:
+        print(label + ": no audited shader, the missed bug risk cannot be estimated")
+        return
+    not_escalated = stats["executed"] - stats["escalated"]
+    print(label + ": " + str(stats["audit_divergences"]) + " audited shaders diverged on the full compiler set, "
+          + "estimated missed bug risk " + str(round(100 * rate, 2)) + "% (95% upper bound "
+          + str(round(100 * upper_bound, 2)) + "%), about " + str(round(rate * not_escalated, 1))
+          + " missed bugs among the " + str(not_escalated) + " shaders not escalated")
@@ -0,0 +1,230 @@
+# Copyright 2021 The glslsmith Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+import regression
+
+# Background lane of the shaders which only differ by timeouts: instead of being kept as miscompilations, they are
+# moved to the lane directory (shader and buffers named as in the kept directories) and re-executed later on the
+# compilers which timed out, with escalating time budgets and a lower cpu priority. Each shader ends up as:
+# slow: every compiler finished and agrees with the others, the shader and its buffers are removed
+# divergent: every compiler finished but the buffers differ, the shader is moved to the kept directories
+# hang: a compiler still times out with the largest budget, the shader is moved to the hangs directory of the lane
+# error: the post-processing of the shader failed, the shader is moved to the errors directory of the lane
+# The lane state (timeout_lane.json) is locked during each update as the batches add shaders while the lane runs.
+
+LANE_FILE = "timeout_lane.json"
+HANG_DIR = "hangs/"
+ERROR_DIR = "errors/"
+
+
+def get_timed_out_compilers(compilers, buffer_files):
+    # Names of the compilers which timed out when the other compilers agree (empty if the shader must be kept)
+    timed_out = []
+    other_files = []
+    for compiler, buffer_file in zip(compilers, buffer_files):
+        f = open(buffer_file, "rb")
+        if f.read() == b"timeout":
+            timed_out.append(compiler.name)
+        else:
+            other_files.append(buffer_file)
+        f.close()
+    if len(common.comparison_helper(other_files)) > 1:
+        return []
+    return timed_out
+
+
+def update_lane(lane_dir, function):
+    lock_file = open(lane_dir + LANE_FILE + ".lock", "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        entries = load_lane(lane_dir)
+        result = function(entries)
+        g = open(lane_dir + LANE_FILE + ".tmp", "w")
+        json.dump(entries, g, indent=1, sort_keys=True)
+        g.close()
+        os.replace(lane_dir + LANE_FILE + ".tmp", lane_dir + LANE_FILE)
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+    return result
+
+
+def load_lane(lane_dir):
+    if not os.path.isfile(lane_dir + LANE_FILE):
+        return {}
+    f = open(lane_dir + LANE_FILE, "r")
+    entries = json.load(f)
+    f.close()
+    return entries
+
+
+def divert_shader(compilers, lane_dir, shader_file, buffer_files, seed, timed_out):
+    os.makedirs(lane_dir, exist_ok=True)
+    shutil.move(shader_file, lane_dir + str(seed) + ".shadertrap")
+    for compiler, buffer_file in zip(compilers, buffer_files):
+        shutil.move(buffer_file, lane_dir + compiler.name + "_" + str(seed) + ".txt")
+
+    def add(entries):
+        entries[str(seed) + ".shadertrap"] = {"state": "pending", "timed_out": timed_out, "budget_index": 0,
+                                              "durations": {}, "added": time.time()}
+    update_lane(lane_dir, add)
+    print("Shader " + str(seed) + " timed out on " + ", ".join(timed_out) + ", moved to the timeout lane")
+
+
+def has_pending(lane_dir):
+    return any(entry["state"] == "pending" for entry in load_lane(lane_dir).values())
+
+
+def move_shader(compilers, lane_dir, file, shader_dir, buffer_dir):
+    seed = file.split(".")[0]
+    os.makedirs(shader_dir, exist_ok=True)
+    os.makedirs(buffer_dir, exist_ok=True)
+    shutil.move(lane_dir + file, shader_dir + file)
+    for compiler in compilers:
+        if os.path.isfile(lane_dir + compiler.name + "_" + seed + ".txt"):
+            shutil.move(lane_dir + compiler.name + "_" + seed + ".txt",
+                        buffer_dir + compiler.name + "_" + seed + ".txt")
+
+
+def rerun_shader(compilers, exec_dirs, lane_dir, file, entry, budget):
+    # Returns the new state of the shader and the duration of each re-executed compiler
+    seed = file.split(".")[0]
+    compilers_dict = {}
+    for compiler in compilers:
+        compilers_dict[compiler.name] = compiler
+    harness_file = regression.get_postprocessed_harness(exec_dirs.graphicsfuzz, lane_dir + file,
+                                                        lane_dir + "postprocessed/")
+    if harness_file is None:
+        return "error", {}
+    job_dir = tempfile.mkdtemp(prefix="lane_", dir=lane_dir)
+    durations = {}
+    timed_out = False
+    for name in entry["timed_out"]:
+        start = time.time()
+        result = common.execute_compiler(compilers_dict[name], exec_dirs.shadertrap, os.path.abspath(harness_file),
+                                         file, name + "_" + seed + ".txt", "./", False, budget, cwd=job_dir)
+        durations[name] = round(time.time() - start, 3)
+        if result == "timeout":
+            timed_out = True
+            break
+    state = "pending"
+    if not timed_out:
+        buffer_files = []
+        for compiler in compilers:
+            if compiler.name in entry["timed_out"]:
+                buffer_files.append(os.path.join(job_dir, compiler.name + "_" + seed + ".txt"))
+            else:
+                buffer_files.append(lane_dir + compiler.name + "_" + seed + ".txt")
+        state = "slow"
+        if len(common.comparison_helper(buffer_files)) > 1:
+            state = "divergent"
+            for name in entry["timed_out"]:
+                shutil.move(os.path.join(job_dir, name + "_" + seed + ".txt"), lane_dir + name + "_" + seed + ".txt")
+    shutil.rmtree(job_dir, ignore_errors=True)
+    return state, durations
+
+
+def run_lane(compilers, exec_dirs, lane_dir, budgets):
+    # Shaders are re-executed with the smallest budget first so that slow shaders leave the lane quickly
+    compilers_dict = {}
+    for compiler in compilers:
+        compilers_dict[compiler.name] = compiler
+    while True:
+        entries = load_lane(lane_dir)
+        pending = [file for file, entry in entries.items() if entry["state"] == "pending"]
+        if not pending:
+            break
+        file = min(pending, key=lambda name: (entries[name]["budget_index"], entries[name]["added"]))
+        entry = entries[file]
+        budget = budgets[min(entry["budget_index"], len(budgets) - 1)]
+        print("Re-executing " + file + " on " + ", ".join(entry["timed_out"]) + " with a budget of "
+              + str(budget) + "s")
+        state, durations = rerun_shader(compilers, exec_dirs, lane_dir, file, entry, budget)
+        if state == "pending" and entry["budget_index"] + 1 >= len(budgets):
+            state = "hang"
+        if state == "slow":
+            common.clean_files(lane_dir, [file] + [compiler.name + "_" + file.split(".")[0] + ".txt"
+                                                   for compiler in compilers])
+        elif state == "divergent":
+            move_shader(compilers, lane_dir, file, exec_dirs.keptshaderdir, exec_dirs.keptbufferdir)
+            buffer_files = [exec_dirs.keptbufferdir + compiler.name + "_" + file.split(".")[0] + ".txt"
+                            for compiler in compilers]
+            buffers_compilers = {}
+            for compiler, buffer_file in zip(compilers, buffer_files):
+                buffers_compilers[buffer_file] = compiler.name
+            groups = [[buffers_compilers[buffer_file] for buffer_file in group]
+                      for group in common.comparison_helper(buffer_files)]
+            regression.record_kept_shader(exec_dirs.keptshaderdir, file,
+                                          regression.get_classification(groups, compilers_dict))
+        elif state == "hang":
+            move_shader(compilers, lane_dir, file, lane_dir + HANG_DIR, lane_dir + HANG_DIR)
+        elif state == "error":
+            move_shader(compilers, lane_dir, file, lane_dir + ERROR_DIR, lane_dir + ERROR_DIR)
+        print(file + ": " + state)
+
+        def record(entries):
+            entries[file]["state"] = state
+            entries[file]["budget_index"] += 1
+            entries[file]["durations"][str(budget)] = durations
+        update_lane(lane_dir, record)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-execute the shaders which timed out with escalating budgets and "
+                                                 "sort them into hangs, slow shaders and divergences")
+    parser.add_argument('--config-file', dest='config', default="config.xml",
+                        help="specify a different configuration file from the default")
+    parser.add_argument('--lane-dir', dest='lanedir', default="timeoutlane/",
+                        help="Directory of the timeout lane (by default: timeoutlane/ in the execution directory)")
+    parser.add_argument('--budgets', dest='budgets', nargs="+", default=[30, 120, 600], type=int,
+                        help="Escalating time budgets in seconds (by default: 30 120 600)")
+    parser.add_argument('--nice', dest='nice', default=10, type=int,
+                        help="Niceness increment of the lane and of the executions (by default: 10)")
+    parser.add_argument('--status', dest='status', action='store_true',
+                        help="Print the number of shaders per state and exit")
+    ns = parser.parse_args(sys.argv[1:])
+    exec_dirs = common.load_dir_settings(ns.config)
+    compilers = common.load_compilers_settings(ns.config)
+    os.chdir(exec_dirs.execdir)
+    lane_dir = os.path.join(ns.lanedir, "")
+    if ns.status:
+        entries = load_lane(lane_dir)
+        for state in ["pending", "slow", "divergent", "hang", "error"]:
+            print(state + ": " + str(len([entry for entry in entries.values() if entry["state"] == state])))
+        return
+    os.makedirs(lane_dir, exist_ok=True)
+    # A single lane runs at a time
+    run_lock = open(lane_dir + "run.lock", "w")
+    try:
+        fcntl.flock(run_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("The timeout lane is already running")
+        return
+    os.nice(ns.nice)
+    run_lane(compilers, exec_dirs, lane_dir, sorted(ns.budgets))
+    run_lock.close()
+
+
+if __name__ == "__main__":
+    main()